@@ -1,12 +1,20 @@
 import traceback
+import inspect
 import os
-import asyncio
-import datetime
-from copy import deepcopy
+import atexit
 from .sloth_log import sloth_log
-from .sloth_connector import SlothConnector
 from .sloth_config import SlothConfig
+from .sloth_connector import SlothConnector, SlothBinaryConnector, snapshot_connectors, zip_compression
+from .sloth_worker import SlothWorker
+from .sloth_store import SlothCaptureStore
+from .sloth_sampler import SlothSampler
+from .sloth_fingerprint import SlothFingerprintCache
+from .sloth_descriptor import SlothFunctionDescriptor
+from .sloth_serialized import SlothSerializedValue
+from .sloth_timing import start_timer, stop_timer
+from .sloth_metrics import SlothMetrics
 from .sloth_watcher import SlothWatcher
+from .sloth_merge import SlothSnapshotMerger
 from functools import wraps
 
 # the name of the particular instance
@@ -15,31 +23,56 @@ os.environ['SLOTH_INSTANCE'] = 'SLOTH_WATCHER'
 # an instance of sloth watcher starts with the initiation of the package
 slothwatcher = SlothWatcher()
 
+# the snapshot of an unfinished watching and the queued records are written at the interpreter exit
+atexit.register(slothwatcher.shutdown)
 
-def watchme():
+
+def watchme(sample_rate: float = None, rate_limit: float = None, reservoir: int = None):
     """
     The main decorator for the method you need to watch at
     1. copying the income arguments
     2. intercepting the outcome result of the method
     3. regularly dumping the in-and-out of the method to dump-file
 
+    The sampling policies of the method override the ones of slothwatcher.start (see SlothSampler)
+
+    A coroutine function (async def) is awaited in the event loop of the caller, and its call is serialized
+    by an executor (see SlothWatcher.capture_async), so the loop is not blocked
+
+    :param sample_rate: a share of calls to capture
+    :param rate_limit: a max amount of captures per second
+    :param reservoir: a size of the reservoir sample of calls per snapshot
+
     """
 
     def subst_function(fn):
 
+        # the metadata of the function doesn't change between the calls
+        descriptor = SlothFunctionDescriptor(fn)
+
         @wraps(fn)
         def save_vars(*args, **kwargs):
 
             if slothwatcher.sloth_state != SlothConfig.SlothState.WATCHING:
                 return fn(*args, **kwargs)
 
-            if slothwatcher.dump_counter >= SlothConfig.DUMP_ITER_COUNT:
-                slothwatcher.dump()
+            # only sampled calls pay for copying and serialization
+            sampled, reservoir_slot = slothwatcher.sample(descriptor, sample_rate, rate_limit, reservoir)
+            if not sampled:
+                return fn(*args, **kwargs)
+
+            # the call with the inputs captured before gives its slot of the reservoir back
+            if slothwatcher.seen_inputs(descriptor, args, kwargs):
+                slothwatcher.cancel_sample(descriptor, reservoir_slot)
+                return fn(*args, **kwargs)
 
-            in_args = deepcopy(args)
-            in_kwargs = deepcopy(kwargs)
+            # in QUEUED mode the dump is done by the background worker
+            if slothwatcher.capture_mode == SlothConfig.SlothCaptureMode.SYNC:
+                slothwatcher.dump_if_full()
 
-            start_time = datetime.datetime.now()
+            in_args, in_kwargs = slothwatcher.snapshot_inputs(args, kwargs)
+
+            started = start_timer()
 
             try:
                 res = fn(*args, **kwargs)
@@ -48,12 +81,52 @@ def watchme():
                 res = e
                 additional_info = traceback.format_exc()
 
-            stop_time = datetime.datetime.now()
+            timing = stop_timer(started)
 
-            asyncio.run(slothwatcher.watch(fn, in_args, in_kwargs, res, additional_info, start_time, stop_time))
+            slothwatcher.capture(descriptor, in_args, in_kwargs, res, additional_info, timing, reservoir_slot)
 
             return res
 
+        @wraps(fn)
+        async def save_vars_async(*args, **kwargs):
+
+            if slothwatcher.sloth_state != SlothConfig.SlothState.WATCHING:
+                return await fn(*args, **kwargs)
+
+            sampled, reservoir_slot = slothwatcher.sample(descriptor, sample_rate, rate_limit, reservoir)
+            if not sampled:
+                return await fn(*args, **kwargs)
+
+            if slothwatcher.seen_inputs(descriptor, args, kwargs):
+                slothwatcher.cancel_sample(descriptor, reservoir_slot)
+                return await fn(*args, **kwargs)
+
+            if slothwatcher.capture_mode == SlothConfig.SlothCaptureMode.SYNC and slothwatcher.is_full():
+                await slothwatcher.run_in_executor(slothwatcher.dump_if_full)
+
+            # the arguments are copied before the call, in the loop, as the other tasks can change them later
+            in_args, in_kwargs = slothwatcher.snapshot_inputs(args, kwargs)
+
+            started = start_timer()
+
+            try:
+                res = await fn(*args, **kwargs)
+                additional_info = ""
+            except Exception as e:
+                res = e
+                additional_info = traceback.format_exc()
+
+            # the CPU time of the thread includes the other tasks of the loop, so only the wall-clock time is kept
+            timing = {'wall_ns': stop_timer(started)['wall_ns']}
+
+            await slothwatcher.capture_async(descriptor, in_args, in_kwargs, res, additional_info, timing,
+                                             reservoir_slot)
+
+            return res
+
+        if descriptor.is_async:
+            return save_vars_async
+
         return save_vars
 
     return subst_function
@@ -0,0 +1,72 @@
+def sloth_benchmark(run=None, setup=None, baseline_ns: int = 0, baseline_cpu_ns: int = 0, tolerance: float = 3.0,
+                    warmup: int = 1, repeat: int = 5, percentile: float = 50, name: str = "") -> dict:
+    """
+    Running the method repeatedly and comparing the percentile of its run times with the captured ones
+
+    Each run gets its own copy of the arguments (made by setup, not timed), the warmup runs are not measured.
+    If the percentile of the wall-clock (or the CPU) times exceeds the captured time multiplied by the tolerance,
+    the regression is reported with the distribution of the measured times (the passed runs print nothing)
+
+    The function is self-contained: its source is copied to the generated test modules
+
+    :param run: the method call, gets the arguments returned by setup
+    :param setup: returns a tuple of the arguments for run
+    :param baseline_ns: the captured wall-clock time (ns)
+    :param baseline_cpu_ns: the captured CPU time of the thread (ns), 0 - not compared
+    :param tolerance: the max allowed ratio of the measured time to the captured one
+    :param warmup: an amount of runs before the measurement
+    :param repeat: an amount of measured runs
+    :param percentile: the percentile of the measured times to compare (50 - median)
+    :param name: the name of the test, for the report
+    :return: the measured wall-clock and CPU times (ns)
+    """
+
+    import math
+    import time
+
+    def run_once():
+
+        args = setup()
+
+        start_time = time.perf_counter_ns()
+        start_cpu_time = time.thread_time_ns()
+
+        try:
+            run(*args)
+        except Exception:
+            pass
+
+        cpu_time = time.thread_time_ns() - start_cpu_time
+
+        return time.perf_counter_ns() - start_time, cpu_time
+
+    def rank(times, p):
+        return times[max(0, math.ceil(p / 100 * len(times)) - 1)]
+
+    def distribution(times):
+        return "min " + str(times[0]) + ", median " + str(rank(times, 50)) + ", p90 " + str(rank(times, 90)) + \
+               ", max " + str(times[-1]) + " ns, all runs: " + str(times)
+
+    for _ in range(warmup):
+        run_once()
+
+    measured = [run_once() for _ in range(max(1, repeat))]
+
+    wall_times = sorted(wall_time for wall_time, _ in measured)
+    cpu_times = sorted(cpu_time for _, cpu_time in measured)
+
+    regressions = []
+
+    if baseline_ns and rank(wall_times, percentile) > baseline_ns * tolerance:
+        regressions.append("p" + str(percentile) + " wall-clock time " + str(rank(wall_times, percentile)) +
+                           " ns > " + str(baseline_ns) + " ns captured x " + str(tolerance))
+
+    if baseline_cpu_ns and rank(cpu_times, percentile) > baseline_cpu_ns * tolerance:
+        regressions.append("p" + str(percentile) + " CPU time " + str(rank(cpu_times, percentile)) +
+                           " ns > " + str(baseline_cpu_ns) + " ns captured x " + str(tolerance))
+
+    if regressions:
+        raise AssertionError("Performance regression of " + "; ".join(regressions) + "\n" + name +
+                             ": wall-clock " + distribution(wall_times) + "; CPU " + distribution(cpu_times))
+
+    return {'wall_ns': wall_times, 'cpu_ns': cpu_times}
@@ -0,0 +1,148 @@
+import sys
+import pickle
+import struct
+
+# the first bytes of the value serialized by the columnar serializer
+COLUMNAR_MAGIC = b'SLOTHCOL1'
+
+# the buffers of the columns are aligned, so they can be memory mapped as arrays
+COLUMNAR_ALIGN = 64
+
+
+def is_columnar_type(value_type=None) -> bool:
+    # numpy arrays, pandas series and frames are serialized by the columnar serializer
+    # (numpy and pandas are not imported if the project doesn't use them)
+
+    np = sys.modules.get('numpy')
+    pd = sys.modules.get('pandas')
+
+    if np is not None and value_type is np.ndarray:
+        return True
+
+    if pd is not None and value_type in (pd.DataFrame, pd.Series):
+        return True
+
+    return False
+
+
+def is_columnar(data: bytes = b"") -> bool:
+    return data[:len(COLUMNAR_MAGIC)] == COLUMNAR_MAGIC
+
+
+def dump_columnar(value=None) -> bytes:
+    """
+    Serializing ndarray, Series or DataFrame as the raw buffers of its columns, plus the metadata:
+    the kind of the value, dtypes and shapes of the buffers, the index and the columns
+
+    The layout is: the magic bytes, the length of the header (8 bytes, little-endian), the pickled header,
+    and the buffers, each one aligned to COLUMNAR_ALIGN bytes from the start of the value.
+    The columns that have no plain numpy dtype (objects, strings, categories etc.) are pickled
+
+    :param value: the value to serialize
+    :return: the serialized value
+    """
+
+    np = sys.modules['numpy']
+    pd = sys.modules.get('pandas')
+
+    if pd is not None and isinstance(value, pd.DataFrame):
+        header = {'kind': 'frame', 'index': value.index, 'columns': value.columns, 'name': None}
+        arrays = [value.iloc[:, i] for i in range(value.shape[1])]
+    elif pd is not None and isinstance(value, pd.Series):
+        header = {'kind': 'series', 'index': value.index, 'columns': None, 'name': value.name}
+        arrays = [value]
+    else:
+        header = {'kind': 'ndarray', 'index': None, 'columns': None, 'name': None}
+        arrays = [value]
+
+    buffers = []
+    for array in arrays:
+
+        dtype = getattr(array, 'dtype', None)
+
+        if isinstance(dtype, np.dtype) and not dtype.hasobject:
+            data = np.ascontiguousarray(array).tobytes()
+            buffers.append((dtype.str, tuple(np.shape(array)), data))
+        else:
+            data = pickle.dumps(array.array if hasattr(array, 'array') else array,
+                                protocol=pickle.HIGHEST_PROTOCOL)
+            buffers.append((None, tuple(np.shape(array)), data))
+
+    # offsets of the buffers, relative to the start of the value
+    # they depend on the size of the header, so it's pickled again until the buffers start after it
+    header_len = 0
+    while True:
+
+        offset = align(len(COLUMNAR_MAGIC) + 8 + header_len)
+        data_start = offset
+
+        header['buffers'] = []
+        for dtype_str, shape, data in buffers:
+            header['buffers'].append((dtype_str, shape, offset, len(data)))
+            offset = align(offset + len(data))
+
+        header_data = pickle.dumps(header, protocol=pickle.HIGHEST_PROTOCOL)
+
+        if len(COLUMNAR_MAGIC) + 8 + len(header_data) <= data_start:
+            break
+
+        header_len = len(header_data)
+
+    chunks = [COLUMNAR_MAGIC, struct.pack('<Q', len(header_data)), header_data]
+    size = len(COLUMNAR_MAGIC) + 8 + len(header_data)
+
+    for (dtype_str, shape, data), (_, _, offset, _) in zip(buffers, header['buffers']):
+        chunks.append(b'\0' * (offset - size))
+        chunks.append(data)
+        size = offset + len(data)
+
+    return b"".join(chunks)
+
+
+def align(offset: int = 0) -> int:
+    return (offset + COLUMNAR_ALIGN - 1) // COLUMNAR_ALIGN * COLUMNAR_ALIGN
+
+
+def sloth_load_columnar(filename: str = None):
+    """
+    Loading the value serialized by the columnar serializer from a file,
+    the buffers of the columns are memory mapped (copy-on-write), not copied: the tested method can change
+    its inputs in place, the changed pages are private to the test and the file stays as it is
+
+    The function is self-contained: its source is copied to the generated variables modules
+
+    :param filename: the file with the serialized value
+    :return: ndarray, Series or DataFrame
+    """
+
+    import pickle
+    import struct
+    import numpy as np
+
+    with open(filename, 'rb') as fh:
+        fh.seek(len(b'SLOTHCOL1'))
+        header_len = struct.unpack('<Q', fh.read(8))[0]
+        header = pickle.loads(fh.read(header_len))
+
+        arrays = []
+        for dtype_str, shape, offset, length in header['buffers']:
+            if dtype_str is None:
+                fh.seek(offset)
+                arrays.append(pickle.loads(fh.read(length)))
+            elif length == 0:
+                arrays.append(np.empty(shape, dtype=np.dtype(dtype_str)))
+            else:
+                arrays.append(np.memmap(filename, dtype=np.dtype(dtype_str), mode='c', offset=offset, shape=shape))
+
+    if header['kind'] == 'ndarray':
+        return np.asarray(arrays[0])
+
+    import pandas as pd
+
+    if header['kind'] == 'series':
+        return pd.Series(arrays[0], index=header['index'], name=header['name'], copy=False)
+
+    value = pd.DataFrame(dict(enumerate(arrays)), index=header['index'], copy=False)
+    value.columns = header['columns']
+
+    return value
@@ -3,11 +3,111 @@ class SlothConfig:
     # an iteration amount after which the dump will happen in watchme decorator
     DUMP_ITER_COUNT = 100
 
+    # the snapshot is also rotated when the serialized values captured for it reach a size (bytes),
+    # or when it's open for an amount of seconds (0 - no limit)
+    DUMP_MAX_BYTES = 0
+    DUMP_MAX_SECONDS = 0
+
+    # a capture mode of watchme decorator: SlothCaptureMode.SYNC by default
+    CAPTURE_MODE = "0"
+
+    # a max amount of records waiting in the queue of the background worker (QUEUED capture mode)
+    # if the queue is full, the new records are dropped
+    CAPTURE_QUEUE_SIZE = 10000
+
+    # how the income arguments are kept until they are serialized: SlothCopyMode.DEEPCOPY by default
+    CAPTURE_COPY = "0"
+
+    # in SlothCopyMode.SERIALIZE mode, pandas objects are copied lazily (if pandas copy-on-write is on)
+    CAPTURE_COPY_ON_WRITE = True
+
+    # write the snapshots by a background writer, so the watched method doesn't wait for the dump
+    FLUSH_IN_BACKGROUND = True
+
+    # a max amount of full buffers waiting for the background writer
+    # if all of them are busy, the next dump waits for the writer
+    FLUSH_QUEUE_SIZE = 2
+
+    # an amount of buffered records after which they are appended to the open snapshot (0 - only on dump)
+    FLUSH_ITER_COUNT = 0
+
+    # limits of the capture buffer between two dumps: an amount of records and a size of serialized values
+    # (0 - no limit), and the eviction policy (see SlothEvictionPolicy) when the limit is reached
+    STORE_MAX_RECORDS = 0
+    STORE_MAX_BYTES = 0
+    STORE_EVICTION_POLICY = "0"
+
+    # sampling of the watched calls (see SlothSampler): a share of calls to capture,
+    # a max amount of captures per second for each function (0 - no limit),
+    # and a size of the reservoir sample of calls for each function (0 - no reservoir)
+    SAMPLE_RATE = 1.0
+    SAMPLE_RATE_LIMIT = 0
+    SAMPLE_RESERVOIR = 0
+
+    # skip the calls with the inputs already captured for the function (by a fingerprint of the bound arguments),
+    # and a max amount of fingerprints to remember
+    FINGERPRINT_DEDUP = False
+    FINGERPRINT_CACHE_SIZE = 100000
+
+    # serialize numpy arrays and pandas objects as raw column buffers (memory mapped in the generated tests)
+    COLUMNAR_SERIALIZER = True
+
+    # capture the stack of callers of the watched method, and a max amount of callers in it (0 - the whole stack)
+    CALL_STACK_CAPTURE = True
+    CALL_STACK_DEPTH = 0
+
+    # a format of the snapshot: SlothSnapshotFormat.XML by default
+    SNAPSHOT_FORMAT = "0"
+
+    # a compression of the snapshot (zip archive): SlothCompression.DEFLATE by default,
+    # and its level (None - the default one of the codec): 0 (stored) - 9 (best) for DEFLATE, 1 - 9 for BZIP2
+    SNAPSHOT_COMPRESSION = "1"
+    SNAPSHOT_COMPRESS_LEVEL = None
+
+    # the runtime metrics of the watcher (see SlothMetrics) are reported every amount of seconds (0 - no reports):
+    # as a summary to sloth_log, and to a file in the Prometheus text format (None - no file)
+    METRICS_INTERVAL = 60
+    METRICS_LOG = False
+    METRICS_FILE = None
+
+    # the first bytes of the snapshot in the binary format
+    BINARY_MAGIC = b'SLOTHBIN1'
+
+    # the converter: an amount of processes generating the tests, and the sharding of the generated modules:
+    # an amount of tests in each shard (0 - one module for the whole snapshot), or one shard for each function
+    CONVERT_PROCESSES = 1
+    CONVERT_SHARD_SIZE = 0
+    CONVERT_SHARD_BY_FUNCTION = False
+
+    # the serialized values of the generated variables module are kept in a data store, and loaded
+    # when a test uses them (instead of loading all of them on import), and kept loaded after that
+    CONVERT_LAZY_VALUES = True
+    CONVERT_CACHE_VALUES = True
+
+    # the converter keeps a cache of the generated tests in the result dir, and generates the tests only for
+    # the new or changed records of the snapshot
+    CONVERT_INCREMENTAL = True
+
+    # the generated tests check that the run time of the method is not more than the captured one
+    # multiplied by the tolerance, the tolerances of particular methods can be set by
+    # "scope.Class.method", "Class.method" or "method" (e.g. {'main.cleanup': 5})
+    RUN_TIME_TOLERANCE = 3
+    RUN_TIME_TOLERANCES = {}
+
+    # the generated tests run each method repeatedly (see sloth_benchmark): an amount of the warmup runs
+    # and of the measured runs, and the percentile of the measured times to compare with the captured time
+    BENCHMARK_MODE = False
+    BENCHMARK_WARMUP = 1
+    BENCHMARK_REPEAT = 5
+    BENCHMARK_PERCENTILE = 50
+
     # a dictionary that defines the equality operator between two values of the particular type
     # used in pytest creation
     objects_eq = {
         "<class 'pandas.core.series.Series'>": "equals",
-        "<class 'pandas.core.frame.DataFrame'>": "equals"
+        "<class 'pandas.core.frame.DataFrame'>": "equals",
+        "<class 'pandas.Series'>": "equals",
+        "<class 'pandas.DataFrame'>": "equals"
     }
 
     class SlothState:
@@ -15,6 +115,42 @@ class SlothConfig:
         WATCHING = "1"
         TESTING = "2"
 
+    class SlothCaptureMode:
+        # the record is processed in the caller's thread
+        SYNC = "0"
+        # the record is put to a bounded queue and processed by a background worker
+        QUEUED = "1"
+
+    class SlothCopyMode:
+        # the arguments are deep copied before the call and serialized by the watcher
+        DEEPCOPY = "0"
+        # the arguments are serialized once before the call, immutable ones are not copied
+        SERIALIZE = "1"
+
+    class SlothEvictionPolicy:
+        # the oldest record is evicted
+        DROP_OLDEST = "0"
+        # the incoming record is not stored
+        DROP_NEWEST = "1"
+        # the oldest record of the function with the most records is evicted
+        FAIR_SHARE = "2"
+
+    class SlothSnapshotFormat:
+        # xml with base64 serialized values
+        XML = "0"
+        # length-prefixed binary records with raw serialized values
+        BINARY = "1"
+
+    class SlothCompression:
+        # no compression, the fastest one
+        STORED = "0"
+        # zlib (level 1 - fast, level 9 - best)
+        DEFLATE = "1"
+        # bz2, slower and smaller
+        BZIP2 = "2"
+        # lzma, the slowest and the smallest
+        LZMA = "3"
+
     class SlothValueState:
         RESULT = "0"
         INCOME = "1"
@@ -1,11 +1,60 @@
 import os
 import xml.etree.ElementTree as xml
 import zipfile
+import pickle
+import struct
+import codecs
 from typing import List, Dict
 from . import sloth_log
+from . import SlothConfig
+
+
+# SlothCompression -> (the compression method of the zip archive, the allowed levels)
+zip_compressions = {
+    SlothConfig.SlothCompression.STORED: (zipfile.ZIP_STORED, ()),
+    SlothConfig.SlothCompression.DEFLATE: (zipfile.ZIP_DEFLATED, range(0, 10)),
+    SlothConfig.SlothCompression.BZIP2: (zipfile.ZIP_BZIP2, range(1, 10)),
+    SlothConfig.SlothCompression.LZMA: (zipfile.ZIP_LZMA, ()),
+}
+
+
+def zip_compression(compression: str = None, compress_level: int = None) -> (int, int):
+    """
+    The compression method and level of the zip archive
+
+    :param compression: SlothCompression (SlothConfig.SNAPSHOT_COMPRESSION by default)
+    :param compress_level: the level of the codec (SlothConfig.SNAPSHOT_COMPRESS_LEVEL by default)
+    :return: the compression method, the level
+    """
+
+    if compression is None:
+        compression = SlothConfig.SNAPSHOT_COMPRESSION
+
+    if compress_level is None:
+        compress_level = SlothConfig.SNAPSHOT_COMPRESS_LEVEL
+
+    if compression not in zip_compressions:
+        sloth_log.error("Unknown compression of the snapshot: " + str(compression))
+        raise Exception("Unknown compression of the snapshot: " + str(compression))
+
+    method, levels = zip_compressions[compression]
+
+    if compress_level is not None and compress_level not in levels:
+        sloth_log.error("The compression level " + str(compress_level) + " is not supported by the codec")
+        raise Exception("The compression level " + str(compress_level) + " is not supported by the codec")
+
+    return method, compress_level
 
 
 class SlothConnector:
+    """
+    The snapshot writer of the default XML format
+
+    The snapshot is a zip archive with a single member, the format of which is defined by the connector.
+    Another format can be plugged in by overriding write_header, write_function and write_footer
+
+    """
+
     sloth_service = None
     instance_id = ""
     snapshot_id = ""
@@ -16,14 +65,30 @@ class SlothConnector:
     xml_data = None
     to_dir = None
 
-    def __init__(self, session_id: str = "", snapshot_id: str = "", to_dir: str = None):
+    file_ext = ".xml"
+
+    zip_fn = ""
+    zip_file = None
+    compression = zipfile.ZIP_DEFLATED
+    compress_level = None
+    snapshot_stream = None
+
+    written_blobs = None
+
+    def __init__(self, session_id: str = "", snapshot_id: str = "", to_dir: str = None, compression: str = None,
+                 compress_level: int = None):
 
         self.to_dir = to_dir
 
+        self.compression, self.compress_level = zip_compression(compression, compress_level)
+
         self.session_id = session_id
         if snapshot_id != "":
             self.snapshot_id = snapshot_id
 
+        # hashes of the blobs written to the snapshot
+        self.written_blobs = set()
+
         self.init_xml()
 
     def init_xml(self):
@@ -31,7 +96,8 @@ class SlothConnector:
         if self.to_dir is None:
             self.to_dir = os.getcwd()
 
-        self.xml_filename = os.path.join(self.to_dir, self.snapshot_id + ".xml")
+        self.xml_filename = os.path.join(self.to_dir, self.snapshot_id + self.file_ext)
+        self.zip_fn = os.path.join(self.to_dir, self.snapshot_id + '.zip')
 
         self.xml_data = xml.Element("SlothWatch")
 
@@ -44,40 +110,121 @@ class SlothConnector:
         session_name = xml.SubElement(self.xml_data, "session_id")
         session_name.text = self.session_id
 
-    def dump_data(self, data_watch_dump: List = None) -> str:
+    def dump_data(self, data_watch_dump: List = None, close: bool = True) -> str:
+        """
+        Writing the watched records to the snapshot (zip archive)
+
+        The records are streamed straight into the compressed member of the zip, one function at a time,
+        so neither a temporary file, nor the whole xml tree is needed. The snapshot stays open for the next
+        records until it's closed
+
+        :param data_watch_dump: watched records
+        :param close: close the snapshot after the records are written
+        :return: the filename of the snapshot
+        """
 
         if data_watch_dump is None:
             sloth_log.error("couldn't dump the data. watch data was not provided!")
             return ""
 
-        functions_xml = xml.Element("functions_list")
+        if self.snapshot_stream is None:
+            self.open_snapshot()
 
-        n = 0
         for func_watch in data_watch_dump:
-            n += 1
-            self.dump_function(functions_xml, func_watch['function'], func_watch['arguments'], func_watch['results'], n)
+            self.engage_counter += 1
+            self.write_function(self.dedup_blobs(func_watch), self.engage_counter)
+
+        if close:
+            self.close_snapshot()
+
+        return self.zip_fn
+
+    def open_snapshot(self):
+
+        # the member is compressed as it's written, by the thread writing the snapshot (the background writer)
+        self.zip_file = zipfile.ZipFile(self.zip_fn, 'w', compression=self.compression,
+                                        compresslevel=self.compress_level)
+        self.snapshot_stream = self.zip_file.open(os.path.basename(self.xml_filename), 'w', force_zip64=True)
+
+        self.write_header()
+
+    def close_snapshot(self):
+
+        if self.snapshot_stream is None:
+            self.open_snapshot()
+
+        self.write_footer()
+
+        self.snapshot_stream.close()
+        self.zip_file.close()
+
+        self.snapshot_stream = None
+        self.zip_file = None
+
+        sloth_log.info('zip pack created: ' + self.zip_fn)
 
-        self.xml_data.append(functions_xml)
+    def dedup_blobs(self, func_watch: Dict = None) -> Dict:
+        """
+        Each blob (serialized value) is written to the snapshot only once: its first occurrence has the value
+        and the hash (ref) of it, the next occurrences have the hash only
 
-        tree = xml.ElementTree(self.xml_data)
+        :param func_watch: watched record (function, arguments, results)
+        :return: the record to write
+        """
 
-        with open(self.xml_filename, "wb") as fh:
-            tree.write(fh)
+        def dedup(var_dict: Dict = None, value_key: str = "", ref_key: str = "") -> Dict:
 
-        zip_fn = self.xml_filename[:-4] + '.zip'
-        with zipfile.ZipFile(zip_fn, 'w', compression=zipfile.ZIP_DEFLATED) as myzip:
-            myzip.write(self.xml_filename, arcname=os.path.basename(self.xml_filename))
+            ref = var_dict.get(ref_key, "")
+            if not ref:
+                return var_dict
 
-        sloth_log.info('zip pack created: ' + zip_fn)
+            if ref in self.written_blobs:
+                var_dict = dict(var_dict)
+                var_dict[value_key] = ""
+            else:
+                self.written_blobs.add(ref)
 
-        os.remove(self.xml_filename)
+            return var_dict
 
-        return zip_fn
+        return {
+            'function': dedup(func_watch['function'], 'class_dump', 'class_ref'),
+            'arguments': [dedup(arg_dict, 'par_value', 'par_ref') for arg_dict in func_watch['arguments']],
+            'results': [dedup(res_dict, 'par_value', 'par_ref') for res_dict in func_watch['results']]
+        }
+
+    def write_header(self):
+
+        self.snapshot_stream.write(b'<SlothWatch>')
+        for element in self.xml_data:
+            self.snapshot_stream.write(xml.tostring(element))
+        self.snapshot_stream.write(b'<functions_list>')
+
+    def write_function(self, func_watch: Dict = None, n: int = 0):
+
+        function_xml = self.dump_function(None, func_watch['function'], func_watch['arguments'],
+                                          func_watch['results'], n)
+        self.snapshot_stream.write(xml.tostring(function_xml))
+
+    def write_footer(self):
+
+        self.snapshot_stream.write(b'</functions_list></SlothWatch>')
+
+    @staticmethod
+    def encode_value(value) -> str:
+        # raw serialized values are stored in xml as base64 text
+
+        if isinstance(value, bytes):
+            return codecs.encode(value, "base64").decode()
+
+        return value
 
     def dump_function(self, functions_element=None,
                       function_dict: Dict = None, args_dicts: List = None, res_dicts: List = None, n: int = 0):
 
-        function_element = xml.SubElement(functions_element, "function")
+        if functions_element is None:
+            function_element = xml.Element("function")
+        else:
+            function_element = xml.SubElement(functions_element, "function")
 
         run_id = xml.SubElement(function_element, "run_id")
         run_id.text = str(n)
@@ -89,14 +236,25 @@ class SlothConnector:
         classname.text = function_dict['class_name']
 
         classdump = xml.SubElement(function_element, "class_dump")
-        classdump.text = function_dict['class_dump']
+        classdump.text = self.encode_value(function_dict['class_dump'])
+
+        classref = xml.SubElement(function_element, "class_ref")
+        classref.text = function_dict.get('class_ref', "")
 
         function_name = xml.SubElement(function_element, "function_name")
         function_name.text = function_dict['function_name']
 
+        is_async = xml.SubElement(function_element, "is_async")
+        is_async.text = str(function_dict.get('is_async', False))
+
         run_time = xml.SubElement(function_element, "run_time")
         run_time.text = function_dict['run_time']
 
+        timing = xml.SubElement(function_element, "timing")
+        for time_name, time_value in function_dict.get('timing', {}).items():
+            time_element = xml.SubElement(timing, time_name)
+            time_element.text = str(time_value)
+
         call_stack = xml.SubElement(function_element, "call_stack")
         call_stack.text = function_dict['call_stack']
 
@@ -105,13 +263,16 @@ class SlothConnector:
             arg_xml = xml.SubElement(args_xml, "argument")
 
             par_type = xml.SubElement(arg_xml, "par_type")
-            par_type.text = arg_dict['par_type']
+            par_type.text = self.encode_value(arg_dict['par_type'])
 
             par_name = xml.SubElement(arg_xml, "par_name")
             par_name.text = arg_dict['par_name']
 
             par_value = xml.SubElement(arg_xml, "par_value")
-            par_value.text = arg_dict['par_value']
+            par_value.text = self.encode_value(arg_dict['par_value'])
+
+            par_ref = xml.SubElement(arg_xml, "par_ref")
+            par_ref.text = arg_dict.get('par_ref', "")
 
             par_state = xml.SubElement(arg_xml, "par_state")
             par_state.text = arg_dict['par_state']
@@ -127,13 +288,16 @@ class SlothConnector:
             reslt_xml = xml.SubElement(reslts_xml, "result")
 
             par_type = xml.SubElement(reslt_xml, "par_type")
-            par_type.text = res_dict['par_type']
+            par_type.text = self.encode_value(res_dict['par_type'])
 
             par_name = xml.SubElement(reslt_xml, "par_name")
             par_name.text = res_dict['par_name']
 
             par_value = xml.SubElement(reslt_xml, "par_value")
-            par_value.text = res_dict['par_value']
+            par_value.text = self.encode_value(res_dict['par_value'])
+
+            par_ref = xml.SubElement(reslt_xml, "par_ref")
+            par_ref.text = res_dict.get('par_ref', "")
 
             par_state = xml.SubElement(reslt_xml, "par_state")
             par_state.text = res_dict['par_state']
@@ -143,3 +307,52 @@ class SlothConnector:
 
             additional_info = xml.SubElement(reslt_xml, "additional_info")
             additional_info.text = res_dict['additional_info']
+
+        return function_element
+
+
+class SlothBinaryConnector(SlothConnector):
+    """
+    The snapshot writer of the compact binary format
+
+    The member of the zip is the magic bytes, followed by the length-prefixed (8 bytes, little-endian) pickled
+    records: the header first, and then a record per function, with the raw serialized values (no base64)
+
+    """
+
+    file_ext = ".slb"
+
+    def write_header(self):
+
+        self.snapshot_stream.write(SlothConfig.BINARY_MAGIC)
+
+        self.write_record({
+            'instance_name': self.instance_id,
+            'snapshot_name': self.snapshot_id,
+            'session_id': self.session_id
+        })
+
+    def write_function(self, func_watch: Dict = None, n: int = 0):
+
+        self.write_record({
+            'run_id': str(n),
+            'function': func_watch['function'],
+            'arguments': func_watch['arguments'],
+            'results': func_watch['results']
+        })
+
+    def write_footer(self):
+        pass
+
+    def write_record(self, record: Dict = None):
+
+        data = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+
+        self.snapshot_stream.write(struct.pack('<Q', len(data)))
+        self.snapshot_stream.write(data)
+
+
+snapshot_connectors = {
+    SlothConfig.SlothSnapshotFormat.XML: SlothConnector,
+    SlothConfig.SlothSnapshotFormat.BINARY: SlothBinaryConnector,
+}
@@ -0,0 +1,228 @@
+import os
+import pickle
+import hashlib
+from typing import Dict
+
+try:
+    from .sloth_log import sloth_log
+except:
+    from sloth_log import sloth_log
+
+# the version of the generated texts, the cache made by another version is ignored
+CACHE_VERSION = 3
+
+# the name of the cache file in the directory of the generated modules
+CACHE_FILENAME = ".sloth_cache"
+
+# the run id in the cached texts and in the names of the data files, replaced by the run id of the record
+RUN_ID_PLACEHOLDER = "__sloth_run_id__"
+
+
+def digest_of(data: bytes = b"") -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def file_digest(filename: str = "") -> bytes:
+
+    fp = hashlib.blake2b(digest_size=16)
+
+    with open(filename, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            fp.update(chunk)
+
+    return fp.digest()
+
+
+class SlothConvertCache:
+    """
+    The cache of the converter: the generated texts of each function record by the content hash of the record,
+    and the digests of the written data files
+
+    So the converter generates the tests only for the new or changed records, and the files with the same
+    content are not written again (their mtime is kept, and the caches of pytest stay valid)
+
+    The texts are cached with RUN_ID_PLACEHOLDER instead of the run id, and the data files by their names in
+    the data dir, so the same record of another (e.g. overlapping) snapshot is converted from the cache too:
+    its data files are copied from the ones written before
+
+    Only the records and the files used by the last conversion are kept in the saved cache
+
+    """
+
+    filename = None
+    base_dir = ""
+
+    # record key -> (test text, variables text, {data file (in the data dir): digest})
+    records = None
+    # data file (relative to base_dir) -> (digest, size, mtime_ns)
+    files = None
+    # digest -> data file with the content
+    digests = None
+
+    # the records and the files used by this conversion (to merge the caches of the worker processes)
+    used_records = None
+    used_files = None
+
+    def __init__(self, base_dir: str = "", filename: str = None):
+
+        self.base_dir = base_dir
+        self.filename = filename
+
+        self.records = {}
+        self.files = {}
+        self.digests = {}
+        self.used_records = {}
+        self.used_files = {}
+
+        if filename is None or not os.path.isfile(filename):
+            return
+
+        try:
+            with open(filename, 'rb') as fh:
+                data = pickle.load(fh)
+        except Exception as e:
+            sloth_log.warning("The conversion cache " + filename + " can't be read, it's ignored: " + str(e))
+            return
+
+        if data.get('version') == CACHE_VERSION:
+            self.records = data['records']
+            self.files = data['files']
+            self.digests = {state[0]: rel_path for rel_path, state in self.files.items()}
+
+    def load_entries(self, records: Dict = None, files: Dict = None):
+        # the entries of the cache, given to a worker process (see SlothTestConverter.shard_job)
+
+        self.records = records
+        self.files = files
+        self.digests = {state[0]: rel_path for rel_path, state in files.items()}
+
+    def file_states(self, data_files: Dict = None, data_dir_name: str = "", run_id: str = "") -> Dict:
+        # the states of the data files of the record, and of the files they can be copied from (see restore)
+
+        states = {}
+
+        for filename, digest in data_files.items():
+
+            rel_path = os.path.join(data_dir_name, filename.replace(RUN_ID_PLACEHOLDER, run_id))
+            if rel_path in self.files:
+                states[rel_path] = self.files[rel_path]
+
+            source = self.digests.get(digest)
+            if source is not None:
+                states[source] = self.files[source]
+
+        return states
+
+    @staticmethod
+    def record_key(func_dict: Dict = None, settings=None) -> bytes:
+        # the content hash of the record, and the settings the texts depend on
+        # (not pickled: the pickle of equal records depends on the shared objects in them)
+        return digest_of(repr((func_dict, settings)).encode())
+
+    def get(self, key: bytes = b"", data_dir_name: str = "", run_id: str = ""):
+        """
+        The generated texts of the record, if the record was converted before and all its data files are in place
+        (or can be copied from the files with the same content)
+
+        :param key: the key of the record
+        :param data_dir_name: the data dir of the snapshot (relative to base_dir)
+        :param run_id: the run id of the record
+        :return: (test text, variables text) or None
+        """
+
+        entry = self.records.get(key)
+        if entry is None:
+            return None
+
+        func_text, var_text, data_files = entry
+
+        for filename, digest in data_files.items():
+            if not self.restore(os.path.join(data_dir_name, filename.replace(RUN_ID_PLACEHOLDER, run_id)), digest):
+                return None
+
+        self.used_records[key] = entry
+
+        return func_text.replace(RUN_ID_PLACEHOLDER, run_id), var_text.replace(RUN_ID_PLACEHOLDER, run_id)
+
+    def put(self, key: bytes = b"", func_text: str = "", var_text: str = "", data_files: Dict = None):
+
+        self.records[key] = (func_text, var_text, data_files)
+        self.used_records[key] = self.records[key]
+
+    def restore(self, rel_path: str = "", digest: bytes = b"") -> bool:
+        # the data file is in place, or it's copied from another file with the same content
+
+        if self.is_fresh(rel_path, digest):
+            self.used_files[rel_path] = self.files[rel_path]
+            return True
+
+        source = self.digests.get(digest)
+        if source is None or not self.is_fresh(source, digest):
+            return False
+
+        with open(os.path.join(self.base_dir, source), 'rb') as fh:
+            self.write(rel_path, fh.read())
+
+        return True
+
+    def is_fresh(self, rel_path: str = "", digest: bytes = b"") -> bool:
+        # the file was written with this content, and it was not changed since that
+
+        state = self.files.get(rel_path)
+        if state is None or state[0] != digest:
+            return False
+
+        try:
+            stat = os.stat(os.path.join(self.base_dir, rel_path))
+        except OSError:
+            return False
+
+        return state[1:] == (stat.st_size, stat.st_mtime_ns)
+
+    def write(self, rel_path: str = "", data: bytes = b"") -> bytes:
+        """
+        Writing the data file, only if its content is changed
+
+        :param rel_path: the file, relative to the base dir
+        :param data: the content
+        :return: the digest of the content
+        """
+
+        digest = digest_of(data)
+
+        if self.is_fresh(rel_path, digest):
+            self.used_files[rel_path] = self.files[rel_path]
+            return digest
+
+        path = os.path.join(self.base_dir, rel_path)
+
+        if not (os.path.isfile(path) and os.path.getsize(path) == len(data) and file_digest(path) == digest):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as fh:
+                fh.write(data)
+
+        stat = os.stat(path)
+        self.files[rel_path] = (digest, stat.st_size, stat.st_mtime_ns)
+        self.used_files[rel_path] = self.files[rel_path]
+        self.digests[digest] = rel_path
+
+        return digest
+
+    def merge(self, records: Dict = None, files: Dict = None):
+        # the records and the files used by a worker process
+
+        self.used_records.update(records)
+        self.used_files.update(files)
+
+    def save(self):
+
+        if self.filename is None:
+            return
+
+        # the entries not used by this conversion are dropped, so the cache doesn't grow with each snapshot
+        data = {'version': CACHE_VERSION, 'records': self.used_records, 'files': self.used_files}
+
+        with open(self.filename + '.tmp', 'wb') as fh:
+            pickle.dump(data, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(self.filename + '.tmp', self.filename)
@@ -0,0 +1,104 @@
+import os
+import inspect
+import pickle
+from typing import List
+
+
+def get_full_scope(fn) -> str:
+    # build a full path to the method, relative to the current dir
+
+    def unique_path(shorter_dir: List = None, longer_dir: List = None) -> List:
+
+        sep = 0
+        for i in range(len(longer_dir)):
+            if i >= len(shorter_dir):
+                sep = i
+                break
+            if shorter_dir[i] != longer_dir[i]:
+                sep = i
+                break
+
+        return longer_dir[-(len(longer_dir) - sep):]
+
+    this_dir = os.getcwd()
+    remote_dir = os.path.normpath(inspect.getfile(fn)[:-3])
+
+    remote_dir_list = remote_dir.split(os.path.sep)
+    this_dir_list = this_dir.split(os.path.sep)
+
+    diff_dir = unique_path(this_dir_list, remote_dir_list)
+
+    return '.'.join(diff_dir)
+
+
+class SlothFunctionDescriptor:
+    """
+    The metadata of the watched function, computed once when the function is decorated
+    (the scope and the class of the function, its signature), instead of on every call
+
+    The value plan (if the value of the type is simple, and the pickled type) is built once per type
+
+    """
+
+    fn = None
+    key = ""
+    name = ""
+    module = ""
+    scope_name = ""
+    class_name = ""
+    signature = None
+    is_async = False
+
+    value_plans = None
+
+    # the types of values that are stored as is, without serialization
+    simple_types = (int, float, bool)
+
+    def __init__(self, fn=None):
+
+        self.fn = fn
+
+        self.name = fn.__name__
+        self.module = fn.__module__
+        self.key = fn.__module__ + '.' + fn.__qualname__
+
+        # check if the function is a class member
+        # if it's a class member, we need to dump a class instance
+        if fn.__qualname__.find(".") == -1:
+            self.class_name = ""
+        else:
+            self.class_name = fn.__qualname__.split(".")[0]
+
+        self.scope_name = get_full_scope(fn)
+        self.signature = inspect.signature(fn)
+
+        # a coroutine function (async def) is awaited by the watchme decorator
+        self.is_async = inspect.iscoroutinefunction(fn)
+
+        # type -> (is simple, pickled type)
+        self.value_plans = {}
+
+    def __str__(self):
+        return self.key
+
+    def bind(self, args: List = None, kwargs=None):
+        # bound income real arguments with the all possible arguments of the method
+
+        bound_args = self.signature.bind(*args, **kwargs)
+        bound_args.apply_defaults()
+
+        return bound_args.arguments
+
+    def value_plan(self, value_type=None) -> (bool, bytes):
+
+        plan = self.value_plans.get(value_type)
+
+        if plan is None:
+            plan = self.value_plan_of(value_type)
+            self.value_plans[value_type] = plan
+
+        return plan
+
+    @classmethod
+    def value_plan_of(cls, value_type=None) -> (bool, bytes):
+        return value_type in cls.simple_types, pickle.dumps(value_type)
@@ -0,0 +1,135 @@
+import sys
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+from . import SlothConfig
+
+
+def fingerprint(value) -> bytes:
+    """
+    A cheap fingerprint of the value, to find out that the same inputs were already captured
+
+    pandas and numpy objects are hashed by their data, builtin types and containers by their content,
+    anything else by its pickled bytes
+
+    :param value: the value (e.g. the bound arguments of the call)
+    :return: the fingerprint, or None if the value can't be fingerprinted
+    """
+
+    fp = hashlib.blake2b(digest_size=16)
+
+    try:
+        update_fingerprint(fp, value)
+    except Exception:
+        return None
+
+    return fp.digest()
+
+
+def update_fingerprint(fp, value):
+
+    value_type = type(value)
+
+    fp.update(value_type.__qualname__.encode())
+
+    if value is None or value_type in (int, float, bool, complex, str, bytes):
+        fp.update(repr(value).encode())
+
+    elif value_type in (list, tuple):
+        fp.update(str(len(value)).encode())
+        for item in value:
+            update_fingerprint(fp, item)
+
+    elif value_type is dict:
+        fp.update(str(len(value)).encode())
+        for key, item in value.items():
+            update_fingerprint(fp, key)
+            update_fingerprint(fp, item)
+
+    elif is_pandas_object(value):
+        # the data, the index and the labels of the columns
+        pd = sys.modules['pandas']
+        fp.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+        fp.update(repr(getattr(value, 'columns', getattr(value, 'name', None))).encode())
+        fp.update(str(getattr(value, 'dtypes', None)).encode())
+
+    elif is_numpy_array(value):
+        np = sys.modules['numpy']
+        fp.update(str(value.dtype).encode())
+        fp.update(str(value.shape).encode())
+        if value.dtype.hasobject:
+            fp.update(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        else:
+            fp.update(np.ascontiguousarray(value).data)
+
+    else:
+        fp.update(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def is_pandas_object(value) -> bool:
+    # pandas is not imported if the project doesn't use it
+
+    pd = sys.modules.get('pandas')
+
+    return pd is not None and isinstance(value, (pd.DataFrame, pd.Series))
+
+
+def is_numpy_array(value) -> bool:
+
+    np = sys.modules.get('numpy')
+
+    return np is not None and isinstance(value, np.ndarray)
+
+
+class SlothFingerprintCache:
+    """
+    A bounded (LRU) set of the fingerprints of inputs already captured for each function
+
+    The cache is shared by the threads of the watched methods, it's checked and updated under a lock
+
+    """
+
+    max_size = 0
+    fingerprints = None
+
+    skipped_counter = 0
+
+    lock = None
+
+    def __init__(self, max_size: int = None):
+
+        self.max_size = SlothConfig.FINGERPRINT_CACHE_SIZE if max_size is None else max_size
+        self.fingerprints = OrderedDict()
+
+        self.skipped_counter = 0
+
+        self.lock = threading.Lock()
+
+    def seen(self, fn_key: str = "", value=None) -> bool:
+        """
+        Checking if the value was already seen for the function, and remembering it if it wasn't
+
+        :param fn_key: the key of the function
+        :param value: the inputs of the call
+        :return: True, if the same inputs were already captured
+        """
+
+        fp = fingerprint(value)
+        if fp is None:
+            return False
+
+        key = (fn_key, fp)
+
+        with self.lock:
+
+            if key in self.fingerprints:
+                self.fingerprints.move_to_end(key)
+                self.skipped_counter += 1
+                return True
+
+            self.fingerprints[key] = None
+            if self.max_size and len(self.fingerprints) > self.max_size:
+                self.fingerprints.popitem(last=False)
+
+        return False
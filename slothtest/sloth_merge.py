@@ -0,0 +1,285 @@
+import os
+import re
+import json
+import codecs
+import hashlib
+import argparse
+import datetime
+import zipfile
+from typing import Dict, List
+from . import sloth_log
+from . import SlothConfig
+from .sloth_connector import snapshot_connectors
+from .sloth_xml_converter import SlothTestConverter
+
+# the name of the index in the merged snapshot (zip archive)
+INDEX_FILENAME = "index.json"
+
+
+class SlothSnapshotMerger:
+    """
+    Merging many snapshots into one compacted snapshot
+
+    The records are read by SlothTestConverter, and written by the connector of the chosen format:
+    - the identical captures (the same function, instance, arguments and results) are written only once
+    - each blob is written only once, the next occurrences refer to it by the hash
+    - the run ids are renumbered in the order of the snapshots (sorted by name) and of the records in them
+    - the empty or broken snapshots are skipped (e.g. the name claimed by a process that was killed before its dump)
+
+    The index of the merged snapshot (the sources with the new run ids of their records, and the run ids
+    of each function) is written to the same zip archive
+
+    """
+
+    snapshot_format = "0"
+    compression = None
+    compress_level = None
+
+    # the key of the capture -> its run id in the merged snapshot
+    captures = None
+
+    duplicates_counter = 0
+
+    def __init__(self, snapshot_format: str = None, compression: str = None, compress_level: int = None):
+
+        self.snapshot_format = SlothConfig.SNAPSHOT_FORMAT if snapshot_format is None else snapshot_format
+
+        # SlothCompression of the merged snapshot and its level (see SlothConfig.SNAPSHOT_COMPRESSION)
+        self.compression = compression
+        self.compress_level = compress_level
+
+        self.captures = {}
+        self.duplicates_counter = 0
+
+    def merge(self, filenames: List = None, to_dir: str = None, snapshot_id: str = None) -> str:
+        """
+        Merging the snapshots
+
+        :param filenames: the snapshots (zip archives) to merge
+        :param to_dir: the directory for the merged snapshot (current dir by default)
+        :param snapshot_id: the name of the merged snapshot (merged_<timestamp> by default)
+        :return: the filename of the merged snapshot
+        """
+
+        if not filenames:
+            sloth_log.error('Snapshots to merge were not defined')
+            raise Exception('Snapshots to merge were not defined')
+
+        if to_dir is None:
+            to_dir = os.getcwd()
+
+        if snapshot_id is None:
+            snapshot_id = "merged_" + str(datetime.datetime.now().replace(microsecond=0).timestamp())[:-2]
+
+        connector = snapshot_connectors[self.snapshot_format](snapshot_id, snapshot_id, to_dir,
+                                                              self.compression, self.compress_level)
+        converter = SlothTestConverter()
+
+        index = {
+            'snapshot': snapshot_id,
+            'sources': [],
+            'functions': {}
+        }
+
+        for filename in sorted(filenames, key=os.path.basename):
+
+            if not zipfile.is_zipfile(filename):
+                sloth_log.warning("Skipped the empty or broken snapshot: " + filename)
+                continue
+
+            sloth_log.info("Merging: " + filename)
+
+            source = {'snapshot': os.path.basename(filename)[:-4], 'records': 0, 'duplicates': 0, 'run_ids': {}}
+
+            for record in converter.read_records(filename):
+
+                record = self.compact_record(record)
+                key = self.capture_key(record)
+
+                source['records'] += 1
+
+                run_id = self.captures.get(key)
+
+                if run_id is None:
+                    connector.dump_data([record], close=False)
+
+                    run_id = connector.engage_counter
+                    self.captures[key] = run_id
+
+                    fn_key = '.'.join(filter(None, (record['function']['scope_name'],
+                                                    record['function']['class_name'],
+                                                    record['function']['function_name'])))
+                    index['functions'].setdefault(fn_key, []).append(run_id)
+                else:
+                    source['duplicates'] += 1
+                    self.duplicates_counter += 1
+
+                source['run_ids'][record['run_id']] = run_id
+
+            index['sources'].append(source)
+
+        zip_fn = connector.dump_data([], close=True)
+
+        index['records'] = connector.engage_counter
+        index['blobs'] = len(connector.written_blobs)
+        index['duplicates'] = self.duplicates_counter
+
+        with zipfile.ZipFile(zip_fn, 'a') as myzip:
+            myzip.writestr(INDEX_FILENAME, json.dumps(index, indent=1))
+
+        sloth_log.info("Merged " + str(len(filenames)) + " snapshots to " + zip_fn + ": " +
+                       str(index['records']) + " records, " + str(self.duplicates_counter) + " duplicates skipped")
+
+        return zip_fn
+
+    def merge_session(self, session_id: str = "", to_dir: str = None, snapshot_id: str = None) -> str:
+        """
+        Merging the snapshots of the session, with the shards written by its processes and the rotated ones
+
+        :param session_id: the session (the snapshot of its first process)
+        :param to_dir: the directory of the snapshots, and of the merged one (current dir by default)
+        :param snapshot_id: the name of the merged snapshot (merged_<session_id> by default)
+        :return: the filename of the merged snapshot
+        """
+
+        if to_dir is None:
+            to_dir = os.getcwd()
+
+        if snapshot_id is None:
+            snapshot_id = "merged_" + session_id
+
+        filenames = self.session_shards(session_id, to_dir)
+
+        if not filenames:
+            sloth_log.error('Snapshots of the session ' + session_id + ' were not found in ' + to_dir)
+            raise Exception('Snapshots of the session ' + session_id + ' were not found in ' + to_dir)
+
+        return self.merge(filenames, to_dir, snapshot_id)
+
+    @staticmethod
+    def session_shards(session_id: str = "", to_dir: str = "") -> List:
+        # the snapshots of the session: of its first process and the shards of the other ones, with the rotated ones
+        # (<session_id>.zip, <session_id>_0002.zip, <session_id>_w<pid>.zip, <session_id>_w<pid>_0002.zip, ...)
+
+        shard_name = re.compile(re.escape(session_id) + r"(_w\d+)?(_\d{4,})?\.zip")
+
+        filenames = [os.path.join(to_dir, filename) for filename in os.listdir(to_dir)
+                     if shard_name.fullmatch(filename)]
+
+        return sorted(filenames, key=os.path.basename)
+
+    @staticmethod
+    def raw_value(value) -> bytes:
+        # the values of xml snapshots are base64 text, the ones of binary snapshots are raw bytes
+
+        if isinstance(value, bytes):
+            return value
+
+        return codecs.decode(value.encode(), "base64")
+
+    def compact_record(self, record: Dict = None) -> Dict:
+        """
+        The record to write by the connector: the serialized values are raw bytes (so the record can be written
+        in any format), and each of them has the hash, so the connector writes it only once
+
+        :param record: the record read by SlothTestConverter.read_records
+        :return: the record
+        """
+
+        def blob(value) -> (bytes, str):
+
+            value = self.raw_value(value)
+            if not value:
+                return value, ""
+
+            return value, hashlib.blake2b(value, digest_size=16).hexdigest()
+
+        def var_dict(var: Dict = None) -> Dict:
+
+            simple = str(var.get('par_simple', True)) == 'True'
+
+            if simple:
+                value, ref = var.get('par_value', ""), ""
+            else:
+                value, ref = blob(var.get('par_value', ""))
+
+            return {
+                'par_type': self.raw_value(var.get('par_type', "")),
+                'par_name': var.get('par_name', ""),
+                'par_value': value,
+                'par_ref': var.get('par_ref', "") or ref,
+                'par_state': var.get('par_state', ""),
+                'par_simple': str(simple),
+                'additional_info': var.get('additional_info', ""),
+            }
+
+        function_dict = record['function']
+
+        class_dump, class_ref = blob(function_dict.get('class_dump', ""))
+
+        return {
+            'run_id': record.get('run_id', ""),
+            'function': {
+                'scope_name': function_dict.get('scope_name', ""),
+                'class_name': function_dict.get('class_name', ""),
+                'class_dump': class_dump,
+                'class_ref': function_dict.get('class_ref', "") or class_ref,
+                'function_name': function_dict.get('function_name', ""),
+                'is_async': str(function_dict.get('is_async', False)),
+                'run_time': function_dict.get('run_time', ""),
+                'timing': dict(function_dict.get('timing', {})),
+                'call_stack': function_dict.get('call_stack', ""),
+            },
+            'arguments': [var_dict(var) for var in record['arguments']],
+            'results': [var_dict(var) for var in record['results']]
+        }
+
+    @staticmethod
+    def capture_key(record: Dict = None) -> bytes:
+        # the identical captures have the same function, instance, arguments and results
+        # (the run time and the call stack are not compared)
+
+        def var_key(var: Dict = None) -> tuple:
+            return var['par_name'], var['par_type'], var['par_ref'] or var['par_value']
+
+        function_dict = record['function']
+
+        key = (
+            function_dict['scope_name'],
+            function_dict['class_name'],
+            function_dict['function_name'],
+            function_dict['class_ref'],
+            [var_key(var) for var in record['arguments']],
+            [var_key(var) for var in record['results']]
+        )
+
+        # (not pickled: the pickle of equal keys depends on the shared objects in them)
+        return hashlib.blake2b(repr(key).encode(), digest_size=16).digest()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Sloth Watcher snapshots merger')
+    parser.add_argument("filenames", nargs='*', help="Sloth's snapshots (zip archives) to merge")
+    parser.add_argument('-s', "--session", help="Merge the snapshot of the session with the shards of its processes",
+                        default=None)
+    parser.add_argument('-d', "--to_dir", help="The directory for the merged snapshot",
+                        default=os.getcwd())
+    parser.add_argument('-n', "--name", help="The name of the merged snapshot",
+                        default=None)
+    parser.add_argument('-b', "--binary", help="Write the merged snapshot in the binary format",
+                        action='store_true')
+    parser.add_argument('-c', "--compression", help="The compression of the merged snapshot: " +
+                        "0 - stored, 1 - deflate, 2 - bzip2, 3 - lzma", default=None)
+    parser.add_argument('-l', "--level", help="The compression level", type=int, default=None)
+
+    args = parser.parse_args()
+
+    snapshot_format = SlothConfig.SlothSnapshotFormat.BINARY if args.binary else None
+
+    merger = SlothSnapshotMerger(snapshot_format, args.compression, args.level)
+
+    if args.session is None:
+        merger.merge(args.filenames, args.to_dir, args.name)
+    else:
+        merger.merge_session(args.session, args.to_dir, args.name)
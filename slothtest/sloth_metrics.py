@@ -0,0 +1,315 @@
+import os
+import time
+import bisect
+import threading
+from typing import Dict, List
+from . import SlothConfig, sloth_log
+
+# the upper bounds of the buckets of the histograms: of the times (seconds) and of the sizes (bytes)
+SECONDS_BUCKETS = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)
+BYTES_BUCKETS = (1 << 10, 1 << 14, 1 << 17, 1 << 20, 1 << 24, 1 << 27, 1 << 30)
+
+
+class SlothHistogram:
+    """
+    A histogram with fixed buckets, each bucket counts the values less or equal to its bound (as in Prometheus)
+
+    """
+
+    bounds = ()
+    counts = None
+    count = 0
+    total = 0
+
+    def __init__(self, bounds: tuple = SECONDS_BUCKETS):
+
+        self.bounds = bounds
+        # the last one is for the values over all the bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+
+    def observe(self, value=0):
+
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def as_dict(self) -> Dict:
+        # the cumulative counts of the buckets, by their bounds
+
+        buckets = {}
+        cumulative = 0
+
+        for bound, count in zip(self.bounds + ('+Inf', ), self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+
+        return {'count': self.count, 'sum': self.total, 'buckets': buckets}
+
+
+class SlothMetrics:
+    """
+    The runtime metrics of the watcher, since it was created:
+
+    - the captured calls of each function, and their rate over the reporting window (since the last report)
+    - the serialized values of each type: the amount, the bytes, and the histogram of the serialization times
+    - the dumps of the snapshots: the histogram of the times of writing, and the histogram of the sizes of the
+      written snapshots (zip archives)
+
+    The metrics are updated by the threads of the watched methods and of the background workers, under a lock
+    (a few additions per captured value). The gauges (the depth of the queues, the dropped and sampled out calls)
+    are kept by the watcher, and added to the stats when they're taken (see SlothWatcher.stats)
+
+    The stats can be reported periodically (SlothConfig.METRICS_INTERVAL): to sloth_log (SlothConfig.METRICS_LOG),
+    and to a file in the Prometheus text format (SlothConfig.METRICS_FILE)
+
+    """
+
+    started = 0.0
+    last_report = 0.0
+
+    # the start of the reporting window, and the amounts of the captured calls at its start
+    window_started = 0.0
+    window_captures = None
+
+    # function key -> the amount of the captured calls
+    captures = None
+    # type name -> [the amount of the values, bytes, SlothHistogram of the times]
+    serialization = None
+
+    dump_seconds = None
+    dump_bytes = None
+    dumped_records = 0
+
+    # the counters of the finished watchings (the samplers and the fingerprint caches are made by each start)
+    retired = None
+
+    lock = None
+
+    def __init__(self):
+
+        self.started = time.monotonic()
+        self.last_report = self.started
+
+        self.window_started = self.started
+        self.window_captures = {}
+
+        self.captures = {}
+        self.serialization = {}
+
+        self.dump_seconds = SlothHistogram(SECONDS_BUCKETS)
+        self.dump_bytes = SlothHistogram(BYTES_BUCKETS)
+        self.dumped_records = 0
+
+        self.retired = {'sampled_out': 0, 'dedup_skipped': 0}
+
+        self.lock = threading.Lock()
+
+    def count_capture(self, fn_key: str = ""):
+
+        with self.lock:
+            self.captures[fn_key] = self.captures.get(fn_key, 0) + 1
+
+    def observe_serialization(self, type_name: str = "", seconds: float = 0.0, size: int = 0):
+
+        with self.lock:
+
+            value_stats = self.serialization.get(type_name)
+            if value_stats is None:
+                value_stats = [0, 0, SlothHistogram(SECONDS_BUCKETS)]
+                self.serialization[type_name] = value_stats
+
+            value_stats[0] += 1
+            value_stats[1] += size
+            value_stats[2].observe(seconds)
+
+    def observe_dump(self, seconds: float = 0.0, records: int = 0, size: int = None):
+        # size - the size of the closed snapshot (None if the records were appended to the open one)
+
+        with self.lock:
+
+            self.dump_seconds.observe(seconds)
+            self.dumped_records += records
+
+            if size is not None:
+                self.dump_bytes.observe(size)
+
+    def retire(self, counter: str = "", value: int = 0):
+        # keeping the counter of the sampler (or of the fingerprint cache) replaced by the next watching
+
+        with self.lock:
+            self.retired[counter] += value
+
+    def stats(self, gauges: Dict = None) -> Dict:
+        """
+        The snapshot of the metrics
+
+        :param gauges: the current values kept by the watcher (added to the stats as is)
+        :return: the stats
+        """
+
+        with self.lock:
+
+            now = time.monotonic()
+            window = now - self.window_started
+
+            stats = {
+                'uptime_seconds': now - self.started,
+                'window_seconds': window,
+                'captures': {fn_key: {'count': count,
+                                      'per_second': (count - self.window_captures.get(fn_key, 0)) / window
+                                      if window else 0.0}
+                             for fn_key, count in self.captures.items()},
+                'captures_total': sum(self.captures.values()),
+                'serialization': {type_name: {'count': count, 'bytes': size, 'seconds': seconds.as_dict()}
+                                  for type_name, (count, size, seconds) in self.serialization.items()},
+                'dumps': {'records': self.dumped_records,
+                          'seconds': self.dump_seconds.as_dict(),
+                          'bytes': self.dump_bytes.as_dict()},
+            }
+
+        stats.update(gauges or {})
+
+        return stats
+
+    def report_due(self) -> bool:
+        # the time of the periodic report came (it's taken by one thread only)
+
+        if not SlothConfig.METRICS_INTERVAL or not (SlothConfig.METRICS_LOG or SlothConfig.METRICS_FILE):
+            return False
+
+        now = time.monotonic()
+
+        with self.lock:
+            if now - self.last_report < SlothConfig.METRICS_INTERVAL:
+                return False
+            self.last_report = now
+
+        return True
+
+    def report(self, stats: Dict = None):
+        # the periodic report: a summary to the log, and the stats to the Prometheus text file. The next reporting
+        # window starts at the time of these stats
+
+        if SlothConfig.METRICS_LOG:
+            sloth_log.info(self.summary_text(stats))
+
+        if SlothConfig.METRICS_FILE:
+            try:
+                with open(SlothConfig.METRICS_FILE + '.tmp', 'w') as fh:
+                    fh.write(self.prometheus_text(stats))
+                os.replace(SlothConfig.METRICS_FILE + '.tmp', SlothConfig.METRICS_FILE)
+            except OSError as e:
+                sloth_log.error("The metrics were not written to " + SlothConfig.METRICS_FILE + ". Error: " + str(e))
+
+        with self.lock:
+            self.window_started += stats['window_seconds']
+            self.window_captures = {fn_key: fn_stats['count'] for fn_key, fn_stats in stats['captures'].items()}
+
+    @staticmethod
+    def summary_text(stats: Dict = None) -> str:
+
+        serialized_count = sum(value_stats['count'] for value_stats in stats['serialization'].values())
+        serialized_bytes = sum(value_stats['bytes'] for value_stats in stats['serialization'].values())
+        serialized_seconds = sum(value_stats['seconds']['sum'] for value_stats in stats['serialization'].values())
+
+        return "Sloth stats: " + \
+               str(stats['captures_total']) + " captures (" + \
+               "{:.1f}".format(sum(fn_stats['per_second'] for fn_stats in stats['captures'].values())) + \
+               "/s), " + \
+               str(serialized_count) + " values serialized (" + "{:.1f}".format(serialized_bytes / 1e6) + " MB in " + \
+               "{:.3f}".format(serialized_seconds) + " s), " + \
+               str(stats['dumps']['seconds']['count']) + " dumps (" + \
+               "{:.3f}".format(stats['dumps']['seconds']['sum']) + " s, " + \
+               "{:.1f}".format(stats['dumps']['bytes']['sum'] / 1e6) + " MB), " + \
+               "queue " + str(stats['queue_depth']['capture']) + ", " + \
+               "dropped " + str(sum(stats['dropped'].values())) + ", " + \
+               "sampled out " + str(stats['sampled_out'])
+
+    @staticmethod
+    def prometheus_text(stats: Dict = None) -> str:
+        """
+        The stats in the Prometheus text format (e.g. for the textfile collector of node_exporter)
+
+        :param stats: the stats (see stats)
+        :return: the text
+        """
+
+        lines = []
+
+        def label(value) -> str:
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        def metric(name: str = "", metric_type: str = "", help_text: str = "", samples: List = None):
+            # samples: (labels, value)
+
+            lines.append("# HELP " + name + " " + help_text)
+            lines.append("# TYPE " + name + " " + metric_type)
+
+            for labels, value in samples:
+                labels_text = ",".join(key + '="' + label(label_value) + '"' for key, label_value in labels.items())
+                lines.append(name + ("{" + labels_text + "}" if labels_text else "") + " " + repr(value))
+
+        def histogram_samples(name: str = "", histograms: List = None) -> None:
+            # histograms: (labels, the histogram as dict)
+
+            for labels, histogram in histograms:
+                for bound, count in histogram['buckets'].items():
+                    lines.append(name + "_bucket{" + ",".join(
+                        [key + '="' + label(value) + '"' for key, value in labels.items()] + ['le="' + bound + '"']) +
+                        "} " + str(count))
+
+                labels_text = ",".join(key + '="' + label(value) + '"' for key, value in labels.items())
+                labels_text = "{" + labels_text + "}" if labels_text else ""
+
+                lines.append(name + "_sum" + labels_text + " " + repr(histogram['sum']))
+                lines.append(name + "_count" + labels_text + " " + str(histogram['count']))
+
+        metric("sloth_captures_total", "counter", "The captured calls of the watched functions",
+               [({'function': fn_key}, fn_stats['count']) for fn_key, fn_stats in stats['captures'].items()])
+
+        metric("sloth_serialized_values_total", "counter", "The serialized values",
+               [({'type': type_name}, value_stats['count'])
+                for type_name, value_stats in stats['serialization'].items()])
+
+        metric("sloth_serialized_bytes_total", "counter", "The size of the serialized values",
+               [({'type': type_name}, value_stats['bytes'])
+                for type_name, value_stats in stats['serialization'].items()])
+
+        lines.append("# HELP sloth_serialize_seconds The time of the serialization of the values")
+        lines.append("# TYPE sloth_serialize_seconds histogram")
+        histogram_samples("sloth_serialize_seconds",
+                          [({'type': type_name}, value_stats['seconds'])
+                           for type_name, value_stats in stats['serialization'].items()])
+
+        lines.append("# HELP sloth_dump_seconds The time of writing the records to the snapshot")
+        lines.append("# TYPE sloth_dump_seconds histogram")
+        histogram_samples("sloth_dump_seconds", [({}, stats['dumps']['seconds'])])
+
+        lines.append("# HELP sloth_snapshot_bytes The size of the written snapshots")
+        lines.append("# TYPE sloth_snapshot_bytes histogram")
+        histogram_samples("sloth_snapshot_bytes", [({}, stats['dumps']['bytes'])])
+
+        metric("sloth_dumped_records_total", "counter", "The records written to the snapshots",
+               [({}, stats['dumps']['records'])])
+
+        metric("sloth_queue_depth", "gauge", "The records waiting in the queues of the background workers",
+               [({'queue': queue_name}, depth) for queue_name, depth in stats['queue_depth'].items()])
+
+        metric("sloth_buffered_records", "gauge", "The records captured for the open snapshot",
+               [({}, stats['buffered']['records'])])
+
+        metric("sloth_buffered_bytes", "gauge", "The size of the values captured for the open snapshot",
+               [({}, stats['buffered']['bytes'])])
+
+        metric("sloth_dropped_total", "counter", "The captures dropped by the full queue or evicted from the buffer",
+               [({'reason': reason}, count) for reason, count in stats['dropped'].items()])
+
+        metric("sloth_sampled_out_total", "counter", "The calls not captured by the sampling",
+               [({}, stats['sampled_out'])])
+
+        metric("sloth_dedup_skipped_total", "counter", "The calls not captured as their inputs were captured before",
+               [({}, stats['dedup_skipped'])])
+
+        return "\n".join(lines) + "\n"
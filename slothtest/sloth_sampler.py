@@ -0,0 +1,152 @@
+import random
+import time
+import threading
+from typing import Dict, List
+from . import SlothConfig
+
+
+class SlothSampler:
+    """
+    Sampling of the watched calls, the decision is made before the arguments are copied and serialized
+
+    sample_rate - a fixed share of calls to capture (1.0 - all of them)
+    rate_limit - a max amount of captures per second for each function (0 - no limit)
+    reservoir - a size of the reservoir for each function (0 - no reservoir): a uniform random sample of N calls
+        of the snapshot, the captured records are kept in the reservoir until the snapshot is dumped
+
+    The sampler is shared by the threads of the watched methods, its state is changed under a lock
+
+    The policies can be combined: a call is captured only if it passes all of them
+
+    """
+
+    sample_rate = 1.0
+    rate_limit = 0
+    reservoir = 0
+
+    buckets = None
+    seen_counters = None
+    reservoirs = None
+    filling = None
+    free_slots = None
+
+    sampled_out_counter = 0
+
+    lock = None
+
+    def __init__(self, sample_rate: float = None, rate_limit: float = None, reservoir: int = None):
+
+        self.sample_rate = SlothConfig.SAMPLE_RATE if sample_rate is None else sample_rate
+        self.rate_limit = SlothConfig.SAMPLE_RATE_LIMIT if rate_limit is None else rate_limit
+        self.reservoir = SlothConfig.SAMPLE_RESERVOIR if reservoir is None else reservoir
+
+        # fn_key -> (tokens, last refill time) of the rate limit
+        self.buckets = {}
+        # fn_key -> amount of calls offered to the reservoir
+        self.seen_counters = {}
+        # fn_key -> {slot: record} of the reservoir (the records are kept in the slots of their sampling,
+        # whatever the order they come in)
+        self.reservoirs = {}
+        # fn_key -> the slots given to the calls while the reservoir is filled, until their records are kept,
+        # and the slots given back by the calls that were not captured (see cancel)
+        self.filling = {}
+        self.free_slots = {}
+
+        self.sampled_out_counter = 0
+
+        self.lock = threading.Lock()
+
+    def sample(self, fn_key: str = "", sample_rate: float = None, rate_limit: float = None,
+               reservoir: int = None) -> (bool, int):
+        """
+        Making the decision if the call should be captured. The policies of the function (if any) override
+        the policies of the sampler
+
+        :return: the call should be captured, the slot of the reservoir for the record (None - no reservoir)
+        """
+
+        sample_rate = self.sample_rate if sample_rate is None else sample_rate
+        rate_limit = self.rate_limit if rate_limit is None else rate_limit
+        reservoir = self.reservoir if reservoir is None else reservoir
+
+        if sample_rate < 1.0 and random.random() >= sample_rate:
+            with self.lock:
+                self.sampled_out_counter += 1
+            return False, None
+
+        with self.lock:
+
+            if rate_limit and not self.take_token(fn_key, rate_limit):
+                self.sampled_out_counter += 1
+                return False, None
+
+            if not reservoir:
+                return True, None
+
+            seen = self.seen_counters.get(fn_key, 0) + 1
+            self.seen_counters[fn_key] = seen
+
+            if seen <= reservoir:
+                free_slots = self.free_slots.get(fn_key)
+                slot = free_slots.pop() if free_slots else seen - 1
+                self.filling.setdefault(fn_key, set()).add(slot)
+                return True, slot
+
+            slot = random.randrange(seen)
+            if slot < reservoir:
+                # the record replaces the one in the slot
+                self.sampled_out_counter += 1
+                return True, slot
+
+            self.sampled_out_counter += 1
+            return False, None
+
+    def take_token(self, fn_key: str = "", rate_limit: float = 0) -> bool:
+        # a token bucket of the function: refilled with rate_limit tokens per second, up to rate_limit tokens
+        # (at least one, so a limit below one capture per second still captures)
+
+        now = time.monotonic()
+        capacity = max(1, rate_limit)
+
+        tokens, last_time = self.buckets.get(fn_key, (capacity, now))
+        tokens = min(capacity, tokens + (now - last_time) * rate_limit)
+
+        if tokens < 1:
+            self.buckets[fn_key] = (tokens, now)
+            return False
+
+        self.buckets[fn_key] = (tokens - 1, now)
+        return True
+
+    def keep(self, fn_key: str = "", slot: int = 0, record: Dict = None):
+        # put the record to the slot of the function's reservoir
+
+        with self.lock:
+            self.reservoirs.setdefault(fn_key, {})[slot] = record
+            self.filling.get(fn_key, set()).discard(slot)
+
+    def cancel(self, fn_key: str = "", slot: int = 0):
+        # the call got the slot, but it's not captured (e.g. its inputs were captured before):
+        # it's not counted as offered to the reservoir, and the empty slot is given to the next call
+
+        with self.lock:
+            if self.seen_counters.get(fn_key, 0) > 0:
+                self.seen_counters[fn_key] -= 1
+
+            filling = self.filling.get(fn_key)
+            if filling and slot in filling:
+                filling.discard(slot)
+                self.free_slots.setdefault(fn_key, []).append(slot)
+
+    def release(self) -> List:
+        # get all the records of the reservoirs (when the snapshot is dumped), and start the new ones
+
+        with self.lock:
+            records = [fn_records[slot] for fn_records in self.reservoirs.values() for slot in sorted(fn_records)]
+
+            self.reservoirs = {}
+            self.seen_counters = {}
+            self.filling = {}
+            self.free_slots = {}
+
+        return records
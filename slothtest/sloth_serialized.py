@@ -0,0 +1,60 @@
+import sys
+from . import SlothConfig
+from .sloth_fingerprint import is_pandas_object
+
+
+class SlothSerializedValue:
+    """
+    A value serialized once when the watched method is called (SlothCopyMode.SERIALIZE),
+    instead of the deep copy of it. The watcher stores the bytes as is, without serializing the value again
+
+    """
+
+    value_type = None
+    data = b""
+
+    def __init__(self, value_type=None, data: bytes = b""):
+
+        self.value_type = value_type
+        self.data = data
+
+
+# the types of values that can't be changed by the watched method, so they are not copied
+immutable_types = (int, float, bool, complex, str, bytes, type(None))
+
+
+def pandas_copy_on_write() -> bool:
+    # with copy-on-write of pandas, a shallow copy is a lazy one: the data is copied only if it's changed
+
+    pd = sys.modules.get('pandas')
+    if pd is None:
+        return False
+
+    if int(pd.__version__.split('.')[0]) >= 3:
+        return True
+
+    return bool(getattr(pd.options.mode, 'copy_on_write', False) is True)
+
+
+def snapshot_value(value=None, serialize=None):
+    """
+    Making a snapshot of the income value in SlothCopyMode.SERIALIZE mode
+
+    immutable values are not copied at all,
+    pandas objects are copied lazily if pandas copy-on-write is on (and serialized by the watcher later),
+    anything else is serialized once
+
+    :param value: the value to snapshot
+    :param serialize: the serializer of the value, returns bytes
+    :return: the value, its lazy copy or SlothSerializedValue
+    """
+
+    value_type = type(value)
+
+    if value_type in immutable_types:
+        return value
+
+    if SlothConfig.CAPTURE_COPY_ON_WRITE and is_pandas_object(value) and pandas_copy_on_write():
+        return value.copy(deep=False)
+
+    return SlothSerializedValue(value_type, serialize(value))
@@ -0,0 +1,196 @@
+from collections import deque
+from typing import Dict
+from . import SlothConfig, sloth_log
+
+
+class SlothCaptureStore:
+    """
+    A bounded buffer of the watched records, between two dumps of the snapshot
+
+    The buffer is limited by the amount of records (max_records) and by the size of the serialized values
+    (max_bytes), 0 means no limit. When the limit is reached, a record is evicted according to the policy:
+
+    DROP_OLDEST - the oldest record of the buffer is evicted
+    DROP_NEWEST - the incoming record is not stored
+    FAIR_SHARE - the oldest record of the function with the most records in the buffer is evicted
+
+    The evicted records are counted in dropped_counter
+
+    The size of the buffer is the size of the values it keeps in memory: a blob shared by many records
+    (the same ref, see SlothWatcher.dump_blob) is counted once, while any of the records refers to it
+
+    """
+
+    max_records = 0
+    max_bytes = 0
+    eviction_policy = None
+
+    records = None
+    functions = None
+    blobs = None
+    size_bytes = 0
+    seq = 0
+
+    dropped_counter = 0
+
+    def __init__(self, max_records: int = None, max_bytes: int = None, eviction_policy: str = None):
+
+        self.max_records = SlothConfig.STORE_MAX_RECORDS if max_records is None else max_records
+        self.max_bytes = SlothConfig.STORE_MAX_BYTES if max_bytes is None else max_bytes
+        self.eviction_policy = SlothConfig.STORE_EVICTION_POLICY if eviction_policy is None else eviction_policy
+
+        # (seq, record), from the oldest to the newest one
+        self.records = deque()
+        # function key -> seqs of its records, from the oldest to the newest one
+        self.functions = {}
+        # blob ref -> [amount of the records referring to it, size of the blob]
+        self.blobs = {}
+
+        self.size_bytes = 0
+        self.seq = 0
+        self.dropped_counter = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        for seq, record in self.records:
+            yield record
+
+    def __getitem__(self, index: int) -> Dict:
+        return self.records[index][1]
+
+    def append(self, record: Dict = None) -> bool:
+        """
+        Adding the record to the buffer, evicting the records over the limits
+
+        :param record: watched record (function, arguments, results)
+        :return: False, if the record itself was dropped
+        """
+
+        if self.eviction_policy == SlothConfig.SlothEvictionPolicy.DROP_NEWEST and \
+                self.is_full(1, self.added_size(record)):
+            self.dropped_counter += 1
+            sloth_log.debug("Capture buffer is full, record dropped")
+            return False
+
+        self.seq += 1
+        self.records.append((self.seq, record))
+        self.functions.setdefault(self.function_key(record), deque()).append(self.seq)
+        self.size_bytes += self.charge(record, 1)
+
+        while len(self.records) > 1 and self.is_full():
+            self.evict()
+
+        # the newest record is the last one, if it's not evicted
+        return self.records[-1][0] == self.seq
+
+    def is_full(self, extra_records: int = 0, extra_bytes: int = 0) -> bool:
+        # check if the buffer is over the limits, with the incoming records (if any)
+
+        if self.max_records and len(self.records) + extra_records > self.max_records:
+            return True
+
+        if self.max_bytes and self.size_bytes + extra_bytes > self.max_bytes:
+            return True
+
+        return False
+
+    def evict(self):
+
+        if self.eviction_policy == SlothConfig.SlothEvictionPolicy.FAIR_SHARE:
+            fn_key = max(self.functions, key=lambda k: len(self.functions[k]))
+            seq = self.functions[fn_key][0]
+
+            index = next(i for i, (record_seq, record) in enumerate(self.records) if record_seq == seq)
+            record = self.records[index][1]
+            del self.records[index]
+        else:
+            seq, record = self.records.popleft()
+
+        fn_key = self.function_key(record)
+        self.functions[fn_key].remove(seq)
+        if not self.functions[fn_key]:
+            del self.functions[fn_key]
+
+        self.size_bytes -= self.charge(record, -1)
+        self.dropped_counter += 1
+
+        sloth_log.debug("Capture buffer is full, record evicted")
+
+    def clear(self):
+        # the records are written to the snapshot and not needed in memory anymore
+
+        self.records.clear()
+        self.functions.clear()
+        self.blobs.clear()
+        self.size_bytes = 0
+
+    @staticmethod
+    def function_key(record: Dict = None) -> str:
+
+        function_dict = record['function']
+
+        return function_dict['scope_name'] + ':' + function_dict['class_name'] + '.' + function_dict['function_name']
+
+    def added_size(self, record: Dict = None) -> int:
+        # the size the record would add to the buffer: its values, except the blobs already kept
+
+        size = 0
+        for ref, value in self.record_values(record):
+            if not ref or ref not in self.blobs:
+                size += len(value)
+
+        return size
+
+    def charge(self, record: Dict = None, sign: int = 1) -> int:
+        """
+        Counting the references of the record to the blobs, when it's added (sign 1) or removed (sign -1)
+
+        :return: the size added to (or released from) the buffer
+        """
+
+        size = 0
+
+        for ref, value in self.record_values(record):
+
+            if not ref:
+                size += len(value)
+                continue
+
+            blob = self.blobs.get(ref)
+
+            if sign > 0:
+                if blob is None:
+                    self.blobs[ref] = [1, len(value)]
+                    size += len(value)
+                else:
+                    blob[0] += 1
+            else:
+                blob[0] -= 1
+                if not blob[0]:
+                    del self.blobs[ref]
+                    size += blob[1]
+
+        return size
+
+    @staticmethod
+    def record_values(record: Dict = None):
+        # (ref, serialized value) of the record, the ref is empty for the values that are not shared
+
+        function_dict = record['function']
+        yield function_dict.get('class_ref', ""), function_dict.get('class_dump', "")
+
+        for var_dict in record['arguments'] + record['results']:
+            yield var_dict.get('par_ref', ""), var_dict['par_value']
+
+    @staticmethod
+    def record_size(record: Dict = None) -> int:
+        # the size of the serialized values of the record
+
+        size = len(record['function'].get('class_dump', ""))
+
+        for var_dict in record['arguments'] + record['results']:
+            size += len(var_dict['par_value'])
+
+        return size
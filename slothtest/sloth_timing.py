@@ -0,0 +1,26 @@
+import time
+from typing import Dict
+
+
+def start_timer() -> tuple:
+    # the monotonic wall-clock time, the CPU time of the process and of the thread at the start of the call (ns)
+    return time.perf_counter_ns(), time.process_time_ns(), time.thread_time_ns()
+
+
+def stop_timer(started: tuple = None) -> Dict:
+    """
+    The timing of the call, started by start_timer
+
+    :param started: the times at the start of the call
+    :return: the wall-clock time, the CPU time of the process and of the thread spent by the call (ns)
+    """
+
+    thread_ns = time.thread_time_ns()
+    process_ns = time.process_time_ns()
+    wall_ns = time.perf_counter_ns()
+
+    return {
+        'wall_ns': wall_ns - started[0],
+        'process_ns': process_ns - started[1],
+        'thread_ns': thread_ns - started[2]
+    }
@@ -1,53 +1,289 @@
 import os
+import sys
+import time
+import threading
 import datetime
-import inspect
-import pickle
-import codecs
+import hashlib
 import joblib
 import io
 import asyncio
+import itertools
+import multiprocessing.util
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
-from . import SlothConnector, sloth_log
+from copy import deepcopy
+from . import sloth_log, snapshot_connectors, zip_compression
 from . import SlothConfig
+from . import SlothWorker
+from . import SlothCaptureStore
+from . import SlothSampler
+from . import SlothFingerprintCache
+from . import SlothFunctionDescriptor
+from . import SlothSerializedValue
+from . import SlothMetrics
+from .sloth_serialized import snapshot_value
+from .sloth_columnar import is_columnar_type, dump_columnar
 
 
 class SlothWatcher:
+    """
+    The watcher of the calls of the decorated methods
+
+    Each thread keeps its records in its own buffer (appended without a lock), and they are collected to the
+    buffer of the snapshot, in the order of the calls, when it's dumped or read (see collect_records).
+    If the buffer of the snapshot is bounded (SlothConfig.STORE_*), each record is collected as it's captured,
+    so the limits bound the memory
+
+    Each process writes its own snapshot: the first process of the session writes <session_id>.zip, and the
+    processes started (or forked) by it write the shards of the session, <session_id>_w<pid>.zip
+    (see SlothSnapshotMerger.merge_session). The name of the snapshot is claimed by creating its file,
+    so the snapshots of the processes and of the sessions started in the same second are not overwritten
+
+    The snapshot is rotated by the amount of calls, the size of the captured values or the time (see is_full),
+    the next snapshots of the process are numbered: <session_id>_0002.zip, <session_id>_0003.zip, ...
+
+    """
+
     sloth_state = None
 
     instance_id = ""
     snapshot_id = ""
     session_id = ""
 
+    # the name of the snapshots of this process, and the number of the current one
+    snapshot_base = ""
+    snapshot_seq = 0
+    snapshot_started = 0.0
+
     service_online = False
     sloth_connector = None
 
-    data_watch_dump = []
+    capture_store = None
+    blob_index = None
+    stack_index = None
+
+    # the buffers of the threads: (thread, records, [captured bytes]), each record is (seq, record)
+    # (the captured bytes of the thread are only added by the thread itself)
+    thread_buffers = None
+    capture_seq = None
+    records_lock = None
+    dump_lock = None
+
+    collected_counter = 0
+    # the captured bytes of the finished threads, and the captured bytes at the last dump
+    retired_bytes = 0
+    dumped_bytes = 0
+    dropped_counter = 0
 
-    dump_counter = 0
+    # the connectors of the parent process, inherited by fork (they must not be closed by the child)
+    detached_connectors = None
 
     to_dir = None
 
+    capture_mode = SlothConfig.CAPTURE_MODE
+    snapshot_format = SlothConfig.SNAPSHOT_FORMAT
+    compression = SlothConfig.SNAPSHOT_COMPRESSION
+    compress_level = SlothConfig.SNAPSHOT_COMPRESS_LEVEL
+    copy_mode = SlothConfig.CAPTURE_COPY
+    sloth_worker = None
+    sloth_writer = None
+    sloth_executor = None
+    sloth_sampler = None
+    sloth_fingerprints = None
+    sloth_metrics = None
+    descriptors = None
+    local_buffers = None
+
     def __init__(self):
 
         self.instance_id = str(os.environ.get('SLOTH_INSTANCE_ID', ""))
 
-    def start(self, to_dir: str = None):
+        self.capture_store = SlothCaptureStore()
+        self.blob_index = {}
+        self.stack_index = {}
+        self.descriptors = {}
+        self.local_buffers = threading.local()
+
+        self.thread_buffers = []
+        self.capture_seq = itertools.count()
+        self.records_lock = threading.Lock()
+        self.dump_lock = threading.RLock()
+
+        self.detached_connectors = []
+
+        self.sloth_metrics = SlothMetrics()
+
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.after_fork)
+
+        # the children of multiprocessing exit without the atexit handlers
+        multiprocessing.util.register_after_fork(self, SlothWatcher.finalize_in_child)
+
+    @property
+    def data_watch_dump(self) -> SlothCaptureStore:
+        # the buffer of the snapshot, with the records of all the threads
+
+        self.collect_records()
+
+        return self.capture_store
+
+    @property
+    def dump_counter(self) -> int:
+        # the records captured since the last dump: collected to the buffer and still in the buffers of the threads
+        return self.collected_counter + sum(len(records) for thread, records, totals in self.thread_buffers)
+
+    @property
+    def dump_bytes(self) -> int:
+        # the size of the serialized values captured since the last dump
+        return self.captured_bytes() - self.dumped_bytes
+
+    def captured_bytes(self) -> int:
+        return self.retired_bytes + sum(totals[0] for thread, records, totals in self.thread_buffers)
+
+    def start(self, to_dir: str = None, capture_mode: str = None, snapshot_format: str = None,
+              sample_rate: float = None, rate_limit: float = None, reservoir: int = None,
+              dedup_inputs: bool = None, copy_mode: str = None, compression: str = None, compress_level: int = None):
+        """
+        Starting the watching
+
+        :param to_dir: the directory for the snapshots (current dir by default)
+        :param capture_mode: SlothCaptureMode (SlothConfig.CAPTURE_MODE by default)
+        :param snapshot_format: SlothSnapshotFormat (SlothConfig.SNAPSHOT_FORMAT by default)
+        :param sample_rate: a share of calls to capture (SlothConfig.SAMPLE_RATE by default)
+        :param rate_limit: a max amount of captures per second for each function (SlothConfig.SAMPLE_RATE_LIMIT)
+        :param reservoir: a size of the reservoir sample for each function (SlothConfig.SAMPLE_RESERVOIR)
+        :param dedup_inputs: skip the calls with inputs already captured (SlothConfig.FINGERPRINT_DEDUP)
+        :param copy_mode: SlothCopyMode (SlothConfig.CAPTURE_COPY by default)
+        :param compression: SlothCompression of the snapshots (SlothConfig.SNAPSHOT_COMPRESSION by default)
+        :param compress_level: the level of the codec (SlothConfig.SNAPSHOT_COMPRESS_LEVEL by default)
+        :return: None
+        """
 
         self.to_dir = to_dir
 
-        self.session_id = str(datetime.datetime.now().replace(microsecond=0).timestamp())[:-2]
+        if capture_mode is None:
+            capture_mode = SlothConfig.CAPTURE_MODE
+        self.capture_mode = capture_mode
+
+        if snapshot_format is None:
+            snapshot_format = SlothConfig.SNAPSHOT_FORMAT
+        self.snapshot_format = snapshot_format
+
+        if compression is None:
+            compression = SlothConfig.SNAPSHOT_COMPRESSION
+        if compress_level is None:
+            compress_level = SlothConfig.SNAPSHOT_COMPRESS_LEVEL
+
+        # the wrong settings fail on start, not on the first dump
+        zip_compression(compression, compress_level)
+
+        self.compression = compression
+        self.compress_level = compress_level
+
+        if copy_mode is None:
+            copy_mode = SlothConfig.CAPTURE_COPY
+        self.copy_mode = copy_mode
+
+        self.start_workers()
+
+        # the counters of the previous watching are kept in the metrics
+        if self.sloth_sampler is not None:
+            self.sloth_metrics.retire('sampled_out', self.sloth_sampler.sampled_out_counter)
+        if self.sloth_fingerprints is not None:
+            self.sloth_metrics.retire('dedup_skipped', self.sloth_fingerprints.skipped_counter)
+
+        self.sloth_sampler = SlothSampler(sample_rate, rate_limit, reservoir)
 
+        if dedup_inputs is None:
+            dedup_inputs = SlothConfig.FINGERPRINT_DEDUP
+        self.sloth_fingerprints = SlothFingerprintCache() if dedup_inputs else None
+
+        # the limits of the buffer (SlothConfig.STORE_*) are the ones set when the watching starts
+        with self.records_lock:
+            capture_store = SlothCaptureStore()
+            for record in self.capture_store:
+                capture_store.append(record)
+            self.capture_store = capture_store
+
+        self.open_session()
+
+    def start_workers(self):
+
+        if self.capture_mode == SlothConfig.SlothCaptureMode.QUEUED:
+            if self.sloth_worker is None or not self.sloth_worker.is_alive():
+                self.sloth_worker = SlothWorker(self.process, SlothConfig.CAPTURE_QUEUE_SIZE)
+                self.sloth_worker.start()
+
+        if SlothConfig.FLUSH_IN_BACKGROUND:
+            if self.sloth_writer is None or not self.sloth_writer.is_alive():
+                self.sloth_writer = SlothWorker(self.write_snapshot, SlothConfig.FLUSH_QUEUE_SIZE, name="SlothWriter")
+                self.sloth_writer.start()
+
+    def open_session(self):
+        # a new session, with its first snapshot
+
+        # the session watched by another process (the parent), this process writes its own shard of it
         snap_id = str(os.environ.get('SLOTH_SNAPSHOT_ID', ""))
-        if snap_id == "":
+        snap_pid = str(os.environ.get('SLOTH_SNAPSHOT_PID', ""))
+
+        if snap_id != "" and snap_pid != str(os.getpid()):
+            self.session_id = snap_id
+            self.snapshot_base = snap_id + "_w" + str(os.getpid())
+            self.snapshot_seq = 0
+
+            self.open_next_snapshot()
+
+        else:
+            # the timestamp of the start, numbered if the sessions of the same second exist: 1549134821,
+            # 1549134821_s2, 1549134821_s3, ... (the id stays the real time of the start, and doesn't clash
+            # with the names of the rotated snapshots and of the shards of another session)
+            session_time = str(int(datetime.datetime.now().timestamp()))
+            session_id = session_time
+            session_seq = 1
+
+            while not self.claim_snapshot_id(session_id):
+                session_seq += 1
+                session_id = session_time + "_s" + str(session_seq)
+
+            self.session_id = session_id
+            self.snapshot_base = self.session_id
+            self.snapshot_seq = 1
             self.snapshot_id = self.session_id
 
-        self.sloth_connector = SlothConnector(self.session_id, self.snapshot_id, self.to_dir)
+            os.environ['SLOTH_SNAPSHOT_ID'] = str(self.snapshot_id)
+            os.environ['SLOTH_SNAPSHOT_PID'] = str(os.getpid())
+
+            self.open_connector()
+
+    def open_next_snapshot(self):
+        # the next snapshot of the process: <base>.zip, <base>_0002.zip, <base>_0003.zip, ...
+
+        while True:
+            self.snapshot_seq += 1
+
+            if self.snapshot_seq == 1:
+                snapshot_id = self.snapshot_base
+            else:
+                snapshot_id = self.snapshot_base + "_" + str(self.snapshot_seq).zfill(4)
+
+            if self.claim_snapshot_id(snapshot_id):
+                break
+
+        self.snapshot_id = snapshot_id
+
+        self.open_connector()
+
+    def open_connector(self):
+
+        self.sloth_connector = snapshot_connectors[self.snapshot_format](self.session_id, self.snapshot_id, self.to_dir,
+                                                                         self.compression, self.compress_level)
+        self.snapshot_started = time.monotonic()
 
         self.sloth_state = SlothConfig.SlothState.WATCHING
         os.environ['SLOTH_STATE'] = SlothConfig.SlothState.WATCHING
-        os.environ['SLOTH_SNAPSHOT_ID'] = str(self.snapshot_id)
 
-        sloth_log.info("Started id: " + self.session_id)
+        sloth_log.info("Started id: " + self.session_id + ", snapshot: " + self.snapshot_id)
 
     def stop(self):
 
@@ -56,125 +292,520 @@ class SlothWatcher:
         self.sloth_state = SlothConfig.SlothState.IDLE
         os.environ['SLOTH_STATE'] = str(SlothConfig.SlothState.IDLE)
         self.snapshot_id = ""
-        os.environ['SLOTH_SNAPSHOT_ID'] = ""
 
-        zip_fn = self.sloth_connector.dump_data(self.data_watch_dump)
+        if str(os.environ.get('SLOTH_SNAPSHOT_PID', "")) == str(os.getpid()):
+            os.environ['SLOTH_SNAPSHOT_ID'] = ""
+            os.environ['SLOTH_SNAPSHOT_PID'] = ""
+
+        # the records that are still in the queue belong to this snapshot
+        if self.sloth_worker is not None:
+            self.sloth_worker.drain()
+
+        self.flush(wait=True)
+
+        # the final report of the watching
+        if SlothConfig.METRICS_LOG or SlothConfig.METRICS_FILE:
+            self.report_metrics()
+
+    def claim_snapshot_id(self, snapshot_id: str = "") -> bool:
+        """
+        Claiming the name of the snapshot, by creating its (empty) file in the directory of the snapshots
+
+        :param snapshot_id: the name to claim
+        :return: False if the name is taken
+        """
+
+        to_dir = os.getcwd() if self.to_dir is None else self.to_dir
+
+        try:
+            # the mode of the files created by open() (0o666 with umask)
+            fd = os.open(os.path.join(to_dir, snapshot_id + '.zip'), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+        except FileExistsError:
+            return False
 
-        sloth_log.info("Snapshot dumped to: " + zip_fn)
+        os.close(fd)
+
+        return True
 
     def dump(self):
+        # rotate the snapshot: the full buffer is written in the background and the watching goes on
 
-        self.stop()
-        self.start()
+        with self.dump_lock:
+            self.flush()
+            self.open_next_snapshot()
 
-        self.dump_counter = 0
+    def is_full(self) -> bool:
+        # the snapshot is rotated by the amount of calls, by the size of the captured values, or by the time
 
-    async def watch(self, fn, in_args: List = None, in_kwargs: Dict = None, res=None, additional_info: str = "",
-                    start_time: datetime = None, stop_time: datetime = None):
+        if self.dump_counter >= SlothConfig.DUMP_ITER_COUNT:
+            return True
 
-        sloth_log.debug("Start watching: " + str(fn))
+        if SlothConfig.DUMP_MAX_BYTES and self.dump_bytes >= SlothConfig.DUMP_MAX_BYTES:
+            return True
+
+        if SlothConfig.DUMP_MAX_SECONDS and self.dump_counter and \
+                time.monotonic() - self.snapshot_started >= SlothConfig.DUMP_MAX_SECONDS:
+            return True
+
+        return False
+
+    def dump_if_full(self):
+        # rotate the snapshot if it's full (once, when many threads find it full)
+
+        if not self.is_full():
+            return
+
+        with self.dump_lock:
+            if self.is_full():
+                self.dump()
+
+    def flush(self, wait: bool = False, close: bool = True):
+        """
+        Swapping the active buffer for an empty one, and writing the full one to the snapshot
+
+        :param wait: wait until the snapshot is written by the background writer
+        :param close: close the snapshot, otherwise the records are appended to the open one
+        :return: None
+        """
+
+        with self.dump_lock:
+
+            sloth_connector = self.sloth_connector
+
+            with self.records_lock:
+
+                self.collect_thread_records()
+
+                data_watch_dump = self.capture_store
+
+                # the reservoir sample is complete with the snapshot
+                if close and self.sloth_sampler is not None:
+                    for record in self.sloth_sampler.release():
+                        data_watch_dump.append(record)
+
+                self.capture_store = SlothCaptureStore()
+                self.blob_index = {}
+                if close:
+                    self.collected_counter = 0
+                    self.dumped_bytes = self.captured_bytes()
+                    self.stack_index = {}
+
+            # the records evicted from the full buffer
+            self.dropped_counter += data_watch_dump.dropped_counter
+
+            if self.sloth_writer is not None:
+                self.sloth_writer.put((sloth_connector, data_watch_dump, close), block=True)
+                if wait:
+                    self.sloth_writer.drain()
+            else:
+                self.write_snapshot((sloth_connector, data_watch_dump, close))
+
+    def thread_records(self) -> (deque, list):
+        # the buffer of the current thread and its captured bytes, registered on the first call in the thread
+
+        records = getattr(self.local_buffers, 'records', None)
+
+        if records is None:
+            records = deque()
+            self.local_buffers.records = records
+            self.local_buffers.totals = [0]
+
+            with self.records_lock:
+                self.thread_buffers.append((threading.current_thread(), records, self.local_buffers.totals))
+
+        return records, self.local_buffers.totals
+
+    def collect_records(self):
+
+        with self.records_lock:
+            self.collect_thread_records()
+
+    def collect_thread_records(self):
+        # moving the records of the threads to the buffer of the snapshot, in the order of the calls
+        # (called with records_lock, the threads keep appending to their buffers meanwhile)
+
+        collected = []
+        thread_buffers = []
+
+        for thread, records, totals in self.thread_buffers:
+
+            while True:
+                try:
+                    collected.append(records.popleft())
+                except IndexError:
+                    break
+
+            # the finished threads don't append to their buffers any more
+            if thread.is_alive():
+                thread_buffers.append((thread, records, totals))
+            else:
+                self.retired_bytes += totals[0]
+
+        self.thread_buffers = thread_buffers
+
+        collected.sort(key=lambda seq_record: seq_record[0])
+
+        for seq, record in collected:
+            self.capture_store.append(record)
+
+        self.collected_counter += len(collected)
+
+    def after_fork(self):
+        # the forked process (e.g. a worker of gunicorn or multiprocessing) doesn't share the snapshot with its parent:
+        # the records and the threads of the parent are left behind, and it watches to its own shard of the session
+
+        self.local_buffers = threading.local()
+        self.thread_buffers = []
+        self.records_lock = threading.Lock()
+        self.dump_lock = threading.RLock()
+
+        self.capture_store = SlothCaptureStore()
+        self.collected_counter = 0
+        self.retired_bytes = 0
+        self.dumped_bytes = 0
+        self.dropped_counter = 0
+        self.blob_index = {}
+        self.stack_index = {}
+
+        self.sloth_metrics = SlothMetrics()
+
+        self.sloth_worker = None
+        self.sloth_writer = None
+        self.sloth_executor = None
+
+        if self.sloth_connector is not None:
+            self.detached_connectors.append(self.sloth_connector)
+            self.sloth_connector = None
+
+        if self.sloth_state == SlothConfig.SlothState.WATCHING:
+            self.start_workers()
+            self.open_session()
+
+    def finalize_in_child(self):
+        # the shard of the multiprocessing child is written at its exit
+        multiprocessing.util.Finalize(self, self.shutdown, exitpriority=10)
+
+    def write_snapshot(self, record):
+        # writing the full buffer with its connector, either by the background writer or in place
+
+        sloth_connector, data_watch_dump, close = record
+
+        records_count = len(data_watch_dump)
+
+        started = time.perf_counter()
+        zip_fn = sloth_connector.dump_data(data_watch_dump, close)
+        self.sloth_metrics.observe_dump(time.perf_counter() - started, records_count,
+                                        os.path.getsize(zip_fn) if close and zip_fn else None)
+
+        if data_watch_dump.dropped_counter:
+            sloth_log.warning("Records dropped from the snapshot: " + str(data_watch_dump.dropped_counter))
+
+        data_watch_dump.clear()
+
+        if close:
+            sloth_log.info("Snapshot dumped to: " + zip_fn)
+
+    def shutdown(self):
+        # stop the watching and the background threads, processing all the records left in the queues
+
+        if self.sloth_state == SlothConfig.SlothState.WATCHING:
+            self.stop()
+
+        if self.sloth_worker is not None:
+            self.sloth_worker.shutdown()
+            self.sloth_worker = None
+
+        if self.sloth_writer is not None:
+            self.sloth_writer.shutdown()
+            self.sloth_writer = None
+
+        if self.sloth_executor is not None:
+            self.sloth_executor.shutdown(wait=True)
+            self.sloth_executor = None
+
+    def sample(self, fn, sample_rate: float = None, rate_limit: float = None, reservoir: int = None) -> (bool, int):
+        # the sampling decision for the call, before the arguments are copied (see SlothSampler)
+
+        if self.sloth_sampler is None:
+            return True, None
+
+        return self.sloth_sampler.sample(self.function_key(fn), sample_rate, rate_limit, reservoir)
+
+    def cancel_sample(self, fn, reservoir_slot: int = None):
+        # the sampled call is not captured, its slot of the reservoir (if any) is given back
+
+        if self.sloth_sampler is None or reservoir_slot is None:
+            return
+
+        self.sloth_sampler.cancel(self.function_key(fn), reservoir_slot)
+
+    def seen_inputs(self, fn, args: List = None, kwargs: Dict = None) -> bool:
+        # check if the call has the inputs already captured for the function (if the inputs dedup is on)
+
+        if self.sloth_fingerprints is None:
+            return False
+
+        descriptor = self.describe(fn)
+
+        try:
+            target_args = descriptor.bind(args, kwargs)
+        except TypeError:
+            return False
+
+        return self.sloth_fingerprints.seen(descriptor.key, target_args)
+
+    def function_key(self, fn) -> str:
+        return self.describe(fn).key
+
+    def capture(self, fn, in_args: List = None, in_kwargs: Dict = None, res=None, additional_info: str = "",
+                timing: Dict = None, reservoir_slot: int = None):
+        """
+        Capturing the particular call of the watched method, called from the watchme decorator
+
+        SYNC mode: the call is processed (serialized and saved) right in the caller's thread
+        QUEUED mode: the call is put to the queue of the background worker, and the caller doesn't wait for it
+
+        The timing of the call is the wall-clock and CPU times of it, in nanoseconds (see stop_timer)
+
+        """
+
+        # the stack of callers can be obtained in the caller's thread only
+        callers = self.collect_callers()
+
+        if self.capture_mode == SlothConfig.SlothCaptureMode.QUEUED and self.sloth_worker is not None:
+
+            # the result can be changed by the caller after return, so we need a copy of it
+            try:
+                if self.copy_mode == SlothConfig.SlothCopyMode.SERIALIZE:
+                    if type(res) == tuple:
+                        res = tuple(self.snapshot_value(ret_val) for ret_val in res)
+                    else:
+                        res = self.snapshot_value(res)
+                else:
+                    res = deepcopy(res)
+            except Exception:
+                pass
+
+            self.sloth_worker.put((fn, in_args, in_kwargs, res, additional_info, timing, callers, reservoir_slot))
 
-        if start_time and stop_time:
-            run_time = (stop_time - start_time).microseconds
         else:
-            run_time = 0
+
+            self.run_watch((fn, in_args, in_kwargs, res, additional_info, timing, callers, reservoir_slot))
+
+    async def capture_async(self, fn, in_args: List = None, in_kwargs: Dict = None, res=None,
+                            additional_info: str = "", timing: Dict = None, reservoir_slot: int = None):
+        """
+        Capturing the call of the watched coroutine function, in the event loop of the caller
+
+        SYNC mode: the call is processed by the executor, and the caller awaits it, so the loop is not blocked
+        QUEUED mode: the call is put to the queue of the background worker (see capture)
+
+        """
+
+        if self.capture_mode == SlothConfig.SlothCaptureMode.QUEUED and self.sloth_worker is not None:
+            self.capture(fn, in_args, in_kwargs, res, additional_info, timing, reservoir_slot)
+            return
+
+        callers = self.collect_callers()
+
+        await self.run_in_executor(self.run_watch,
+                                   (fn, in_args, in_kwargs, res, additional_info, timing, callers, reservoir_slot))
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        # a single thread, so the records are processed one at a time, in the order of the calls
+
+        if self.sloth_executor is None:
+            self.sloth_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="SlothExecutor")
+
+        return self.sloth_executor
+
+    async def run_in_executor(self, handler=None, *args):
+        # running the blocking work (serialization, dump) off the event loop of the caller
+
+        return await asyncio.get_running_loop().run_in_executor(self.get_executor(), handler, *args)
+
+    def run_watch(self, record):
+        # asyncio.run can't be called from a running event loop (e.g. a sync method watched in a coroutine),
+        # then the record is processed by the executor, and the caller waits for it
 
         try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            asyncio.run(self.watch(*record))
+            return
+
+        self.get_executor().submit(self.run_watch, record).result()
+
+    def process(self, record):
+        # processing of the queued record in the background worker
+
+        self.run_watch(record)
+
+        self.dump_if_full()
+
+    def snapshot_inputs(self, args: tuple = None, kwargs: Dict = None) -> (tuple, Dict):
+        """
+        Keeping the income arguments of the call, before the method can change them
+
+        DEEPCOPY mode: the arguments are deep copied
+        SERIALIZE mode: each argument is serialized once, and the watcher reuses the bytes (see snapshot_value)
+
+        :return: the arguments, the keyword arguments
+        """
+
+        if self.copy_mode != SlothConfig.SlothCopyMode.SERIALIZE:
+            return deepcopy(args), deepcopy(kwargs)
+
+        in_args = tuple(self.snapshot_value(value) for value in args)
+        in_kwargs = {key: self.snapshot_value(value) for key, value in kwargs.items()}
+
+        return in_args, in_kwargs
+
+    def snapshot_value(self, value=None):
 
-            func_dict = await self.watch_function(fn, in_args, run_time)
+        try:
+            return snapshot_value(value, self.serialize)
+        except Exception as e:
+            # the value can't be serialized (e.g. a lambda): it's copied as in DEEPCOPY mode, so the capture
+            # of the call fails later (in the log), not the call itself
+            sloth_log.error("The value was not serialized, it's copied. Error: " + str(e))
+
+        try:
+            return deepcopy(value)
+        except Exception:
+            return value
+
+    def collect_callers(self) -> tuple:
+        """
+        Get the (module, function) list of callers, from the inner to the outer one
+
+        The frames are walked without reading the source code (unlike inspect.stack), up to
+        SlothConfig.CALL_STACK_DEPTH callers (0 - the whole stack). The frames of the sloth itself are skipped
+
+        :return: the callers (a tuple, so the equal stacks can be interned)
+        """
+
+        if not SlothConfig.CALL_STACK_CAPTURE:
+            return ()
+
+        max_depth = SlothConfig.CALL_STACK_DEPTH
+
+        callers = []
+
+        frame = sys._getframe(1)
+        while frame is not None:
+            module_name = frame.f_globals.get('__name__', "")
+            if module_name and module_name.find("sloth") == -1:
+                callers.append((module_name, frame.f_code.co_name))
+                if max_depth and len(callers) >= max_depth:
+                    break
+            frame = frame.f_back
+
+        return tuple(callers)
+
+    async def watch(self, fn, in_args: List = None, in_kwargs: Dict = None, res=None, additional_info: str = "",
+                    timing: Dict = None, callers: tuple = None, reservoir_slot: int = None):
+
+        sloth_log.debug("Start watching: " + str(fn))
+
+        try:
+
+            func_dict = await self.watch_function(fn, in_args, timing, callers)
 
             args_dict = await self.watch_function_args(fn, in_args, in_kwargs)
 
-            res_dict = await self.watch_function_result(res, additional_info)
+            res_dict = await self.watch_function_result(res, additional_info, fn)
 
             sloth_log.debug("End watching: " + str(fn))
 
-            self.data_watch_dump.append({
+            record = {
                 'function': func_dict,
                 'arguments': args_dict,
                 'results': res_dict
-            })
+            }
 
-            sloth_log.debug("Data dumped for: " + str(fn))
+            if reservoir_slot is not None:
+                self.sloth_sampler.keep(self.function_key(fn), reservoir_slot, record)
+                sloth_log.debug("Data sampled for: " + str(fn))
+                return
 
-            self.dump_counter += 1
+            records, totals = self.thread_records()
 
-        except Exception as e:
+            records.append((next(self.capture_seq), record))
+            totals[0] += SlothCaptureStore.record_size(record)
 
-            sloth_log.error("Data was not dumped. Error: " + str(e))
+            self.sloth_metrics.count_capture(self.function_key(fn))
 
-    async def watch_function(self, fn, in_args: List = None, run_time: int = 0) -> Dict:
+            # the limits of a bounded buffer are applied right away, the records are not kept by the threads
+            capture_store = self.capture_store
+            if capture_store.max_records or capture_store.max_bytes:
+                self.collect_records()
 
-        def get_full_scope(fn):
-            # build a full path to the method
-
-            def unique_path(shorter_dir: List = None, longer_dir: List = None) -> List:
-
-                sep = 0
-                for i in range(len(longer_dir)):
-                    if i >= len(shorter_dir):
-                        sep = i
-                        break
-                    if shorter_dir[i] != longer_dir[i]:
-                        sep = i
-                        break
+            sloth_log.debug("Data dumped for: " + str(fn))
 
-                return longer_dir[-(len(longer_dir) - sep):]
+            # the buffered records are appended to the open snapshot, to keep them out of memory
+            if SlothConfig.FLUSH_ITER_COUNT and len(self.data_watch_dump) >= SlothConfig.FLUSH_ITER_COUNT:
+                self.flush(close=False)
 
-            this_dir = os.getcwd()
-            remote_dir = os.path.normpath(inspect.getfile(fn)[:-3])
+            if self.sloth_metrics.report_due():
+                self.report_metrics()
 
-            remote_dir_list = remote_dir.split(os.path.sep)
-            this_dir_list = this_dir.split(os.path.sep)
+        except Exception as e:
 
-            diff_dir = unique_path(this_dir_list, remote_dir_list)
+            sloth_log.error("Data was not dumped. Error: " + str(e))
 
-            return '.'.join(diff_dir)
+    async def watch_function(self, fn, in_args: List = None, timing: Dict = None, callers: tuple = None) -> Dict:
 
-        def get_callers_stack(fn) -> str:
+        def get_callers_stack(descriptor: SlothFunctionDescriptor = None, callers: tuple = None) -> str:
             # get a human-readable stack of callers for the method
+            # the equal stacks of the snapshot share the same string
 
-            stack = inspect.stack()
+            if callers is None:
+                callers = self.collect_callers()
 
-            stack_size = len(stack)
+            if not SlothConfig.CALL_STACK_CAPTURE:
+                return ""
 
-            modules = [(index, inspect.getmodule(stack[index][0]))
-                       for index in reversed(range(1, stack_size))]
+            stack_key = (descriptor.key, callers)
 
-            s = '{name}@{module} '
-            callers = []
+            call_stack = self.stack_index.get(stack_key)
+            if call_stack is None:
 
-            for index, module in modules:
-                if module.__name__.find("sloth") == -1:
-                    callers.append(s.format(module=module.__name__, name=stack[index][3]))
+                s = '{name}@{module} '
+                stack = ['', s.format(module=descriptor.module, name=descriptor.name)]
 
-            callers.append(s.format(module=fn.__module__, name=fn.__name__))
+                for module_name, name in callers:
+                    stack.append(s.format(module=module_name, name=name))
 
-            callers.append('')
-            callers.reverse()
+                call_stack = ' <- '.join(stack)
+                self.stack_index[stack_key] = call_stack
 
-            return ' <- '.join(callers)
+            return call_stack
 
-        # check if the function is a class member
-        # if it's a class member, we need to dump a class instance
+        descriptor = self.describe(fn)
 
-        fn_name = fn.__name__
-        if fn.__qualname__.find(".") == -1:
-            classname = ""
+        # if it's a class member, we need to dump a class instance
+        if descriptor.class_name == "":
             class_dump = ""
+            class_ref = ""
         else:
-            classname = fn.__qualname__.split(".")[0]
-            class_dump = self.dump_class_with_joblib(in_args[0])
+            class_ref, class_dump = self.dump_blob(in_args[0])
+
+        # the run time in microseconds, for the snapshots of the older versions
+        run_time = timing['wall_ns'] // 1000 if timing else 0
 
         dict_comm = {
             'instance_name': self.instance_id,
             'snapshot_name': self.snapshot_id,
-            'scope_name': get_full_scope(fn),
-            'class_name': classname,
+            'scope_name': descriptor.scope_name,
+            'class_name': descriptor.class_name,
             'class_dump': class_dump,
-            'function_name': fn_name,
+            'class_ref': class_ref,
+            'function_name': descriptor.name,
+            'is_async': str(descriptor.is_async),
             'run_time': str(run_time),
-            'call_stack': get_callers_stack(fn)
+            'timing': dict(timing) if timing else {},
+            'call_stack': get_callers_stack(descriptor, callers)
         }
 
         return dict_comm
@@ -183,95 +814,194 @@ class SlothWatcher:
         # bound income real arguments with the all possible arguments of the method
         # and serialize this kwargs list
 
-        bound_args = inspect.signature(fn).bind(*in_args, **in_kwargs)
-        bound_args.apply_defaults()
-        target_args = dict(bound_args.arguments)
+        descriptor = self.describe(fn)
+
+        target_args = descriptor.bind(in_args, in_kwargs)
 
         var_pack = []
 
         for key, value in target_args.items():
 
-            p_type_tmp = type(value)
-
-            if p_type_tmp is int or p_type_tmp is float or p_type_tmp is bool:
-                d_simple = True
-                d_val = value
-            else:
-                d_simple = False
-                d_val = self.dump_class_with_joblib(value)
+            d_simple, d_type, d_ref, d_val = self.serialize_value(descriptor, value)
 
-            d_type = codecs.encode(pickle.dumps(p_type_tmp), "base64").decode()
-
-            var_pack.append(self.var_d_pack(par_type=d_type, par_name=key, par_value=d_val,
+            var_pack.append(self.var_d_pack(par_type=d_type, par_name=key, par_value=d_val, par_ref=d_ref,
                                             par_state=str(SlothConfig.SlothValueState.INCOME),
                                             par_simple=d_simple, ))
 
-            await asyncio.sleep(1)
+            await asyncio.sleep(0)
 
         return var_pack
 
-    async def watch_function_result(self, res=None, additional_info: str = "") -> List:
+    async def watch_function_result(self, res=None, additional_info: str = "", fn=None) -> List:
         # watch and save the result of the method
 
+        descriptor = self.describe(fn)
+
         var_pack = []
         if type(res) == tuple:
 
             i = 0
             for ret_val in res:
 
-                p_type_tmp = type(ret_val)
-
-                if p_type_tmp is int or p_type_tmp is float or p_type_tmp is bool:
-                    d_simple = True
-                    d_res = ret_val
-                else:
-                    d_simple = False
-                    d_res = self.dump_class_with_joblib(ret_val)
-
-                d_type = codecs.encode(pickle.dumps(p_type_tmp), "base64").decode()
+                d_simple, d_type, d_ref, d_res = self.serialize_value(descriptor, ret_val)
 
                 var_pack.append(self.var_d_pack(par_type=d_type, par_name='ret_' + str(i), par_value=d_res,
+                                                par_ref=d_ref,
                                                 par_state=str(SlothConfig.SlothValueState.RESULT),
                                                 par_simple=d_simple, ))
                 i = i + 1
 
-                await asyncio.sleep(1)
+                await asyncio.sleep(0)
         else:
 
-            p_type_tmp = type(res)
-
-            if p_type_tmp is int or p_type_tmp is float or p_type_tmp is bool:
-                d_simple = True
-                d_res = res
-            else:
-                d_simple = False
-                d_res = self.dump_class_with_joblib(res)
+            d_simple, d_type, d_ref, d_res = self.serialize_value(descriptor, res)
 
-            d_type = codecs.encode(pickle.dumps(p_type_tmp), "base64").decode()
-
-            var_pack.append(self.var_d_pack(par_type=d_type, par_name='ret_0', par_value=d_res,
+            var_pack.append(self.var_d_pack(par_type=d_type, par_name='ret_0', par_value=d_res, par_ref=d_ref,
                                             par_state=str(SlothConfig.SlothValueState.RESULT),
                                             par_simple=d_simple,
                                             additional_info=additional_info))
 
         return var_pack
 
-    def dump_class_with_joblib(self, value) -> str:
+    def serialize_value(self, descriptor: SlothFunctionDescriptor = None, value=None) -> (bool, bytes, str, object):
+        # serialize the value by the plan of its type: simple values are stored as is
+
+        # the value, serialized when the method was called
+        if isinstance(value, SlothSerializedValue):
+            value_type = value.value_type
+        else:
+            value_type = type(value)
+
+        if descriptor is None:
+            d_simple, d_type = SlothFunctionDescriptor.value_plan_of(value_type)
+        else:
+            d_simple, d_type = descriptor.value_plan(value_type)
+
+        if d_simple:
+            return d_simple, d_type, "", value
+
+        d_ref, d_val = self.dump_blob(value)
+
+        return d_simple, d_type, d_ref, d_val
+
+    def stats(self) -> Dict:
+        """
+        The runtime metrics of the watcher (see SlothMetrics), with the current state of its queues and buffers:
+        the records waiting for the background worker and writer, the records and the bytes captured for the open
+        snapshot, the dropped captures (by the full queue or evicted from the full buffer), the calls sampled out,
+        and the calls skipped as their inputs were captured before
+
+        :return: the stats
+        """
+
+        sloth_worker = self.sloth_worker
+        sloth_writer = self.sloth_writer
+
+        return self.sloth_metrics.stats({
+            'queue_depth': {
+                'capture': sloth_worker.records.qsize() if sloth_worker is not None else 0,
+                'writer': sloth_writer.records.qsize() if sloth_writer is not None else 0,
+            },
+            'buffered': {'records': self.dump_counter, 'bytes': self.dump_bytes},
+            'dropped': {
+                'queue_full': sloth_worker.dropped_counter if sloth_worker is not None else 0,
+                'evicted': self.dropped_counter + self.capture_store.dropped_counter,
+            },
+            'sampled_out': self.sloth_metrics.retired['sampled_out'] +
+            (self.sloth_sampler.sampled_out_counter if self.sloth_sampler is not None else 0),
+            'dedup_skipped': self.sloth_metrics.retired['dedup_skipped'] +
+            (self.sloth_fingerprints.skipped_counter if self.sloth_fingerprints is not None else 0),
+        })
+
+    def report_metrics(self):
+        # the periodic report of the stats (see SlothMetrics.report)
+
+        try:
+            self.sloth_metrics.report(self.stats())
+        except Exception as e:
+            sloth_log.error("The metrics were not reported. Error: " + str(e))
+
+    def describe(self, fn) -> SlothFunctionDescriptor:
+        # the descriptor of the function: the one made by watchme, or a cached one for a plain function
+
+        if fn is None or isinstance(fn, SlothFunctionDescriptor):
+            return fn
+
+        descriptor = self.descriptors.get(fn)
+        if descriptor is None:
+            descriptor = SlothFunctionDescriptor(fn)
+            self.descriptors[fn] = descriptor
+
+        return descriptor
+
+    def serialize(self, value) -> bytes:
+        # numpy arrays and pandas objects are serialized as raw column buffers, anything else with joblib
+
+        started = time.perf_counter()
+
+        if SlothConfig.COLUMNAR_SERIALIZER and is_columnar_type(type(value)):
+            data = dump_columnar(value)
+        else:
+            data = self.dump_class_with_joblib(value)
+
+        value_type = type(value)
+        self.sloth_metrics.observe_serialization(value_type.__module__ + '.' + value_type.__qualname__,
+                                                 time.perf_counter() - started, len(data))
+
+        return data
+
+    def dump_class_with_joblib(self, value) -> bytes:
+        # the raw serialized value, it's encoded (if needed) by the connector of the snapshot format
+        # the stream is reused by the calls of the thread
+
+        outputStream = getattr(self.local_buffers, 'stream', None)
+        if outputStream is None:
+            outputStream = io.BytesIO()
+            self.local_buffers.stream = outputStream
 
-        outputStream = io.BytesIO()
-        joblib.dump(value, outputStream)
         outputStream.seek(0)
-        d_val = codecs.encode(outputStream.read(), "base64").decode()
+        outputStream.truncate()
+        joblib.dump(value, outputStream)
+
+        return outputStream.getvalue()
+
+    def dump_blob(self, value) -> (str, bytes):
+        """
+        Serializing the value to a blob, addressed by the hash of its content
+
+        The equal blobs of the buffer share the same bytes in memory, and the connector writes each blob
+        to the snapshot only once (the next occurrences refer to it by the hash)
 
-        return d_val
+        :param value: the value to serialize
+        :return: the hash of the blob, the blob
+        """
+
+        if isinstance(value, SlothSerializedValue):
+            d_val = value.data
+        else:
+            d_val = self.serialize(value)
+
+        d_ref = hashlib.blake2b(d_val, digest_size=16).hexdigest()
+
+        return d_ref, self.blob_index.setdefault(d_ref, d_val)
 
     def var_d_pack(self, **kwargs):
 
         return {
             'par_type': kwargs.get('par_type', ""),
             'par_name': kwargs.get('par_name', ""),
-            'par_value': str(kwargs.get('par_value', "")),
+            'par_value': self.pack_value(kwargs.get('par_value', "")),
+            'par_ref': kwargs.get('par_ref', ""),
             'par_state': kwargs.get('par_state', ""),
             'par_simple': str(kwargs.get('par_simple', "")),
             'additional_info': kwargs.get('additional_info', ""),
         }
+
+    @staticmethod
+    def pack_value(value):
+        # serialized values are kept as raw bytes, simple ones as a text
+
+        if isinstance(value, bytes):
+            return value
+
+        return str(value)
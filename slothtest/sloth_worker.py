@@ -0,0 +1,75 @@
+import queue
+import threading
+from . import sloth_log
+
+
+class SlothWorker(threading.Thread):
+    """
+    A background worker with a bounded queue of records
+
+    The producer (watchme decorator) only puts a record to the queue and returns immediately,
+    all the heavy processing is done by the handler in the worker thread.
+    If the queue is full, the record is dropped and counted in dropped_counter (unless the producer blocks)
+
+    """
+
+    queue_size = 0
+    handler = None
+    records = None
+
+    dropped_counter = 0
+
+    def __init__(self, handler=None, queue_size: int = 0, name: str = "SlothWorker"):
+
+        super().__init__(name=name, daemon=True)
+
+        self.handler = handler
+        self.queue_size = queue_size
+        self.records = queue.Queue(maxsize=queue_size)
+
+        self.dropped_counter = 0
+
+    def put(self, record, block: bool = False) -> bool:
+        # if block is True, wait for a free slot in the queue instead of dropping the record
+
+        try:
+            self.records.put(record, block=block)
+        except queue.Full:
+            self.dropped_counter += 1
+            sloth_log.debug("Worker queue is full, record dropped")
+            return False
+
+        return True
+
+    def run(self):
+
+        while True:
+
+            record = self.records.get()
+
+            try:
+                if record is None:
+                    break
+                self.handler(record)
+            except Exception as e:
+                sloth_log.error("Worker couldn't process the record. Error: " + str(e))
+            finally:
+                self.records.task_done()
+
+    def drain(self):
+        # wait until all the queued records are processed
+        # (the worker can't wait for itself, e.g. when the handler triggers a dump)
+
+        if threading.current_thread() is self or not self.is_alive():
+            return
+
+        self.records.join()
+
+    def shutdown(self):
+
+        if not self.is_alive():
+            return
+
+        self.drain()
+        self.records.put(None)
+        self.join()
@@ -4,17 +4,81 @@ import codecs
 import argparse
 import os
 import zipfile
+import struct
+import inspect
+import sys
+import multiprocessing
+import filecmp
+import tempfile
+from collections import deque
 from typing import Dict, List
 
 # it can be either called via the CLI as a standalone, or as a class
 try:
     from .sloth_config import SlothConfig
     from .sloth_log import sloth_log
+    from .sloth_columnar import COLUMNAR_MAGIC, is_columnar, sloth_load_columnar
+    from .sloth_convert_cache import SlothConvertCache, CACHE_FILENAME, RUN_ID_PLACEHOLDER
+    from .sloth_benchmark import sloth_benchmark
 except:
     from sloth_config import SlothConfig
     from sloth_log import sloth_log
+    from sloth_columnar import COLUMNAR_MAGIC, is_columnar, sloth_load_columnar
+    from sloth_convert_cache import SlothConvertCache, CACHE_FILENAME, RUN_ID_PLACEHOLDER
+    from sloth_benchmark import sloth_benchmark
+
+# an amount of tests in each shard, if the tests are generated by several processes and the shard size is not defined
+DEFAULT_SHARD_SIZE = 100
+
+# the variables module loads the lazy values on the first access to them (module __getattr__, PEP 562)
+LAZY_LOADER_TEXT = '''
+def __getattr__(name):
+    # the value is loaded from the data store when a test uses it for the first time
+
+    if name not in sloth_index:
+        raise AttributeError("module " + __name__ + " has no attribute " + name)
+
+    kind, filename = sloth_index[name]
+
+    if kind == 'columnar':
+        value = sloth_load_columnar(os.path.join(sloth_data_dir, filename))
+    else:
+        value = joblib.load(os.path.join(sloth_data_dir, filename))
+
+    if sloth_cache_values:
+        globals()[name] = value
+
+    return value
+'''
+
+# the columnar values in xml snapshots start with the base64 of the magic bytes
+COLUMNAR_MAGIC_BASE64 = codecs.encode(COLUMNAR_MAGIC, "base64").decode()[:len(COLUMNAR_MAGIC) // 3 * 4]
+
+
+def sloth_init_worker(path: List = None, settings: Dict = None):
+    # the worker process has to import the project the same way as the main one, to unpickle the types of values,
+    # and to convert them with the same settings
+    sys.path[:] = path
+
+    for name, value in settings.items():
+        setattr(SlothConfig, name, value)
+
+
+def sloth_write_shard(job: Dict = None) -> (List, Dict, Dict):
+    # the shard written by a worker process, with only the entries of the conversion cache it needs
+    # (see SlothTestConverter.shard_job)
+
+    converter = SlothTestConverter()
+
+    converter.data_dir_name = job['data_dir_name']
+    converter.data_dir = os.path.join(job['to_dir'], job['data_dir_name'])
+    converter.lazy_values = job['lazy_values']
+
+    converter.convert_cache = SlothConvertCache(job['to_dir'])
+    converter.convert_cache.load_entries(job['records'], job['files'])
+
+    return converter.write_shard(job['shard_name'], job['functions'], job['to_dir'], job['keys'])
 
-RUN_TIME_INCREASE_RATE = 3
 
 class SlothTestConverter:
 
@@ -23,6 +87,19 @@ class SlothTestConverter:
 
     objects_eq_function = SlothConfig.objects_eq
 
+    # the directory for the buffers of the columnar values, and its name (relative to the variables module)
+    data_dir = None
+    data_dir_name = ""
+
+    # the values are loaded by the variables module when a test uses them (see SlothConfig.CONVERT_LAZY_VALUES)
+    lazy_values = True
+
+    # the cache of the generated texts and the data files (see SlothConvertCache),
+    # and the run id and the data files of the record being converted
+    convert_cache = None
+    run_id = ""
+    data_files = None
+
     def _parseXMLtodict(self, parent):
         """
         Converting incoming xml file to dict for better usability
@@ -65,8 +142,10 @@ class SlothTestConverter:
         def test_cleanup_1():
             from main import cleanup
 
+            run_args = dict(dt=sl.val_cleanup_1_dt, column_name=sl.val_cleanup_1_column_name, )
+
             try:
-                run_result = cleanup(dt=sl.val_cleanup_1_dt, column_name=sl.val_cleanup_1_column_name, )
+                run_result = cleanup(**run_args)
             except Exception as e:
                 run_result = e
 
@@ -77,9 +156,9 @@ class SlothTestConverter:
         == Variables module text ex:
 
         ...
-        val_cleanup_1_dt = pickle.loads(codecs.decode('gANjcGFu.......'.encode(),"base64"))
+        sloth_index['val_cleanup_1_dt'] = ('joblib', 'val_cleanup_1_dt.slj')
         val_cleanup_1_column_name = 'Advertisers list'
-        res_cleanup_1_ret_0 = pickle.loads(codecs.decode('gANjcGFuZGF.........'.encode(),"base64"))
+        sloth_index['res_cleanup_1_ret_0'] = ('joblib', 'res_cleanup_1_ret_0.slj')
         ...
 
         """
@@ -96,7 +175,10 @@ class SlothTestConverter:
         classname = func_data_dict.get('class_name', "")
         class_dump = func_data_dict.get('class_dump', "")
         fnname = func_data_dict.get('func_name', "")
+        is_async = func_data_dict.get('is_async', False)
         run_time = int(func_data_dict.get('run_time', 0))
+        cpu_time = int(func_data_dict.get('timing', {}).get('thread_ns', 0))
+        wall_time = int(func_data_dict.get('timing', {}).get('wall_ns', run_time * 1000))
         target_values_raw = func_data_dict.get('in', [])
         target_result_raw = func_data_dict.get('out', [])
 
@@ -127,49 +209,76 @@ class SlothTestConverter:
 
             else:
 
-                parval = "%r" % v_val['par_value']
-                var_text += 'var_stream = io.BytesIO()\n'
-                var_text += 'var_stream_str = codecs.decode(' + parval + '.encode(),"base64")\n\n'
-                var_text += 'var_stream.write(var_stream_str)\n'
-                var_text += 'var_stream.seek(0)\n'
-                var_text += v_parname + ' = joblib.load(var_stream)\n\n'
+                var_text += self.value_text(v_parname, v_val['par_value'], 'var_stream')
 
             par_str += parname + '=sl.' + v_parname + ', '
 
-        func_text += "\n    try:\n"
-
-        if classname == "":
+        # the values are loaded (lazily) before the run, so the loading is not timed
+        func_text += "\n    run_args = dict(" + par_str + ")\n"
 
-            if run_time > 0:
-                func_text += '        start_time = datetime.datetime.now()\n'
+        if classname != "":
+            v_classname = 'cls_' + t_func_name + '_' + classname
+            var_text += self.value_text(v_classname, class_dump, 'class_stream')
 
-            func_text += '        run_result = ' + fnname + "(" + par_str + ") \n"
+            func_text += "    run_object = sl." + v_classname + "\n"
 
-            if run_time > 0:
-                func_text += '        stop_time = datetime.datetime.now()\n'
-                func_text += '        run_time = (stop_time - start_time).microseconds\n'
+        tolerance = self.run_time_tolerance(scope, classname, fnname)
 
+        # a coroutine is run by a new event loop, created before the run, so its creation is not timed
+        if classname == "":
+            call_text = fnname + "(**run_args)"
+            bench_call_text = fnname + "(**a)"
         else:
-            parval = "%r" % class_dump
-            var_text += 'class_stream = io.BytesIO()\n'
-            var_text += 'class_stream_str = codecs.decode(' + parval + '.encode(),"base64")\n'
-            var_text += 'class_stream.write(class_stream_str)\n'
-            var_text += 'class_stream.seek(0)\n'
-            v_classname = 'cls_' + t_func_name + '_' + classname
-            var_text += v_classname + ' = joblib.load(class_stream)\n\n'
+            call_text = "run_object." + fnname + "(**run_args)"
+            bench_call_text = "o." + fnname + "(**a)"
+
+        if is_async:
+            func_text += "    run_loop = asyncio.new_event_loop()\n"
+            call_text = "run_loop.run_until_complete(" + call_text + ")"
+            bench_call_text = "run_loop.run_until_complete(" + bench_call_text + ")"
+
+        # in the benchmark mode the run time is checked by the repeated runs (with copies of the arguments),
+        # instead of the single run
+        benchmark = SlothConfig.BENCHMARK_MODE and run_time > 0
+        if benchmark:
+            run_time = 0
+
+            if classname == "":
+                func_text += "\n    sloth_benchmark(lambda a: " + bench_call_text + ", lambda: copy.deepcopy((run_args, )),\n"
+            else:
+                func_text += "\n    sloth_benchmark(lambda o, a: " + bench_call_text + ", " + \
+                             "lambda: copy.deepcopy((run_object, run_args)),\n"
 
-            if run_time > 0:
-                func_text += '        start_time = datetime.datetime.now()\n'
+            func_text += "                    baseline_ns=" + str(wall_time) + ", baseline_cpu_ns=" + str(cpu_time) + \
+                         ", tolerance=" + str(tolerance) + ",\n"
+            func_text += "                    warmup=" + str(SlothConfig.BENCHMARK_WARMUP) + \
+                         ", repeat=" + str(SlothConfig.BENCHMARK_REPEAT) + \
+                         ", percentile=" + str(SlothConfig.BENCHMARK_PERCENTILE) + \
+                         ", name='" + t_func_name + "')\n"
 
-            func_text += '        run_result = sl.' + v_classname + "." + fnname + "(" + par_str + ") \n"
+        func_text += "\n    try:\n"
 
-            if run_time > 0:
-                func_text += '        stop_time = datetime.datetime.now()\n'
-                func_text += '        run_time = (stop_time - start_time).microseconds\n'
+        # the wall-clock time (in microseconds, as in the snapshot) and the CPU time of the thread (in nanoseconds)
+        if run_time > 0:
+            func_text += '        start_time = time.perf_counter_ns()\n'
+            func_text += '        start_cpu_time = time.thread_time_ns()\n'
+
+        func_text += '        run_result = ' + call_text + " \n"
+
+        if run_time > 0:
+            func_text += '        cpu_time = time.thread_time_ns() - start_cpu_time\n'
+            func_text += '        run_time = (time.perf_counter_ns() - start_time) // 1000\n'
 
         func_text += '    except Exception as e:\n'
         func_text += '        run_time = 0\n'
-        func_text += '        run_result = e\n\n'
+        func_text += '        cpu_time = 0\n'
+        func_text += '        run_result = e\n'
+
+        if is_async:
+            func_text += '    finally:\n'
+            func_text += '        run_loop.close()\n'
+
+        func_text += '\n'
 
         # result
 
@@ -186,12 +295,7 @@ class SlothTestConverter:
 
             else:
 
-                parval = "%r" % v_res['par_value']
-                var_text += 'res_stream = io.BytesIO()\n'
-                var_text += 'res_stream_str = codecs.decode(' + parval + '.encode(),"base64")\n'
-                var_text += 'res_stream.write(res_stream_str)\n'
-                var_text += 'res_stream.seek(0)\n'
-                var_text += v_parname + ' = joblib.load(res_stream)\n\n'
+                var_text += self.value_text(v_parname, v_res['par_value'], 'res_stream')
 
             res.append('sl.' + v_parname)
 
@@ -230,11 +334,27 @@ class SlothTestConverter:
                 func_text += "    assert(run_result["+str(i)+"]." + eq_expr + "(test_result["+str(i)+"]))\n"
 
         if run_time > 0:
-            max__run_time = run_time * RUN_TIME_INCREASE_RATE
+            max__run_time = run_time * tolerance
             func_text += f"    assert(run_time <= {max__run_time})\n"
 
+            if cpu_time > 0:
+                max__cpu_time = cpu_time * tolerance
+                func_text += f"    assert(cpu_time <= {max__cpu_time})\n"
+
         return func_text, var_text
 
+    @staticmethod
+    def run_time_tolerance(scope: str = "", classname: str = "", fnname: str = "") -> float:
+        # the tolerance of the method's run time (see SlothConfig.RUN_TIME_TOLERANCES)
+
+        for key in ('.'.join(filter(None, (scope, classname, fnname))),
+                    '.'.join(filter(None, (classname, fnname))),
+                    fnname):
+            if key in SlothConfig.RUN_TIME_TOLERANCES:
+                return SlothConfig.RUN_TIME_TOLERANCES[key]
+
+        return SlothConfig.RUN_TIME_TOLERANCE
+
     def get_dumped_parameters(self, par_val_arr: List = None) -> List:
         """
 
@@ -252,7 +372,10 @@ class SlothTestConverter:
 
             for rec in par_val_arr:
 
-                p_type_tmp = pickle.loads(codecs.decode(rec['par_type'].encode(), "base64"))
+                if isinstance(rec['par_type'], bytes):
+                    p_type_tmp = pickle.loads(rec['par_type'])
+                else:
+                    p_type_tmp = pickle.loads(codecs.decode(rec['par_type'].encode(), "base64"))
 
                 t_d = {
                     'par_name': rec['par_name'],
@@ -264,119 +387,565 @@ class SlothTestConverter:
 
         return params
 
-    def parse_file_create_tests(self, filename: str = None, to_dir: str = None):
+    def read_snapshot(self, filename: str = None):
+        """
+        Reading the functions of the snapshot (zip archive), either in the xml or in the binary format
+
+        :param filename: the snapshot
+        :return: generator of the function dicts (see create_text_of_test_module)
+        """
+
+        for record in self.read_records(filename):
+            yield self.function_dict(record)
+
+    def read_records(self, filename: str = None):
+        """
+        Reading the watched records of the snapshot as they were written by the connector:
+        run_id, function, arguments and results, with the values of the deduplicated blobs restored
+
+        :param filename: the snapshot
+        :return: generator of the records
+        """
+
+        packname = os.path.basename(filename)[:-4]
+
+        with zipfile.ZipFile(filename) as myzip:
+            names = myzip.namelist()
+
+        if packname + '.slb' in names:
+            records = self.read_binary_snapshot(filename, packname + '.slb')
+        else:
+            records = self.read_xml_snapshot(filename, packname + '.xml')
+
+        yield from self.resolve_blobs(records)
+
+    def resolve_blobs(self, records=None):
         """
-        The Main function. Get an XML file (zip) of dumped functions and converts it to python unit-test code
+        Restoring the values of the deduplicated blobs: the blob is stored in the snapshot only once,
+        with its first occurrence, the next occurrences refer to it by the hash
+
+        The blobs are spilled to a temporary file when they are read for the first time, only their offsets
+        are kept in memory, so the memory doesn't depend on the size of the snapshot
+
+        :param records: generator of the records
+        :return: generator of the records with all the values
+        """
+
+        # ref -> (offset, length, the value is text) of the blob in the temporary file
+        blobs = {}
+
+        with tempfile.TemporaryFile(prefix="sloth_blobs_") as blob_file:
+
+            def resolve(var_dict: Dict = None, value_key: str = "", ref_key: str = ""):
+
+                ref = var_dict.get(ref_key, "")
+                if not ref:
+                    return
+
+                value = var_dict[value_key]
+
+                if value:
+                    if ref not in blobs:
+                        # the values of xml snapshots are base64 text, the ones of binary snapshots are bytes
+                        is_text = isinstance(value, str)
+                        data = value.encode() if is_text else value
+
+                        blob_file.seek(0, os.SEEK_END)
+                        blobs[ref] = (blob_file.tell(), len(data), is_text)
+                        blob_file.write(data)
+                    return
+
+                blob = blobs.get(ref)
+                if blob is None:
+                    var_dict[value_key] = ""
+                    return
+
+                offset, length, is_text = blob
+
+                blob_file.seek(offset)
+                data = blob_file.read(length)
+
+                var_dict[value_key] = data.decode() if is_text else data
+
+            for record in records:
+
+                resolve(record['function'], 'class_dump', 'class_ref')
+                for var_dict in record['arguments'] + record['results']:
+                    resolve(var_dict, 'par_value', 'par_ref')
+
+                yield record
+
+    @staticmethod
+    def function_dict(record: Dict = None) -> Dict:
+        # the function dict (see create_text_of_test_module) of the record
+
+        def var_dicts(var_list: List = None) -> List:
+
+            return [{
+                'par_type': var['par_type'],
+                'par_name': var['par_name'],
+                'par_value': var['par_value'],
+                'par_ref': var.get('par_ref', ""),
+                'par_simple': str(var.get('par_simple', True)) == 'True',
+            } for var in var_list]
+
+        function_dict = record['function']
+
+        return {
+            'scope': function_dict['scope_name'],
+            'class_name': function_dict['class_name'],
+            'class_dump': function_dict['class_dump'],
+            'class_ref': function_dict.get('class_ref', ""),
+            'func_name': function_dict['function_name'],
+            'is_async': str(function_dict.get('is_async', False)) == 'True',
+            'run_time': function_dict['run_time'],
+            'timing': function_dict.get('timing', {}),
+            'run_id': record['run_id'],
+            'in': var_dicts(record['arguments']),
+            'out': var_dicts(record['results'])
+        }
+
+    def read_xml_snapshot(self, filename: str = None, xml_filename: str = None):
+
+        # the function elements are parsed straight from the zip one at a time, and cleared after the conversion,
+        # so the memory doesn't depend on the size of the snapshot
+
+        with zipfile.ZipFile(filename) as myzip:
+            with myzip.open(xml_filename) as myfile:
+
+                functions_list = None
+
+                try:
+                    for event, element in ET.iterparse(myfile, events=('start', 'end')):
+
+                        if event == 'start':
+                            if element.tag == 'functions_list':
+                                functions_list = element
+                            continue
+
+                        if element.tag != 'function' or functions_list is None:
+                            continue
+
+                        yield self._xml_function_to_record(self._parseXMLtodict(element))
+
+                        functions_list.clear()
+
+                except ET.ParseError as e:
+                    sloth_log.error('Error while parsing the XML file: ' + str(e))
+                    raise Exception('Error while parsing the XML file: ' + str(e))
+
+    def _xml_function_to_record(self, func_element: Dict = None) -> Dict:
+        # the record (see read_records) of the parsed function element, all the values are text
+
+        def content(element: Dict = None) -> Dict:
+            return {tag: sub_element.get(self.xml_content_tag, "") for tag, sub_element in element.items()
+                    if tag not in ('arguments_list', 'results_list')}
+
+        function_dict = content(func_element)
+
+        # the wall-clock and CPU times of the call (ns)
+        function_dict['timing'] = {tag: int(time_element.get(self.xml_content_tag, 0))
+                                   for tag, time_element in func_element.get('timing', {}).items()}
+
+        return {
+            'run_id': function_dict.pop('run_id', ""),
+            'function': function_dict,
+            'arguments': [content(arg_element) for arg_element in func_element['arguments_list'][self.xml_list_tag]],
+            'results': [content(res_element) for res_element in func_element['results_list'][self.xml_list_tag]]
+        }
+
+    def read_binary_snapshot(self, filename: str = None, bin_filename: str = None):
+
+        def read_record(stream):
+
+            rec_len = stream.read(8)
+            if len(rec_len) < 8:
+                return None
+
+            return pickle.loads(stream.read(struct.unpack('<Q', rec_len)[0]))
+
+        with zipfile.ZipFile(filename) as myzip:
+            with myzip.open(bin_filename) as stream:
+
+                if stream.read(len(SlothConfig.BINARY_MAGIC)) != SlothConfig.BINARY_MAGIC:
+                    sloth_log.error('Wrong format of the binary snapshot: ' + filename)
+                    raise Exception('Wrong format of the binary snapshot: ' + filename)
+
+                # header
+                read_record(stream)
+
+                while True:
+
+                    rec = read_record(stream)
+                    if rec is None:
+                        break
+
+                    yield rec
+
+    def parse_file_create_tests(self, filename: str = None, to_dir: str = None, processes: int = None,
+                                shard_size: int = None, shard_by_function: bool = None, incremental: bool = None):
+        """
+        The Main function. Get a snapshot (zip) of dumped functions and converts it to python unit-test code
+        Both xml and binary snapshot formats are supported
 
         The result is two files:
         test_sloth.py - python code for unit testing all dumped function
         sloth_test_parval.py - python code for dumped variables that used in unit tests
 
-        :param filename: the XML file with dumps you need to convert
+        If the result is sharded, there are two files for each shard (test_sloth_<pack>_<shard>.py and
+        sloth_test_parval_<pack>_<shard>.py), so pytest-xdist can spread the modules across the cores
+
+        The incremental conversion keeps the cache of the generated texts in the result dir, and generates
+        the tests only for the new or changed records. The files with the same content are not written again
+
+        :param filename: the snapshot with dumps you need to convert
         :param to_dir: the directory where to put the result files (current dir by default)
-        :return: None
+        :param processes: an amount of processes generating the shards (SlothConfig.CONVERT_PROCESSES by default)
+        :param shard_size: an amount of tests in each shard (SlothConfig.CONVERT_SHARD_SIZE by default, 0 - no shards)
+        :param shard_by_function: one shard for each function (SlothConfig.CONVERT_SHARD_BY_FUNCTION by default)
+        :param incremental: use the conversion cache (SlothConfig.CONVERT_INCREMENTAL by default)
+        :return: a list of created files
         """
 
         if filename is None:
             sloth_log.error('Filename was not defined')
             raise Exception('Filename was not defined')
 
+        processes = SlothConfig.CONVERT_PROCESSES if processes is None else processes
+        shard_size = SlothConfig.CONVERT_SHARD_SIZE if shard_size is None else shard_size
+        shard_by_function = SlothConfig.CONVERT_SHARD_BY_FUNCTION if shard_by_function is None else shard_by_function
+        incremental = SlothConfig.CONVERT_INCREMENTAL if incremental is None else incremental
+
         packname = os.path.basename(filename)[:-4]
-        with zipfile.ZipFile(filename) as myzip:
-            xml_filename = packname+'.xml'
-            with myzip.open(xml_filename) as myfile:
-                with open(os.path.join(os.path.dirname(filename),xml_filename), "wb") as fh:
-                    fh.write(myfile.read())
 
         sloth_log.info("Converting: " + packname)
 
         if to_dir is None:
             to_dir = os.path.dirname(os.path.abspath(__file__))
 
+        # the data dir is shared by all the shards of the snapshot
+        self.data_dir_name = "sloth_data_" + packname
+        self.data_dir = os.path.join(to_dir, self.data_dir_name)
+
+        self.lazy_values = SlothConfig.CONVERT_LAZY_VALUES
+
+        # without the incremental conversion the cache is not saved, but the unchanged files are still not written
+        self.convert_cache = SlothConvertCache(to_dir, os.path.join(to_dir, CACHE_FILENAME) if incremental else None)
+
+        if processes > 1 and not shard_size and not shard_by_function:
+            shard_size = DEFAULT_SHARD_SIZE
+
+        shards = self.shards(self.read_snapshot(filename), packname, shard_size, shard_by_function)
+
+        if processes > 1:
+            settings = {name: value for name, value in vars(SlothConfig).items() if name.isupper()}
+
+            jobs = (self.shard_job(name, functions, to_dir) for name, functions in shards)
+
+            with multiprocessing.Pool(processes, initializer=sloth_init_worker, initargs=(sys.path, settings)) as pool:
+                created = self.run_jobs(pool, processes, jobs)
+        else:
+            created = [self.write_shard(name, functions, to_dir) for name, functions in shards]
+
+        files = []
+        for shard_files, records, data_files in created:
+            files += shard_files
+            self.convert_cache.merge(records, data_files)
+
+        self.convert_cache.save()
+
+        sloth_log.info("Convertion finished. Files " + ", ".join(files) + " created!")
+
+        return files
+
+    def shards(self, functions=None, packname: str = "", shard_size: int = 0, shard_by_function: bool = False):
+        """
+        Splitting the functions of the snapshot to the shards
+
+        :param functions: generator of the function dicts
+        :param packname: the name of the snapshot
+        :param shard_size: an amount of tests in each shard (0 - no shards)
+        :param shard_by_function: one shard for each function
+        :return: generator of (the name of the shard, the function dicts of the shard)
+        """
+
+        if shard_by_function:
+
+            by_function = {}
+            for func_dict in functions:
+                key = (func_dict['scope'], func_dict['class_name'], func_dict['func_name'])
+                by_function.setdefault(key, []).append(func_dict)
+
+            for n, shard in enumerate(by_function.values()):
+                yield packname + "_" + str(n + 1).zfill(4) + "_" + shard[0]['func_name'], shard
+
+            return
+
+        if not shard_size:
+            yield packname, functions
+            return
+
+        n = 0
+        shard = []
+        for func_dict in functions:
+
+            shard.append(func_dict)
+
+            if len(shard) >= shard_size:
+                n += 1
+                yield packname + "_" + str(n).zfill(4), shard
+                shard = []
+
+        if shard:
+            yield packname + "_" + str(n + 1).zfill(4), shard
+
+    def shard_job(self, shard_name: str = "", functions=None, to_dir: str = None) -> Dict:
+        """
+        The job of the worker process (see sloth_write_shard): the function dicts of the shard, their cache keys,
+        and only the entries of the conversion cache for them (not the whole cache)
+
+        :param shard_name: the name of the shard
+        :param functions: the function dicts of the shard
+        :param to_dir: the directory where to put the result files
+        :return: the job
+        """
+
+        functions = list(functions)
+        keys = [self.cache_key(func_dict) for func_dict in functions]
+
+        records = {}
+        files = {}
+
+        for key, func_dict in zip(keys, functions):
+
+            entry = self.convert_cache.records.get(key)
+            if entry is None:
+                continue
+
+            records[key] = entry
+            files.update(self.convert_cache.file_states(entry[2], self.data_dir_name, str(func_dict['run_id'])))
+
+        return {
+            'shard_name': shard_name,
+            'functions': functions,
+            'keys': keys,
+            'to_dir': to_dir,
+            'data_dir_name': self.data_dir_name,
+            'lazy_values': self.lazy_values,
+            'records': records,
+            'files': files,
+        }
+
+    @staticmethod
+    def run_jobs(pool=None, processes: int = 1, jobs=None) -> List:
+        # the jobs are submitted as the workers take them (up to two waiting for each process), so only a few
+        # shards are in memory at once (Pool.imap would read all of them ahead); the results keep the order
+
+        created = []
+        pending = deque()
+
+        for job in jobs:
+
+            if len(pending) >= 2 * processes:
+                created.append(pending.popleft().get())
+
+            pending.append(pool.apply_async(sloth_write_shard, (job, )))
+
+        while pending:
+            created.append(pending.popleft().get())
+
+        return created
+
+    def write_shard(self, shard_name: str = "", functions=None, to_dir: str = None,
+                    keys: List = None) -> (List, Dict, Dict):
+        """
+        Writing the test and the variables modules of the shard
+
+        :param shard_name: the name of the shard (the name of the snapshot, if there are no shards)
+        :param functions: the function dicts of the shard
+        :param to_dir: the directory where to put the result files
+        :param keys: the cache keys of the function dicts (computed here by default)
+        :return: [the test module file, the variables module file], the records and the data files
+            used from (or added to) the conversion cache
+        """
+
+        ttf = os.path.join(to_dir, "test_sloth_" + shard_name + ".py")
+        ttv = os.path.join(to_dir, "sloth_test_parval_" + shard_name + ".py")
+
+        # the modules are written to temporary files, and replace the old ones only if they are changed
         try:
-            tree = ET.parse(xml_filename)
-            root = tree.getroot()
-        except Exception as e:
-            sloth_log.error('Error while parsing the XML file: ' + str(e))
-            raise Exception('Error while parsing the XML file: ' + str(e))
-
-        func_dict = self._parseXMLtodict(root)
-
-        target_test_file = 'import sloth_test_parval_'+packname+' as sl \n\n'
-        target_test_file += "import datetime\n\n"
-
-        target_variable_file = "import codecs\n"
-        target_variable_file += "import io\n"
-        target_variable_file += "import joblib\n"
-
-        for func_element in func_dict['functions_list'][self.xml_list_tag]:
-
-            f_run_id = func_element['run_id'].get(self.xml_content_tag, "")
-            f_scope = func_element['scope_name'].get(self.xml_content_tag, "")
-            f_class_name = func_element['class_name'].get(self.xml_content_tag, "")
-            f_class_dump = func_element['class_dump'].get(self.xml_content_tag, "")
-            f_name = func_element['function_name'].get(self.xml_content_tag, "")
-            run_time = func_element['run_time'].get(self.xml_content_tag, "")
-
-            f_in = []
-            for arg_element in func_element['arguments_list'][self.xml_list_tag]:
-                in_d = {
-                    'par_type': arg_element['par_type'].get(self.xml_content_tag, ""),
-                    'par_name': arg_element['par_name'].get(self.xml_content_tag, ""),
-                    'par_value': arg_element['par_value'].get(self.xml_content_tag, ""),
-                    'par_simple': eval(arg_element['par_simple'].get(self.xml_content_tag, 'True')),
-                }
+            self.write_modules(shard_name, functions, ttf + '.tmp', ttv + '.tmp', keys)
 
-                f_in.append(in_d)
+            for fn in (ttf, ttv):
+                if os.path.isfile(fn) and filecmp.cmp(fn + '.tmp', fn, shallow=False):
+                    os.remove(fn + '.tmp')
+                else:
+                    os.replace(fn + '.tmp', fn)
+        finally:
+            for fn in (ttf, ttv):
+                if os.path.isfile(fn + '.tmp'):
+                    os.remove(fn + '.tmp')
 
-            f_out = []
-            for arg_element in func_element['results_list'][self.xml_list_tag]:
-                out_d = {
-                    'par_type': arg_element['par_type'].get(self.xml_content_tag, ""),
-                    'par_name': arg_element['par_name'].get(self.xml_content_tag, ""),
-                    'par_value': arg_element['par_value'].get(self.xml_content_tag, ""),
-                    'par_simple': eval(arg_element['par_simple'].get(self.xml_content_tag, 'True')),
-                }
+        return [ttf, ttv], self.convert_cache.used_records, self.convert_cache.used_files
 
-                f_out.append(out_d)
+    def write_modules(self, shard_name: str = "", functions=None, ttf: str = "", ttv: str = "", keys: List = None):
 
-            func_dict = {
-                'scope': f_scope,
-                'class_name': f_class_name,
-                'class_dump': f_class_dump,
-                'func_name': f_name,
-                'run_time': run_time,
-                'run_id': f_run_id,
-                'in': f_in,
-                'out': f_out
-            }
+        # the text of each function is written as soon as it's converted, so the memory doesn't depend on
+        # the amount of functions in the snapshot
+        with open(ttf, 'w') as test_file, open(ttv, 'w') as variable_file:
 
-            t_f_t, v_f_t = self.create_text_of_test_module(func_dict)
+            test_file.write('import sloth_test_parval_' + shard_name + ' as sl \n\n')
+            test_file.write("import time\n")
+            test_file.write("import asyncio\n\n")
 
-            target_variable_file += "\n# ===== "+f_run_id+": "+f_name+"@"+f_scope+"\n\n"
+            if SlothConfig.BENCHMARK_MODE:
+                test_file.write("import copy\n\n\n")
+                test_file.write(inspect.getsource(sloth_benchmark) + "\n\n")
 
-            target_test_file += t_f_t
-            target_variable_file += v_f_t
+            variable_file.write("import codecs\n")
+            variable_file.write("import io\n")
+            variable_file.write("import os\n")
+            variable_file.write("import joblib\n\n")
+            variable_file.write("sloth_data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '" +
+                                self.data_dir_name + "')\n\n\n")
+            variable_file.write(inspect.getsource(sloth_load_columnar))
 
-            target_variable_file += "\n\n"
-            target_test_file += "\n\n"
+            if self.lazy_values:
+                variable_file.write("\n\n# name -> (kind, file in the data dir) of the lazy values\n")
+                variable_file.write("sloth_index = {}\n\n")
+                variable_file.write("# keep the loaded values in the module, or load them on each access\n")
+                variable_file.write("sloth_cache_values = " + str(SlothConfig.CONVERT_CACHE_VALUES) + "\n\n")
+                variable_file.write(LAZY_LOADER_TEXT)
 
-        ttf = os.path.join(to_dir, "test_sloth_" + packname + ".py")
-        with open(ttf, 'w') as f:
-            f.write(target_test_file)
+            for n, func_dict in enumerate(functions):
 
-        ttv = os.path.join(to_dir, "sloth_test_parval_"+packname+".py")
-        with open(ttv, 'w') as f:
-            f.write(target_variable_file)
+                t_f_t, v_f_t = self.convert_function(func_dict, None if keys is None else keys[n])
 
-        os.remove(xml_filename)
+                variable_file.write("\n# ===== "+func_dict['run_id']+": "+func_dict['func_name']+"@" +
+                                    func_dict['scope']+"\n\n")
 
-        sloth_log.info("Convertion finished. Files " + ttf + " and "+ttv+" created!")
+                test_file.write(t_f_t + "\n\n")
+                variable_file.write(v_f_t + "\n\n")
 
+    def cache_key(self, func_dict: Dict = None) -> bytes:
+        # the key of the record in the conversion cache: the record without its run id, and the settings
+        # the texts depend on
 
-if __name__ == '__main__':
+        record = dict(func_dict, run_id=RUN_ID_PLACEHOLDER)
+
+        settings = (self.lazy_values, self.objects_eq_function,
+                    SlothConfig.RUN_TIME_TOLERANCE, SlothConfig.RUN_TIME_TOLERANCES, SlothConfig.BENCHMARK_MODE,
+                    SlothConfig.BENCHMARK_WARMUP, SlothConfig.BENCHMARK_REPEAT, SlothConfig.BENCHMARK_PERCENTILE)
+
+        return self.convert_cache.record_key(record, settings)
+
+    def convert_function(self, func_dict: Dict = None, key: bytes = None) -> (str, str):
+        """
+        The texts of the test and the variables of the function record (see create_text_of_test_module),
+        from the conversion cache if the same record was converted before (in this or in another snapshot)
+
+        The texts are generated (and cached) for the record without its run id, the generated names get
+        the run id after that
+
+        :param func_dict: the function dict
+        :param key: the cache key of the record (see cache_key), computed here by default
+        :return: text of the test module, text of the variables module
+        """
+
+        run_id = str(func_dict.get('run_id', ""))
+        record = dict(func_dict, run_id=RUN_ID_PLACEHOLDER)
+
+        if key is None:
+            key = self.cache_key(func_dict)
+
+        texts = self.convert_cache.get(key, self.data_dir_name, run_id)
+        if texts is not None:
+            return texts
+
+        self.run_id = run_id
+        self.data_files = {}
+        func_text, var_text = self.create_text_of_test_module(record)
+
+        # the values embedded to the variables module (not lazy) are not kept in the cache a second time
+        if self.lazy_values:
+            self.convert_cache.put(key, func_text, var_text, self.data_files)
+
+        return func_text.replace(RUN_ID_PLACEHOLDER, run_id), var_text.replace(RUN_ID_PLACEHOLDER, run_id)
+
+    def write_data_file(self, filename: str = "", data: bytes = b""):
+        # the file in the data dir, it's not written if it has the same content
+        # (the name of the file is kept in the cache with the placeholder of the run id)
+
+        rel_path = os.path.join(self.data_dir_name, filename.replace(RUN_ID_PLACEHOLDER, self.run_id))
+
+        self.data_files[filename] = self.convert_cache.write(rel_path, data)
+
+    def columnar_value(self, value=None) -> bytes:
+        # the raw columnar value (see sloth_columnar), or None if the value is serialized by joblib
+
+        if isinstance(value, bytes):
+            return value if is_columnar(value) else None
 
-    import sys
+        if value.startswith(COLUMNAR_MAGIC_BASE64):
+            return codecs.decode(value.encode(), "base64")
+
+        return None
+
+    def value_text(self, v_parname: str = "", value=None, stream_name: str = "var_stream") -> str:
+        """
+        The text of the serialized value in the variables module
+
+        Columnar values are written to the data dir and memory mapped. With lazy values, the joblib values are
+        written to the data dir too, and only the index of the value is in the module text,
+        so the value is loaded when a test uses it. Otherwise the value is embedded to the module as base64
+
+        :param v_parname: the name of the variable
+        :param value: the serialized value (base64 text in xml snapshots, bytes in binary snapshots)
+        :param stream_name: the name of the stream variable for embedded values
+        :return: the text of the variable
+        """
+
+        columnar = self.columnar_value(value)
+
+        if columnar is not None:
+
+            self.write_data_file(v_parname + '.slc', columnar)
+
+            if self.lazy_values:
+                return "sloth_index['" + v_parname + "'] = ('columnar', '" + v_parname + ".slc')\n"
+
+            return v_parname + " = sloth_load_columnar(os.path.join(sloth_data_dir, '" + v_parname + ".slc'))\n\n"
+
+        if self.lazy_values:
+
+            if not isinstance(value, bytes):
+                value = codecs.decode(value.encode(), "base64")
+
+            self.write_data_file(v_parname + '.slj', value)
+
+            return "sloth_index['" + v_parname + "'] = ('joblib', '" + v_parname + ".slj')\n"
+
+        parval = "%r" % self.encode_value(value)
+
+        text = stream_name + ' = io.BytesIO()\n'
+        text += stream_name + '_str = codecs.decode(' + parval + '.encode(),"base64")\n'
+        text += stream_name + '.write(' + stream_name + '_str)\n'
+        text += stream_name + '.seek(0)\n'
+        text += v_parname + ' = joblib.load(' + stream_name + ')\n\n'
+
+        return text
+
+    @staticmethod
+    def encode_value(value) -> str:
+        # raw serialized values (binary format) are embedded to the variables module as base64 text
+
+        if isinstance(value, bytes):
+            return codecs.encode(value, "base64").decode()
+
+        return value
+
+
+if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Sloth Watcher Dump to pytest converter')
     parser.add_argument("filename", help="a Sloth's xml dump file (zip archive)")
@@ -384,11 +953,25 @@ if __name__ == '__main__':
                         default=os.getcwd())
     parser.add_argument('-d', "--to_dir", help="The directory for result files",
                         default=os.getcwd())
+    parser.add_argument('-j', "--processes", help="An amount of processes generating the tests",
+                        type=int, default=None)
+    parser.add_argument('-s', "--shard_size", help="An amount of tests in each generated module",
+                        type=int, default=None)
+    parser.add_argument('-f', "--shard_by_function", help="Generate a module for each function",
+                        action='store_true', default=None)
+    parser.add_argument('-b', "--benchmark", help="Check the run times by the repeated runs of each method",
+                        action='store_true')
+    parser.add_argument("--no_cache", help="Generate all the tests again, without the conversion cache",
+                        dest='incremental', action='store_false', default=None)
 
     args = parser.parse_args()
 
     sys.path.append(os.path.abspath(args.project_dir))
 
+    if args.benchmark:
+        SlothConfig.BENCHMARK_MODE = True
+
     sltc = SlothTestConverter()
-    sltc.parse_file_create_tests(args.filename, args.to_dir)
+    sltc.parse_file_create_tests(args.filename, args.to_dir, args.processes, args.shard_size, args.shard_by_function,
+                                 args.incremental)
 
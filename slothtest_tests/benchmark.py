@@ -0,0 +1,277 @@
+"""
+The overhead benchmark of the Sloth itself
+
+For each payload of the grid it measures:
+- the time of a call of the watched method: not decorated, decorated while the Sloth is idle, and while it's watching
+  (the dump is not done during the calls, it's measured separately)
+- the throughput of the snapshot writer (dump_data), MB of the snapshot (uncompressed) per second
+- the throughput of the converter (parse_file_create_tests), records per second
+
+The results are written as json, so the cost of the tool can be tracked across the releases:
+
+python benchmark.py -o bench.json
+python benchmark.py -p scalar -p dataframe_1e5 --max_rows 100000 --calls_scale 0.1
+
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import argparse
+import platform
+import tempfile
+import datetime
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+from slothtest import watchme
+from slothtest import slothwatcher
+from slothtest import SlothConfig
+from slothtest import snapshot_connectors
+from slothtest.sloth_xml_converter import SlothTestConverter
+
+
+def bench_function(value=None):
+    return value
+
+
+watched_function = watchme()(bench_function)
+
+
+class BenchClass:
+
+    def __init__(self, rows: int = 0):
+        self.table = pd.DataFrame({'column': np.arange(rows), 'value': np.arange(rows) * 0.5})
+
+    def bench_method(self, key=0):
+        return key
+
+    watched_method = watchme()(bench_method)
+
+
+def nested_dict(depth: int = 3, width: int = 10) -> Dict:
+    if depth == 0:
+        return {'int': 1, 'float': 0.5, 'str': 'sloth', 'list': list(range(width))}
+
+    return {'key_' + str(i): nested_dict(depth - 1, width) for i in range(width)}
+
+
+def data_frame(rows: int = 0) -> pd.DataFrame:
+    return pd.DataFrame({'column': np.arange(rows), 'value': np.arange(rows) * 0.5,
+                         'name': pd.Categorical(np.arange(rows) % 10)})
+
+
+# name -> (the kind of the call, the amount of rows, the payload factory, the amount of calls)
+PAYLOADS = {
+    'scalar': ('function', 0, lambda: 42, 1000),
+    'nested_dict': ('function', 0, nested_dict, 100),
+    'dataframe_1e3': ('function', 10 ** 3, lambda: data_frame(10 ** 3), 100),
+    'dataframe_1e5': ('function', 10 ** 5, lambda: data_frame(10 ** 5), 20),
+    'dataframe_1e7': ('function', 10 ** 7, lambda: data_frame(10 ** 7), 2),
+    'method_self_1e5': ('method', 10 ** 5, lambda: BenchClass(10 ** 5), 20),
+    'method_self_1e7': ('method', 10 ** 7, lambda: BenchClass(10 ** 7), 2),
+}
+
+
+def time_calls(call=None, calls: int = 1) -> int:
+    # the mean time of a call (ns)
+
+    started = time.perf_counter_ns()
+    for _ in range(calls):
+        call()
+
+    return (time.perf_counter_ns() - started) // calls
+
+
+def bench_payload(name: str = "", calls: int = 1, to_dir: str = "", capture_mode: str = None,
+                  snapshot_format: str = None) -> Dict:
+    """
+    Benchmarking a payload of the grid
+
+    :param name: the name of the payload (see PAYLOADS)
+    :param calls: an amount of calls of the method
+    :param to_dir: the directory for the snapshots and the generated tests
+    :param capture_mode: SlothCaptureMode of the watching
+    :param snapshot_format: SlothSnapshotFormat of the snapshot
+    :return: the results
+    """
+
+    kind, rows, factory, _ = PAYLOADS[name]
+
+    payload = factory()
+
+    if kind == 'method':
+        bare_call = lambda: payload.bench_method(1)
+        watched_call = lambda: payload.watched_method(1)
+    else:
+        bare_call = lambda: bench_function(payload)
+        watched_call = lambda: watched_function(payload)
+
+    os.makedirs(to_dir, exist_ok=True)
+
+    bare_ns = time_calls(bare_call, calls)
+    idle_ns = time_calls(watched_call, calls)
+
+    # all the calls are kept in the buffer, the dump is measured by itself
+    dump_iter_count = SlothConfig.DUMP_ITER_COUNT
+    SlothConfig.DUMP_ITER_COUNT = calls + 1
+
+    try:
+        slothwatcher.start(to_dir=to_dir, capture_mode=capture_mode, snapshot_format=snapshot_format,
+                           sample_rate=1.0, rate_limit=0, reservoir=0, dedup_inputs=False)
+
+        watching_ns = time_calls(watched_call, calls)
+
+        if slothwatcher.sloth_worker is not None:
+            slothwatcher.sloth_worker.drain()
+
+        records = list(slothwatcher.data_watch_dump)
+
+        slothwatcher.stop()
+    finally:
+        SlothConfig.DUMP_ITER_COUNT = dump_iter_count
+
+    snapshot_id = "bench_" + name
+    connector = snapshot_connectors[slothwatcher.snapshot_format](snapshot_id, snapshot_id, to_dir)
+
+    started = time.perf_counter_ns()
+    zip_fn = connector.dump_data(records)
+    dump_ns = time.perf_counter_ns() - started
+
+    with zipfile.ZipFile(zip_fn) as myzip:
+        snapshot_bytes = sum(info.file_size for info in myzip.infolist())
+
+    tests_dir = os.path.join(to_dir, 'tests')
+    os.makedirs(tests_dir, exist_ok=True)
+
+    started = time.perf_counter_ns()
+    SlothTestConverter().parse_file_create_tests(zip_fn, tests_dir, processes=1, incremental=False)
+    convert_ns = time.perf_counter_ns() - started
+
+    return {
+        'payload': name,
+        'kind': kind,
+        'rows': rows,
+        'calls': calls,
+        'records': len(records),
+        'bare_ns': bare_ns,
+        'idle_ns': idle_ns,
+        'watching_ns': watching_ns,
+        'idle_overhead_ns': idle_ns - bare_ns,
+        'watching_overhead_ns': watching_ns - bare_ns,
+        'snapshot_bytes': snapshot_bytes,
+        'zip_bytes': os.path.getsize(zip_fn),
+        'dump_ns': dump_ns,
+        'dump_mb_s': snapshot_bytes / 1e6 / (dump_ns / 1e9) if dump_ns else 0.0,
+        'convert_ns': convert_ns,
+        'convert_records_s': len(records) / (convert_ns / 1e9) if convert_ns else 0.0,
+    }
+
+
+def run_benchmarks(payloads: List = None, max_rows: int = None, calls_scale: float = 1.0, to_dir: str = None,
+                   capture_mode: str = None, snapshot_format: str = None) -> Dict:
+    """
+    Running the benchmark for the grid of payloads
+
+    :param payloads: the names of the payloads (all of them by default)
+    :param max_rows: skip the payloads with more rows
+    :param calls_scale: a multiplier of the amount of calls of each payload (at least one call)
+    :param to_dir: the directory for the snapshots and the generated tests (a temp dir, removed after, by default)
+    :param capture_mode: SlothCaptureMode of the watching (SlothConfig.CAPTURE_MODE by default)
+    :param snapshot_format: SlothSnapshotFormat of the snapshot (SlothConfig.SNAPSHOT_FORMAT by default)
+    :return: the report
+    """
+
+    if payloads is None:
+        payloads = list(PAYLOADS)
+
+    for name in payloads:
+        if name not in PAYLOADS:
+            raise Exception("Unknown payload: " + name + ", the payloads are: " + ", ".join(PAYLOADS))
+
+    if capture_mode is None:
+        capture_mode = SlothConfig.CAPTURE_MODE
+
+    if snapshot_format is None:
+        snapshot_format = SlothConfig.SNAPSHOT_FORMAT
+
+    temp_dir = None
+    if to_dir is None:
+        to_dir = temp_dir = tempfile.mkdtemp(prefix="sloth_bench_")
+
+    report = {
+        'timestamp': datetime.datetime.now().replace(microsecond=0).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'settings': {
+            'capture_mode': capture_mode,
+            'snapshot_format': snapshot_format,
+            'compression': SlothConfig.SNAPSHOT_COMPRESSION,
+            'compress_level': SlothConfig.SNAPSHOT_COMPRESS_LEVEL,
+            'capture_copy': SlothConfig.CAPTURE_COPY,
+            'columnar_serializer': SlothConfig.COLUMNAR_SERIALIZER,
+            'call_stack_capture': SlothConfig.CALL_STACK_CAPTURE,
+            'calls_scale': calls_scale,
+        },
+        'results': []
+    }
+
+    try:
+        for name in payloads:
+
+            kind, rows, factory, calls = PAYLOADS[name]
+            if max_rows is not None and rows > max_rows:
+                continue
+
+            result = bench_payload(name, max(1, int(calls * calls_scale)), os.path.join(to_dir, name),
+                                   capture_mode, snapshot_format)
+            report['results'].append(result)
+
+            print("{payload:>16}: idle +{idle_overhead_ns} ns, watching +{watching_overhead_ns} ns per call, "
+                  "dump {dump_mb_s:.1f} MB/s, convert {convert_records_s:.1f} records/s".format(**result),
+                  file=sys.stderr)
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return report
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Sloth overhead benchmark')
+    parser.add_argument('-p', "--payload", help="A payload to benchmark (all of them by default): " +
+                        ", ".join(PAYLOADS), action='append', default=None)
+    parser.add_argument("--max_rows", help="Skip the payloads with more rows", type=int, default=None)
+    parser.add_argument("--calls_scale", help="A multiplier of the amount of calls of each payload",
+                        type=float, default=1.0)
+    parser.add_argument('-q', "--queued", help="Watch in the queued capture mode", action='store_true')
+    parser.add_argument('-b', "--binary", help="Write the snapshots in the binary format", action='store_true')
+    parser.add_argument('-c', "--compression", help="The compression of the snapshots: " +
+                        "0 - stored, 1 - deflate, 2 - bzip2, 3 - lzma", default=None)
+    parser.add_argument('-l', "--level", help="The compression level", type=int, default=None)
+    parser.add_argument('-d', "--to_dir", help="Keep the snapshots and the generated tests in the directory",
+                        default=None)
+    parser.add_argument('-o', "--output", help="The json file for the results (stdout by default)", default=None)
+
+    args = parser.parse_args()
+
+    if args.compression is not None:
+        SlothConfig.SNAPSHOT_COMPRESSION = args.compression
+    if args.level is not None:
+        SlothConfig.SNAPSHOT_COMPRESS_LEVEL = args.level
+
+    report = run_benchmarks(args.payload, args.max_rows, args.calls_scale, args.to_dir,
+                            SlothConfig.SlothCaptureMode.QUEUED if args.queued else None,
+                            SlothConfig.SlothSnapshotFormat.BINARY if args.binary else None)
+
+    if args.output is None:
+        print(json.dumps(report, indent=1))
+    else:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=1)
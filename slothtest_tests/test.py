@@ -1,8 +1,32 @@
 import pytest
 import os
+import io
+import sys
+import pickle
+import joblib
+import zipfile
+import json
+import importlib.util
+import asyncio
+import time
+import threading
+import multiprocessing
+import xml.etree.ElementTree as ET
+import numpy as np
 import pandas as pd
 from slothtest import watchme
 from slothtest import slothwatcher
+from slothtest import SlothConfig
+from slothtest import SlothCaptureStore
+from slothtest import SlothSampler
+from slothtest import SlothFingerprintCache
+from slothtest import SlothFunctionDescriptor
+from slothtest import SlothSerializedValue
+from slothtest import SlothSnapshotMerger
+from slothtest import SlothMetrics
+from slothtest.sloth_xml_converter import SlothTestConverter
+from slothtest.sloth_columnar import dump_columnar, sloth_load_columnar
+from slothtest.sloth_benchmark import sloth_benchmark
 
 
 class ClassForTesting:
@@ -27,16 +51,14 @@ def im_another_function_for_testing(d_table=None, vv=1):
     return d_table, vv
 
 
-def test_classmethod():
-    dirname = os.path.dirname(__file__)
-
+def test_classmethod(tmp_path):
     d_data = [{'column': 1, 'value': 1},
               {'column': 2, 'value': 2},
               {'column': 3, 'value': 4}]
 
     d_table = pd.DataFrame(d_data)
 
-    slothwatcher.start()
+    slothwatcher.start(to_dir=str(tmp_path))
 
     fn = ClassForTesting(12).im_a_function_for_testing(d_table, 2)
 
@@ -53,19 +75,17 @@ def test_classmethod():
 
     slothwatcher.stop()
 
-    assert os.path.isfile(os.path.join(dirname, slothwatcher.session_id + '.zip'))
-
+    assert os.path.isfile(os.path.join(str(tmp_path), slothwatcher.session_id + '.zip'))
 
-def test_function():
-    dirname = os.path.dirname(__file__)
 
+def test_function(tmp_path):
     d_data = [{'column': 1, 'value': 1},
               {'column': 2, 'value': 2},
               {'column': 3, 'value': 4}]
 
     d_table = pd.DataFrame(d_data)
 
-    slothwatcher.start()
+    slothwatcher.start(to_dir=str(tmp_path))
 
     fn = im_another_function_for_testing(d_table, 2)
 
@@ -82,4 +102,1073 @@ def test_function():
 
     slothwatcher.stop()
 
-    assert os.path.isfile(os.path.join(dirname, slothwatcher.session_id + '.zip'))
+    assert os.path.isfile(os.path.join(str(tmp_path), slothwatcher.session_id + '.zip'))
+
+
+def test_queued_capture(tmp_path):
+    d_data = [{'column': 1, 'value': 1},
+              {'column': 2, 'value': 2},
+              {'column': 3, 'value': 4}]
+
+    d_table = pd.DataFrame(d_data)
+
+    slothwatcher.start(to_dir=str(tmp_path), capture_mode=SlothConfig.SlothCaptureMode.QUEUED)
+
+    fn = im_another_function_for_testing(d_table, 2)
+
+    # the worker processes all the queued records before the snapshot is dumped
+    slothwatcher.stop()
+
+    assert slothwatcher.sloth_worker.dropped_counter == 0
+
+    zip_fn = os.path.join(str(tmp_path), slothwatcher.session_id + '.zip')
+    assert os.path.isfile(zip_fn)
+
+    with zipfile.ZipFile(zip_fn) as myzip:
+        xml_data = myzip.read(slothwatcher.session_id + '.xml')
+
+    assert xml_data.count(b'<function>') == 1
+    assert xml_data.count(b'<function_name>im_another_function_for_testing</function_name>') == 1
+
+    slothwatcher.shutdown()
+
+
+def test_capture_store_eviction():
+
+    def record(fn_name, value):
+        return {
+            'function': {'scope_name': 'test', 'class_name': '', 'class_dump': '', 'function_name': fn_name},
+            'arguments': [{'par_value': value}],
+            'results': []
+        }
+
+    store = SlothCaptureStore(max_records=3, eviction_policy=SlothConfig.SlothEvictionPolicy.DROP_OLDEST)
+    for i in range(5):
+        store.append(record('f', str(i)))
+
+    assert len(store) == 3
+    assert store.dropped_counter == 2
+    assert [r['arguments'][0]['par_value'] for r in store] == ['2', '3', '4']
+
+    store = SlothCaptureStore(max_bytes=2, eviction_policy=SlothConfig.SlothEvictionPolicy.DROP_NEWEST)
+    for i in range(5):
+        store.append(record('f', str(i)))
+
+    assert [r['arguments'][0]['par_value'] for r in store] == ['0', '1']
+    assert store.dropped_counter == 3
+
+    store = SlothCaptureStore(max_records=3, eviction_policy=SlothConfig.SlothEvictionPolicy.FAIR_SHARE)
+    for i in range(4):
+        store.append(record('busy', str(i)))
+    store.append(record('rare', 'r'))
+
+    assert [r['function']['function_name'] for r in store] == ['busy', 'busy', 'rare']
+    assert store[0]['arguments'][0]['par_value'] == '2'
+    assert store[-1]['function']['function_name'] == 'rare'
+
+    # a blob shared by the records is counted once
+    def shared_record(fn_name, value):
+        shared = record(fn_name, value)
+        shared['arguments'][0]['par_ref'] = 'ref_' + value
+        return shared
+
+    store = SlothCaptureStore(max_bytes=10, eviction_policy=SlothConfig.SlothEvictionPolicy.DROP_NEWEST)
+    for i in range(5):
+        store.append(shared_record('f', 'blob_6'))
+    store.append(shared_record('f', 'blob_7'))
+
+    assert len(store) == 5
+    assert store.size_bytes == 6
+    assert store.dropped_counter == 1
+
+    store = SlothCaptureStore(max_records=2, eviction_policy=SlothConfig.SlothEvictionPolicy.DROP_OLDEST)
+    for value in ('blob_6', 'blob_6', 'blob_7'):
+        store.append(shared_record('f', value))
+
+    assert store.size_bytes == 12
+    assert store.blobs == {'ref_blob_6': [1, 6], 'ref_blob_7': [1, 6]}
+
+
+def test_capture_store_limits(monkeypatch, tmp_path):
+
+    d_table = pd.DataFrame([{'column': 1, 'value': 1}])
+
+    # the limits set after the import are applied to the first snapshot
+    monkeypatch.setattr(SlothConfig, 'STORE_MAX_RECORDS', 2)
+
+    slothwatcher.start(to_dir=str(tmp_path))
+
+    for vv in range(5):
+        im_another_function_for_testing(d_table, vv)
+
+    # the records are evicted as they are captured, not when the buffers of the threads are collected
+    assert sum(len(records) for thread, records, totals in slothwatcher.thread_buffers) == 0
+    assert len(slothwatcher.capture_store) == 2
+
+    assert len(slothwatcher.data_watch_dump) == 2
+    assert slothwatcher.data_watch_dump.dropped_counter == 3
+
+    slothwatcher.stop()
+
+
+def test_streaming_snapshot(tmp_path):
+    d_table = pd.DataFrame([{'column': 1, 'value': 1}])
+
+    SlothConfig.FLUSH_ITER_COUNT = 1
+
+    try:
+        slothwatcher.start(to_dir=str(tmp_path))
+
+        im_another_function_for_testing(d_table, 2)
+        im_another_function_for_testing(d_table, 3)
+
+        slothwatcher.stop()
+    finally:
+        SlothConfig.FLUSH_ITER_COUNT = 0
+
+    zip_fn = os.path.join(str(tmp_path), slothwatcher.session_id + '.zip')
+    assert not os.path.isfile(os.path.join(str(tmp_path), slothwatcher.session_id + '.xml'))
+
+    with zipfile.ZipFile(zip_fn) as myzip:
+        root = ET.fromstring(myzip.read(slothwatcher.session_id + '.xml'))
+
+    assert root.find('session_id').text == slothwatcher.session_id
+    assert [f.find('run_id').text for f in root.find('functions_list')] == ['1', '2']
+
+    # the converter streams the functions out of the zip, without extracting it
+    functions = SlothTestConverter().read_snapshot(zip_fn)
+
+    assert next(functions)['run_id'] == '1'
+    assert not os.path.isfile(os.path.join(str(tmp_path), slothwatcher.session_id + '.xml'))
+    assert [f['run_id'] for f in functions] == ['2']
+
+
+@pytest.mark.parametrize("snapshot_format", [SlothConfig.SlothSnapshotFormat.XML,
+                                             SlothConfig.SlothSnapshotFormat.BINARY])
+def test_snapshot_formats(snapshot_format, tmp_path):
+    d_table = pd.DataFrame([{'column': 1, 'value': 1}])
+
+    slothwatcher.start(to_dir=str(tmp_path), snapshot_format=snapshot_format)
+
+    im_another_function_for_testing(d_table, 2)
+
+    slothwatcher.stop()
+
+    zip_fn = os.path.join(str(tmp_path), slothwatcher.session_id + '.zip')
+
+    sltc = SlothTestConverter()
+    functions = list(sltc.read_snapshot(zip_fn))
+
+    assert len(functions) == 1
+    assert functions[0]['func_name'] == 'im_another_function_for_testing'
+    assert [v['par_name'] for v in functions[0]['in']] == ['d_table', 'vv']
+    assert [v['par_simple'] for v in functions[0]['in']] == [False, True]
+
+    sltc.parse_file_create_tests(zip_fn, str(tmp_path))
+
+    with open(os.path.join(str(tmp_path), 'test_sloth_' + slothwatcher.session_id + '.py')) as f:
+        assert 'def test_im_another_function_for_testing_1()' in f.read()
+
+
+@pytest.mark.parametrize("shard_size, shard_by_function, shards", [(2, False, 2), (0, True, 2)])
+def test_sharded_conversion(shard_size, shard_by_function, shards, tmp_path):
+    d_table = pd.DataFrame([{'column': 1, 'value': 1}])
+
+    slothwatcher.start(to_dir=str(tmp_path))
+
+    im_another_function_for_testing(d_table, 2)
+    im_another_function_for_testing(d_table, 3)
+    ClassForTesting(12).im_a_function_for_testing(d_table, 4)
+
+    slothwatcher.stop()
+
+    zip_fn = os.path.join(str(tmp_path), slothwatcher.session_id + '.zip')
+
+    sltc = SlothTestConverter()
+    files = sltc.parse_file_create_tests(zip_fn, str(tmp_path), processes=2, shard_size=shard_size,
+                                         shard_by_function=shard_by_function)
+
+    test_files = [fn for fn in files if os.path.basename(fn).startswith('test_sloth_')]
+    assert len(test_files) == shards
+
+    tests = []
+    for fn in test_files:
+        with open(fn) as f:
+            text = f.read()
+        tests += [line for line in text.splitlines() if line.startswith('def test_')]
+        assert text.startswith('import sloth_test_parval_' + os.path.basename(fn)[len('test_sloth_'):-3] + ' as sl')
+
+    assert len(tests) == 3
+
+    # the workers get the entries of the cache for their shards, the files are not written again
+    mtimes = [os.stat(fn).st_mtime_ns for fn in files]
+
+    sltc = SlothTestConverter()
+    assert sltc.parse_file_create_tests(zip_fn, str(tmp_path), processes=2, shard_size=shard_size,
+                                        shard_by_function=shard_by_function) == files
+    assert [os.stat(fn).st_mtime_ns for fn in files] == mtimes
+
+    job = sltc.shard_job('all', sltc.read_snapshot(zip_fn), str(tmp_path))
+    assert len(job['records']) == 3
+    assert all(rel_path.startswith(job['data_dir_name']) for rel_path in job['files'])
+
+    with open(os.path.join(str(tmp_path), '.sloth_cache'), 'rb') as fh:
+        assert len(pickle.load(fh)['records']) == 3
+
+
+@pytest.mark.parametrize("lazy_values", [True, False])
+def test_lazy_values(lazy_values, tmp_path):
+    slothwatcher.start(to_dir=str(tmp_path), snapshot_format=SlothConfig.SlothSnapshotFormat.BINARY)
+
+    ClassForTesting(12).im_a_function_for_testing(pd.DataFrame([{'column': 1, 'value': 1}]), 2)
+
+    slothwatcher.stop()
+
+    zip_fn = os.path.join(str(tmp_path), slothwatcher.session_id + '.zip')
+
+    SlothConfig.CONVERT_LAZY_VALUES = lazy_values
+
+    try:
+        files = SlothTestConverter().parse_file_create_tests(zip_fn, str(tmp_path))
+    finally:
+        SlothConfig.CONVERT_LAZY_VALUES = True
+
+    spec = importlib.util.spec_from_file_location('sloth_test_parval', files[1])
+    parval = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(parval)
+
+    cls_name = 'cls_im_a_function_for_testing_1_ClassForTesting'
+
+    # the lazy values are loaded on the first access only
+    assert (cls_name in vars(parval)) != lazy_values
+    assert getattr(parval, cls_name).debugging == 12
+    assert cls_name in vars(parval)
+    assert parval.res_im_a_function_for_testing_1_ret_1 == 2
+    assert parval.val_im_a_function_for_testing_1_d_table.equals(pd.DataFrame([{'column': 1, 'value': 1}]))
+
+
+def test_incremental_conversion(tmp_path, monkeypatch):
+    slothwatcher.start(to_dir=str(tmp_path))
+
+    ClassForTesting(12).im_a_function_for_testing(pd.DataFrame([{'column': 1, 'value': 1}]), 2)
+
+    slothwatcher.stop()
+
+    zip_fn = os.path.join(str(tmp_path), slothwatcher.session_id + '.zip')
+
+    files = SlothTestConverter().parse_file_create_tests(zip_fn, str(tmp_path))
+
+    data_dir = os.path.join(str(tmp_path), 'sloth_data_' + slothwatcher.session_id)
+    outputs = files + [os.path.join(data_dir, fn) for fn in os.listdir(data_dir)]
+    mtimes = [os.stat(fn).st_mtime_ns for fn in outputs]
+
+    # the same snapshot is converted from the cache, the files are not touched
+    def no_generation(self, func_data_dict=None):
+        raise Exception('The record was converted again')
+
+    monkeypatch.setattr(SlothTestConverter, 'create_text_of_test_module', no_generation)
+
+    assert SlothTestConverter().parse_file_create_tests(zip_fn, str(tmp_path)) == files
+    assert [os.stat(fn).st_mtime_ns for fn in outputs] == mtimes
+
+    # without the cache, the tests are generated again
+    with pytest.raises(Exception):
+        SlothTestConverter().parse_file_create_tests(zip_fn, str(tmp_path), incremental=False)
+
+    monkeypatch.undo()
+
+    # the same record in another snapshot (with another run id) is converted from the cache too
+    slothwatcher.start(to_dir=str(tmp_path))
+    im_another_function_for_testing(pd.DataFrame([{'column': 1, 'value': 1}]), 2)
+    slothwatcher.stop()
+
+    corpus_fn = SlothSnapshotMerger().merge([os.path.join(str(tmp_path), slothwatcher.session_id + '.zip'), zip_fn],
+                                            str(tmp_path), 'corpus')
+
+    generated = []
+    create_text_of_test_module = SlothTestConverter.create_text_of_test_module
+
+    def counted_generation(self, func_data_dict=None):
+        generated.append(func_data_dict['func_name'])
+        return create_text_of_test_module(self, func_data_dict)
+
+    monkeypatch.setattr(SlothTestConverter, 'create_text_of_test_module', counted_generation)
+
+    files = SlothTestConverter().parse_file_create_tests(corpus_fn, str(tmp_path))
+    assert generated == ['im_another_function_for_testing']
+
+    # the snapshots are merged in the order of their names, the first session goes first
+    with open(files[0]) as f:
+        assert 'def test_im_a_function_for_testing_1():' in f.read()
+    assert os.path.isfile(os.path.join(str(tmp_path), 'sloth_data_corpus', 'val_im_a_function_for_testing_1_d_table.slc'))
+
+    # only the entries used by the last conversion are kept in the cache
+    def cached_records():
+        with open(os.path.join(str(tmp_path), '.sloth_cache'), 'rb') as fh:
+            return len(pickle.load(fh)['records'])
+
+    assert cached_records() == 2
+
+    SlothTestConverter().parse_file_create_tests(zip_fn, str(tmp_path))
+    assert cached_records() == 1
+
+
+@pytest.mark.parametrize("snapshot_format", [SlothConfig.SlothSnapshotFormat.XML,
+                                             SlothConfig.SlothSnapshotFormat.BINARY])
+def test_merge_snapshots(snapshot_format, tmp_path):
+    d_table = pd.DataFrame([{'column': 1, 'value': 1}])
+
+    snapshots = []
+    for source_format, values in ((SlothConfig.SlothSnapshotFormat.XML, (2, 3)),
+                                  (SlothConfig.SlothSnapshotFormat.BINARY, (3, 4))):
+
+        slothwatcher.start(to_dir=str(tmp_path), snapshot_format=source_format)
+
+        for vv in values:
+            im_another_function_for_testing(d_table, vv)
+        ClassForTesting(12).im_a_function_for_testing(d_table, 5)
+
+        slothwatcher.stop()
+
+        # the snapshots of the same second share the name
+        snapshots.append(os.path.join(str(tmp_path), 'snap_' + str(len(snapshots)) + '.zip'))
+        zip_fn = os.path.join(str(tmp_path), slothwatcher.session_id + '.zip')
+        with zipfile.ZipFile(zip_fn) as src, zipfile.ZipFile(snapshots[-1], 'w') as dst:
+            for name in src.namelist():
+                dst.writestr('snap_' + str(len(snapshots) - 1) + name[name.index('.'):], src.read(name))
+        os.remove(zip_fn)
+
+    merger = SlothSnapshotMerger(snapshot_format)
+    zip_fn = merger.merge(snapshots, str(tmp_path), 'corpus')
+
+    assert merger.duplicates_counter == 2
+
+    functions = list(SlothTestConverter().read_snapshot(zip_fn))
+
+    assert [f['run_id'] for f in functions] == ['1', '2', '3', '4']
+    assert [v['par_value'] for f in functions for v in f['in'] if v['par_name'] == 'vv'] == ['2', '3', '5', '4']
+    assert all(v['par_value'] for f in functions for v in f['in'] + f['out'])
+
+    with zipfile.ZipFile(zip_fn) as myzip:
+        index = json.loads(myzip.read('index.json'))
+
+    assert index['records'] == 4
+    assert index['sources'][0]['run_ids'] == {'1': 1, '2': 2, '3': 3}
+    assert index['sources'][1]['run_ids'] == {'1': 2, '2': 4, '3': 3}
+    assert index['functions']['test.im_another_function_for_testing'] == [1, 2, 4]
+
+
+def test_blob_dedup(tmp_path):
+    d_table = pd.DataFrame([{'column': 1, 'value': 1}])
+
+    slothwatcher.start(to_dir=str(tmp_path))
+
+    im_another_function_for_testing(d_table, 2)
+    im_another_function_for_testing(d_table, 3)
+
+    slothwatcher.stop()
+
+    zip_fn = os.path.join(str(tmp_path), slothwatcher.session_id + '.zip')
+
+    with zipfile.ZipFile(zip_fn) as myzip:
+        root = ET.fromstring(myzip.read(slothwatcher.session_id + '.xml'))
+
+    tables = [f.find('arguments_list')[0] for f in root.find('functions_list')]
+    assert tables[0].find('par_ref').text == tables[1].find('par_ref').text
+    assert tables[0].find('par_value').text
+    assert not tables[1].find('par_value').text
+
+    functions = list(SlothTestConverter().read_snapshot(zip_fn))
+
+    assert functions[0]['in'][0]['par_value'] == functions[1]['in'][0]['par_value']
+
+
+def test_resolve_blobs():
+
+    def record(value, ref):
+        return {'run_id': '1', 'function': {'class_dump': '', 'class_ref': ''},
+                'arguments': [{'par_value': value, 'par_ref': ref}], 'results': []}
+
+    records = [record('AAAA', 'text'), record(b'\x00\x01', 'raw'), record('', 'text'), record(b'', 'raw'),
+               record('', 'unknown')]
+
+    resolved = [r['arguments'][0]['par_value'] for r in SlothTestConverter().resolve_blobs(iter(records))]
+
+    # the blobs are read back from the spill file, as text or as bytes
+    assert resolved == ['AAAA', b'\x00\x01', 'AAAA', b'\x00\x01', '']
+
+
+def test_sampling(tmp_path):
+
+    d_table = pd.DataFrame([{'column': 1, 'value': 1}])
+
+    slothwatcher.start(to_dir=str(tmp_path), sample_rate=0.0)
+
+    im_another_function_for_testing(d_table, 2)
+
+    assert slothwatcher.dump_counter == 0
+    assert slothwatcher.sloth_sampler.sampled_out_counter == 1
+
+    slothwatcher.stop()
+
+    sampler = SlothSampler(rate_limit=1)
+    assert sampler.sample('f') == (True, None)
+    assert sampler.sample('f') == (False, None)
+    assert sampler.sample('g') == (True, None)
+
+    sampler = SlothSampler(reservoir=2)
+    for i in range(100):
+        sampled, slot = sampler.sample('f')
+        if sampled:
+            assert slot in (0, 1)
+            sampler.keep('f', slot, i)
+
+    records = sampler.release()
+    assert len(records) == 2
+    assert sampler.sample('f') == (True, 0)
+
+    # the records are kept in their slots, whatever the order they come in (e.g. from the threads)
+    sampler = SlothSampler(reservoir=2)
+    assert sampler.sample('f') == (True, 0)
+    assert sampler.sample('f') == (True, 1)
+    sampler.keep('f', 1, 'B')
+    sampler.keep('f', 0, 'A')
+    assert sampler.release() == ['A', 'B']
+
+    # a limit below one capture per second
+    sampler = SlothSampler(rate_limit=0.5)
+    assert sampler.sample('f') == (True, None)
+    assert sampler.sample('f') == (False, None)
+    bucket_tokens, bucket_time = sampler.buckets['f']
+    sampler.buckets['f'] = (bucket_tokens, bucket_time - 2)
+    assert sampler.sample('f') == (True, None)
+
+
+def test_inputs_dedup(tmp_path):
+
+    d_table = pd.DataFrame([{'column': 1, 'value': 1}])
+
+    slothwatcher.start(to_dir=str(tmp_path), dedup_inputs=True)
+
+    im_another_function_for_testing(d_table, 2)
+    im_another_function_for_testing(d_table.copy(), vv=2)
+    im_another_function_for_testing(d_table, 3)
+
+    assert slothwatcher.dump_counter == 2
+    assert slothwatcher.sloth_fingerprints.skipped_counter == 1
+
+    slothwatcher.stop()
+
+    # the skipped call gives its slot of the reservoir to the next one
+    slothwatcher.start(to_dir=str(tmp_path), dedup_inputs=True, reservoir=2)
+
+    im_another_function_for_testing(d_table, 2)
+    im_another_function_for_testing(d_table, 2)
+    im_another_function_for_testing(d_table, 3)
+
+    slothwatcher.stop()
+
+    functions = SlothTestConverter().read_snapshot(os.path.join(str(tmp_path), slothwatcher.session_id + '.zip'))
+    assert [v['par_value'] for f in functions for v in f['in'] if v['par_name'] == 'vv'] == ['2', '3']
+
+    sampler = SlothSampler(reservoir=2)
+    assert sampler.sample('f') == (True, 0)
+    assert sampler.sample('f') == (True, 1)
+    sampler.cancel('f', 0)
+    assert sampler.sample('f') == (True, 0)
+    sampler.keep('f', 1, 'B')
+    sampler.keep('f', 0, 'A')
+    assert sampler.release() == ['A', 'B']
+
+    cache = SlothFingerprintCache(max_size=1)
+    assert not cache.seen('f', {'a': 1})
+    assert cache.seen('f', {'a': 1})
+    assert not cache.seen('g', {'a': 1})
+    assert not cache.seen('f', {'a': 1})
+
+    # the threads evicting each other's fingerprints
+    errors = []
+
+    def check_inputs(thread_n):
+        try:
+            for n in range(2000):
+                cache.seen('f', {'a': n % 3 + thread_n})
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=check_inputs, args=(thread_n, )) for thread_n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(cache.fingerprints) == 1
+
+
+def test_function_descriptor():
+
+    descriptor = SlothFunctionDescriptor(ClassForTesting.__init__)
+
+    assert descriptor.scope_name == 'test'
+    assert descriptor.class_name == 'ClassForTesting'
+    assert descriptor.name == '__init__'
+    assert dict(descriptor.bind((None,), {})) == {'self': None, 'dd': 0}
+
+    assert descriptor.value_plan(int)[0]
+    assert not descriptor.value_plan(pd.DataFrame)[0]
+    assert descriptor.value_plan(pd.DataFrame) is descriptor.value_plan(pd.DataFrame)
+
+
+def test_call_stack(monkeypatch, tmp_path):
+
+    d_table = pd.DataFrame([{'column': 1, 'value': 1}])
+
+    slothwatcher.start(to_dir=str(tmp_path))
+
+    im_another_function_for_testing(d_table, 2)
+    im_another_function_for_testing(d_table, 3)
+
+    call_stack = slothwatcher.data_watch_dump[0]['function']['call_stack']
+    assert call_stack.startswith(' <- im_another_function_for_testing@test  <- test_call_stack@test ')
+    assert call_stack is slothwatcher.data_watch_dump[1]['function']['call_stack']
+
+    monkeypatch.setattr(SlothConfig, 'CALL_STACK_DEPTH', 1)
+    im_another_function_for_testing(d_table, 4)
+
+    monkeypatch.setattr(SlothConfig, 'CALL_STACK_CAPTURE', False)
+    im_another_function_for_testing(d_table, 5)
+
+    assert slothwatcher.data_watch_dump[2]['function']['call_stack'] == \
+        ' <- im_another_function_for_testing@test  <- test_call_stack@test '
+    assert slothwatcher.data_watch_dump[3]['function']['call_stack'] == ''
+
+    slothwatcher.stop()
+
+
+def test_timing(tmp_path):
+    slothwatcher.start(to_dir=str(tmp_path))
+
+    im_another_function_for_testing(pd.DataFrame([{'column': 1, 'value': 1}]), 2)
+
+    timing = slothwatcher.data_watch_dump[0]['function']['timing']
+    assert sorted(timing) == ['process_ns', 'thread_ns', 'wall_ns']
+    assert slothwatcher.data_watch_dump[0]['function']['run_time'] == str(timing['wall_ns'] // 1000)
+
+    # the whole seconds are not dropped from the run time
+    descriptor = SlothFunctionDescriptor(im_another_function_for_testing.__wrapped__)
+    slothwatcher.capture(descriptor, (pd.DataFrame([{'column': 1, 'value': 1}]), 3), {}, (None, 3), "",
+                         {'wall_ns': 2300000000, 'process_ns': 2100000000, 'thread_ns': 2000000000})
+
+    assert slothwatcher.data_watch_dump[1]['function']['run_time'] == '2300000'
+
+    slothwatcher.stop()
+
+    zip_fn = os.path.join(str(tmp_path), slothwatcher.session_id + '.zip')
+
+    functions = list(SlothTestConverter().read_snapshot(zip_fn))
+    assert functions[1]['timing'] == {'wall_ns': 2300000000, 'process_ns': 2100000000, 'thread_ns': 2000000000}
+
+    files = SlothTestConverter().parse_file_create_tests(zip_fn, str(tmp_path))
+
+    with open(files[0]) as f:
+        text = f.read()
+
+    assert 'assert(run_time <= 6900000)' in text
+    assert 'assert(cpu_time <= 6000000000)' in text
+
+
+def test_benchmark_mode(tmp_path, capsys):
+    slothwatcher.start(to_dir=str(tmp_path))
+
+    im_another_function_for_testing(pd.DataFrame([{'column': 1, 'value': 1}]), 2)
+    ClassForTesting(12).im_a_function_for_testing(pd.DataFrame([{'column': 1, 'value': 1}]), 5)
+
+    slothwatcher.stop()
+
+    zip_fn = os.path.join(str(tmp_path), slothwatcher.session_id + '.zip')
+
+    SlothConfig.BENCHMARK_MODE = True
+    SlothConfig.RUN_TIME_TOLERANCES = {'ClassForTesting.im_a_function_for_testing': 10}
+
+    try:
+        files = SlothTestConverter().parse_file_create_tests(zip_fn, str(tmp_path))
+    finally:
+        SlothConfig.BENCHMARK_MODE = False
+        SlothConfig.RUN_TIME_TOLERANCES = {}
+
+    with open(files[0]) as f:
+        text = f.read()
+
+    assert 'def sloth_benchmark(' in text
+    assert 'assert(run_time <=' not in text
+    assert text.count('tolerance=3,') == 1
+    assert text.count('tolerance=10,') == 1
+    assert 'lambda o, a: o.im_a_function_for_testing(**a), lambda: copy.deepcopy((run_object, run_args))' in text
+
+    # each run gets its own copy of the arguments, the regression is reported with the measured times
+    runs = []
+    times = sloth_benchmark(lambda a: runs.append(a.pop()), lambda: ([1], ), baseline_ns=10 ** 9, warmup=2, repeat=3)
+
+    # the passed runs print nothing to the test suite
+    assert capsys.readouterr().out == ""
+
+    assert runs == [1] * 5
+    assert len(times['wall_ns']) == 3
+
+    with pytest.raises(AssertionError, match='(?s)wall-clock time .* all runs'):
+        sloth_benchmark(lambda: sum(range(10000)), lambda: (), baseline_ns=1, repeat=3)
+
+
+def test_overhead_benchmark(tmp_path):
+    import benchmark
+
+    report = benchmark.run_benchmarks(['scalar', 'dataframe_1e3', 'method_self_1e5', 'dataframe_1e7'],
+                                      max_rows=10 ** 5, calls_scale=0.01, to_dir=str(tmp_path))
+
+    # the report is machine-readable
+    report = json.loads(json.dumps(report))
+
+    assert [result['payload'] for result in report['results']] == ['scalar', 'dataframe_1e3', 'method_self_1e5']
+
+    for result in report['results']:
+        assert result['records'] == result['calls']
+        assert result['watching_ns'] > 0
+        assert result['snapshot_bytes'] > 0
+        assert result['dump_mb_s'] > 0
+        assert result['convert_records_s'] > 0
+
+    assert slothwatcher.sloth_state == SlothConfig.SlothState.IDLE
+    assert SlothConfig.DUMP_ITER_COUNT == 100
+
+
+@watchme()
+async def im_an_async_function_for_testing(d_table=None, vv=1):
+    await asyncio.sleep(0.01)
+
+    return d_table['value'].sum() * vv
+
+
+async def im_a_caller_in_the_loop(d_table=None):
+    # the watched methods are called from a running event loop
+    return await im_an_async_function_for_testing(d_table, 2), im_another_function_for_testing(d_table, 3)
+
+
+def test_async_function(tmp_path, monkeypatch):
+    d_table = pd.DataFrame([{'column': 1, 'value': 1}, {'column': 2, 'value': 2}])
+
+    slothwatcher.start(to_dir=str(tmp_path))
+
+    res, another_res = asyncio.run(im_a_caller_in_the_loop(d_table))
+
+    # the awaited result is returned and captured, not the coroutine
+    assert res == 6
+
+    assert len(slothwatcher.data_watch_dump) == 2
+    func_dict = slothwatcher.data_watch_dump[0]['function']
+
+    assert func_dict['function_name'] == 'im_an_async_function_for_testing'
+    assert func_dict['is_async'] == 'True'
+    assert func_dict['timing']['wall_ns'] >= 10 ** 7
+    assert 'thread_ns' not in func_dict['timing']
+    assert 'im_a_caller_in_the_loop' in func_dict['call_stack']
+
+    assert slothwatcher.data_watch_dump[1]['function']['is_async'] == 'False'
+
+    slothwatcher.stop()
+
+    zip_fn = os.path.join(str(tmp_path), slothwatcher.session_id + '.zip')
+
+    files = SlothTestConverter().parse_file_create_tests(zip_fn, str(tmp_path))
+
+    with open(files[0]) as f:
+        text = f.read()
+
+    assert 'run_result = run_loop.run_until_complete(im_an_async_function_for_testing(**run_args))' in text
+
+    # the generated test of the coroutine passes
+    monkeypatch.syspath_prepend(str(tmp_path))
+    # the data module of another session with the same id (in another tmp_path) may be imported already
+    monkeypatch.delitem(sys.modules, 'sloth_test_parval_' + slothwatcher.session_id, raising=False)
+
+    spec = importlib.util.spec_from_file_location('test_sloth_async', files[0])
+    generated = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(generated)
+
+    generated.test_im_an_async_function_for_testing_1()
+
+
+@watchme()
+def im_a_threaded_function_for_testing(thread_n=0, call_n=0):
+    return thread_n * 1000 + call_n
+
+
+def call_in_threads(threads_amount: int = 0, calls_amount: int = 0):
+
+    def calls(thread_n):
+        for call_n in range(calls_amount):
+            im_a_threaded_function_for_testing(thread_n, call_n)
+
+    threads = [threading.Thread(target=calls, args=(thread_n, )) for thread_n in range(threads_amount)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def snapshot_results(filenames=None) -> list:
+    converter = SlothTestConverter()
+    return [int(func_dict['out'][0]['par_value']) for filename in filenames
+            for func_dict in converter.read_snapshot(filename)]
+
+
+def test_threaded_capture(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(SlothConfig, 'DUMP_ITER_COUNT', 7)
+
+    slothwatcher.start(to_dir=str(tmp_path))
+
+    call_in_threads(4, 25)
+
+    slothwatcher.stop()
+
+    # the rotated snapshots don't overwrite each other, and no record is lost or written twice
+    snapshots = sorted(str(fn) for fn in tmp_path.glob('*.zip'))
+    assert len(snapshots) > 1
+
+    results = snapshot_results(snapshots)
+    assert sorted(results) == sorted(thread_n * 1000 + call_n for thread_n in range(4) for call_n in range(25))
+
+    # the records of the threads are collected in the order of the calls
+    monkeypatch.setattr(SlothConfig, 'DUMP_ITER_COUNT', 1000)
+
+    slothwatcher.start(to_dir=str(tmp_path))
+
+    call_in_threads(3, 10)
+
+    assert slothwatcher.dump_counter == 30
+    assert len(slothwatcher.data_watch_dump) == 30
+    assert all(thread.is_alive() for thread, records, totals in slothwatcher.thread_buffers)
+
+    slothwatcher.stop()
+
+    # the snapshots of the sessions started in the same second are not overwritten
+    assert len(list(tmp_path.glob('*.zip'))) == len(snapshots) + 1
+
+
+def watch_in_child_process(calls_amount: int = 0):
+    for call_n in range(calls_amount):
+        im_a_threaded_function_for_testing(1, call_n)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="fork is not available")
+def test_process_shards(tmp_path):
+
+    slothwatcher.start(to_dir=str(tmp_path))
+
+    im_a_threaded_function_for_testing(0, 0)
+
+    # the forked processes write the shards of the session
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=watch_in_child_process, args=(3, )) for _ in range(2)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    im_a_threaded_function_for_testing(0, 1)
+
+    slothwatcher.stop()
+
+    session_id = slothwatcher.session_id
+
+    shards = SlothSnapshotMerger.session_shards(session_id, str(tmp_path))
+    assert [os.path.basename(fn) for fn in shards] == \
+        sorted([session_id + '.zip'] + [session_id + '_w' + str(process.pid) + '.zip' for process in processes])
+
+    assert snapshot_results(shards[:1]) == [0, 1]
+    assert snapshot_results(shards[1:]) == [1000, 1001, 1002, 1000, 1001, 1002]
+
+    merged_fn = SlothSnapshotMerger().merge_session(session_id, str(tmp_path))
+
+    assert os.path.basename(merged_fn) == 'merged_' + session_id + '.zip'
+    assert sorted(snapshot_results([merged_fn])) == [0, 1, 1000, 1001, 1002]
+
+
+@pytest.mark.parametrize("compression, compress_level, compress_type", [
+    (SlothConfig.SlothCompression.STORED, None, zipfile.ZIP_STORED),
+    (SlothConfig.SlothCompression.DEFLATE, 1, zipfile.ZIP_DEFLATED),
+    (SlothConfig.SlothCompression.DEFLATE, 9, zipfile.ZIP_DEFLATED),
+    (SlothConfig.SlothCompression.BZIP2, None, zipfile.ZIP_BZIP2),
+    (SlothConfig.SlothCompression.LZMA, None, zipfile.ZIP_LZMA),
+])
+def test_snapshot_compression(compression, compress_level, compress_type, tmp_path):
+
+    slothwatcher.start(to_dir=str(tmp_path), compression=compression, compress_level=compress_level)
+
+    im_another_function_for_testing(pd.DataFrame([{'column': 1, 'value': 1}]), 2)
+    im_another_function_for_testing(pd.DataFrame([{'column': 2, 'value': 2}]), 3)
+
+    slothwatcher.stop()
+
+    zip_fn = os.path.join(str(tmp_path), slothwatcher.session_id + '.zip')
+
+    with zipfile.ZipFile(zip_fn) as myzip:
+        assert [info.compress_type for info in myzip.infolist()] == [compress_type]
+
+    # the converter reads any of the codecs
+    files = SlothTestConverter().parse_file_create_tests(zip_fn, str(tmp_path))
+    with open(files[0]) as f:
+        assert f.read().count('def test_im_another_function_for_testing_') == 2
+
+    merged_fn = SlothSnapshotMerger(compression=compression).merge([zip_fn], str(tmp_path), 'merged')
+    with zipfile.ZipFile(merged_fn) as myzip:
+        assert myzip.infolist()[0].compress_type == compress_type
+
+
+def test_snapshot_compression_settings():
+
+    with pytest.raises(Exception, match='Unknown compression'):
+        slothwatcher.start(compression="zstd")
+
+    with pytest.raises(Exception, match='level 0 is not supported'):
+        slothwatcher.start(compression=SlothConfig.SlothCompression.BZIP2, compress_level=0)
+
+    assert slothwatcher.sloth_state != SlothConfig.SlothState.WATCHING
+
+
+@watchme()
+def im_a_function_with_a_payload_for_testing(payload=None, n=0):
+    return n
+
+
+def test_snapshot_rotation(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(SlothConfig, 'DUMP_MAX_BYTES', 10000)
+
+    slothwatcher.start(to_dir=str(tmp_path))
+
+    for n in range(10):
+        im_a_function_with_a_payload_for_testing(bytes([n]) * 3000, n)
+
+    slothwatcher.stop()
+
+    # rotated by the size of the captured values, the snapshots of the session are numbered
+    session_id = slothwatcher.session_id
+
+    shards = SlothSnapshotMerger.session_shards(session_id, str(tmp_path))
+    assert [os.path.basename(fn) for fn in shards] == \
+        [session_id + '.zip', session_id + '_0002.zip', session_id + '_0003.zip']
+
+    assert [snapshot_results([fn]) for fn in shards] == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+
+    # the snapshots are created with the mode of the files created by open()
+    umask = os.umask(0)
+    os.umask(umask)
+    assert all(os.stat(fn).st_mode & 0o777 == 0o666 & ~umask for fn in shards)
+
+    # the name claimed by a process killed before its dump is skipped by the merge
+    open(os.path.join(str(tmp_path), session_id + '_0004.zip'), 'wb').close()
+
+    merged_fn = SlothSnapshotMerger().merge_session(session_id, str(tmp_path))
+    assert snapshot_results([merged_fn]) == list(range(10))
+
+    # rotated by the time
+    monkeypatch.setattr(SlothConfig, 'DUMP_MAX_BYTES', 0)
+    monkeypatch.setattr(SlothConfig, 'DUMP_MAX_SECONDS', 0.05)
+
+    slothwatcher.start(to_dir=str(tmp_path))
+
+    im_a_function_with_a_payload_for_testing(b'', 0)
+    im_a_function_with_a_payload_for_testing(b'', 1)
+    time.sleep(0.06)
+    im_a_function_with_a_payload_for_testing(b'', 2)
+
+    slothwatcher.stop()
+
+    shards = SlothSnapshotMerger.session_shards(slothwatcher.session_id, str(tmp_path))
+    assert [snapshot_results([fn]) for fn in shards] == [[0, 1], [2]]
+
+
+def test_session_ids(tmp_path):
+
+    # the sessions of these seconds exist already
+    started = int(time.time())
+    for session_time in range(started, started + 5):
+        open(os.path.join(str(tmp_path), str(session_time) + '.zip'), 'wb').close()
+
+    session_ids = []
+
+    for n in range(3):
+        slothwatcher.start(to_dir=str(tmp_path))
+        im_a_function_with_a_payload_for_testing(b'', n)
+        slothwatcher.stop()
+
+        session_ids.append(slothwatcher.session_id)
+
+    # the sessions are numbered, their ids stay the time of the start
+    assert len(set(session_ids)) == 3
+    assert all('_s' in session_id for session_id in session_ids)
+    assert all(started <= int(session_id.split('_s')[0]) <= time.time() for session_id in session_ids)
+
+    # the sessions don't take the snapshots of each other
+    for n, session_id in enumerate(session_ids):
+        shards = SlothSnapshotMerger.session_shards(session_id, str(tmp_path))
+        assert [snapshot_results([fn]) for fn in shards] == [[n]]
+
+
+def test_metrics(tmp_path, monkeypatch):
+
+    metrics_file = str(tmp_path / 'sloth.prom')
+
+    monkeypatch.setattr(SlothConfig, 'METRICS_INTERVAL', 60)
+    monkeypatch.setattr(SlothConfig, 'METRICS_FILE', metrics_file)
+
+    fn_key = slothwatcher.function_key(im_a_function_with_a_payload_for_testing)
+
+    before = slothwatcher.stats()
+    captured = before['captures'].get(fn_key, {}).get('count', 0)
+    serialized = before['serialization'].get('builtins.bytes', {}).get('bytes', 0)
+    dumps = before['dumps']['bytes']['count']
+
+    slothwatcher.start(to_dir=str(tmp_path))
+
+    for n in range(5):
+        im_a_function_with_a_payload_for_testing(bytes([n]) * 3000, n)
+
+    stats = slothwatcher.stats()
+    assert stats['captures'][fn_key]['count'] == captured + 5
+    assert stats['captures'][fn_key]['per_second'] > 0
+    assert stats['buffered']['records'] == 5
+    assert stats['serialization']['builtins.bytes']['bytes'] >= serialized + 5 * 3000
+    assert stats['queue_depth'] == {'capture': 0, 'writer': 0}
+
+    slothwatcher.stop()
+
+    # the snapshot is written, and the stats are reported to the file at stop
+    stats = slothwatcher.stats()
+    assert stats['dumps']['bytes']['count'] == dumps + 1
+    assert stats['dumps']['seconds']['buckets']['+Inf'] == stats['dumps']['seconds']['count']
+    assert stats['buffered']['records'] == 0
+
+    with open(metrics_file) as fh:
+        text = fh.read()
+
+    assert 'sloth_captures_total{function="' + fn_key + '"} ' + str(captured + 5) in text
+    assert '# TYPE sloth_serialize_seconds histogram' in text
+    assert 'sloth_serialize_seconds_bucket{type="builtins.bytes",le="+Inf"}' in text
+    assert 'sloth_snapshot_bytes_count ' + str(dumps + 1) in text
+
+    assert SlothMetrics.summary_text(stats).startswith("Sloth stats: ")
+
+    # the rate is over the time since the last report (the one at stop)
+    assert stats['captures'][fn_key]['count'] == captured + 5
+    assert stats['captures'][fn_key]['per_second'] == 0.0
+    assert stats['window_seconds'] < stats['uptime_seconds']
+
+    # (the metrics without the gauges of the watcher are not written)
+    monkeypatch.setattr(SlothConfig, 'METRICS_FILE', None)
+
+    metrics = SlothMetrics()
+    metrics.count_capture(fn_key)
+    metrics.report(metrics.stats())
+    metrics.count_capture(fn_key)
+    metrics.count_capture(fn_key)
+
+    window_stats = metrics.stats()
+    assert window_stats['captures'][fn_key]['count'] == 3
+    assert window_stats['captures'][fn_key]['per_second'] == pytest.approx(2 / window_stats['window_seconds'])
+
+
+@watchme()
+def im_a_mutating_function_for_testing(d_dict=None):
+    d_dict['value'] = 2
+
+    return d_dict
+
+
+def test_serialize_once_capture(tmp_path):
+
+    slothwatcher.start(to_dir=str(tmp_path), copy_mode=SlothConfig.SlothCopyMode.SERIALIZE)
+
+    in_args, in_kwargs = slothwatcher.snapshot_inputs((1, 'a', [1]), {'d_table': pd.DataFrame([{'value': 1}])})
+    assert in_args[:2] == (1, 'a')
+    assert isinstance(in_args[2], SlothSerializedValue)
+    assert isinstance(in_kwargs['d_table'], pd.DataFrame)
+
+    im_a_mutating_function_for_testing({'value': 1})
+
+    record = slothwatcher.data_watch_dump[0]
+    assert joblib.load(io.BytesIO(record['arguments'][0]['par_value'])) == {'value': 1}
+    assert joblib.load(io.BytesIO(record['results'][0]['par_value'])) == {'value': 2}
+    assert pickle.loads(record['arguments'][0]['par_type']) is dict
+
+    slothwatcher.stop()
+
+
+@watchme()
+def im_an_inplace_function_for_testing(d_array=None, k=1):
+    d_array *= k
+
+    return float(d_array.sum())
+
+
+@watchme()
+def im_a_function_with_a_callback_for_testing(callback=None, vv=1):
+    return callback(vv)
+
+
+def test_serialize_once_unpicklable(tmp_path):
+
+    slothwatcher.start(to_dir=str(tmp_path), copy_mode=SlothConfig.SlothCopyMode.SERIALIZE)
+
+    # the argument can't be serialized, the call is not captured, but it still runs
+    assert im_a_function_with_a_callback_for_testing(lambda vv: vv * 2, 3) == 6
+    assert slothwatcher.dump_counter == 0
+
+    slothwatcher.stop()
+
+
+def test_columnar_serializer(tmp_path):
+
+    d_table = pd.DataFrame({'value': [1.5, 2.5, 4.5], 'name': ['a', 'b', 'c']}, index=[10, 20, 30])
+
+    for value in (d_table, d_table['value'], d_table['value'].values):
+
+        data = dump_columnar(value)
+
+        filename = os.path.join(str(tmp_path), 'value.slc')
+        with open(filename, 'wb') as fh:
+            fh.write(data)
+
+        loaded = sloth_load_columnar(filename)
+
+        assert type(loaded) == type(value)
+        if isinstance(value, np.ndarray):
+            assert np.array_equal(loaded, value)
+        else:
+            assert loaded.equals(value)
+            assert loaded.index.equals(value.index)
+
+
+def test_columnar_inplace_inputs(tmp_path, monkeypatch):
+    slothwatcher.start(to_dir=str(tmp_path))
+
+    im_an_inplace_function_for_testing(np.arange(5.0), 3)
+
+    slothwatcher.stop()
+
+    zip_fn = os.path.join(str(tmp_path), slothwatcher.session_id + '.zip')
+
+    files = SlothTestConverter().parse_file_create_tests(zip_fn, str(tmp_path))
+
+    # the generated test changes its memory mapped input in place
+    monkeypatch.syspath_prepend(str(tmp_path))
+    # the data module of another session with the same id (in another tmp_path) may be imported already
+    monkeypatch.delitem(sys.modules, 'sloth_test_parval_' + slothwatcher.session_id, raising=False)
+
+    spec = importlib.util.spec_from_file_location('test_sloth_inplace', files[0])
+    generated = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(generated)
+
+    generated.test_im_an_inplace_function_for_testing_1()